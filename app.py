@@ -1,31 +1,42 @@
 # Chexpert_front-main/app.py
-import os, io, uuid, datetime, time, json
-from typing import Optional, List, Tuple
+import os, io, re, uuid, datetime, time, zipfile, asyncio, functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Optional, List, Tuple, Union
 
 import numpy as np
 from PIL import Image
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Form, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 import torch
 
 # =========================
 # 路径与静态目录（自动创建）
 # =========================
 ROOT = os.path.abspath(os.path.dirname(__file__))
-STATIC_ROOT = os.path.join(ROOT, "static")
+STATIC_ROOT = os.environ.get("CHEX_STATIC_ROOT", os.path.join(ROOT, "static"))
 UPLOAD_DIR = os.path.join(STATIC_ROOT, "uploads")
 HEATMAP_DIR = os.path.join(STATIC_ROOT, "heatmaps")
 for d in (UPLOAD_DIR, HEATMAP_DIR):
     os.makedirs(d, exist_ok=True)
 
+# 多进程部署（chex_serve 设置 CHEX_WORKERS）：刚返回的原图 / 热力图可能由另一个 worker 在后台写入，
+# 本进程的 _WRITER 不知道；此时 /static 未命中先轮询等待至多 STATIC_MISS_WAIT_S 秒再 404
+SERVE_WORKERS = max(1, int(os.environ.get("CHEX_WORKERS", "1")))
+STATIC_MISS_WAIT_S = float(os.environ.get("CHEX_STATIC_MISS_WAIT_MS", "2000")) / 1000.0
+
 # 历史记录数据文件
-DATA_DIR = os.path.join(ROOT, "data")
-HISTORY_FILE = os.path.join(DATA_DIR, "analysis_history.jsonl")
+DATA_DIR = os.environ.get("CHEX_DATA_DIR", os.path.join(ROOT, "data"))
+HISTORY_FILE = os.path.join(DATA_DIR, "analysis_history.jsonl")   # 旧格式，启动时自动迁移
+HISTORY_DB = os.path.join(DATA_DIR, "analysis_history.sqlite3")
 os.makedirs(DATA_DIR, exist_ok=True)
 
+from chex_history import HistoryStore  # noqa
+_HISTORY = HistoryStore(HISTORY_DB, legacy_jsonl=HISTORY_FILE)
+
 # =========================
 # App & CORS & 静态资源
 # =========================
@@ -38,12 +49,49 @@ app.add_middleware(
 )
 app.mount("/static", StaticFiles(directory=STATIC_ROOT), name="static")
 
+@app.middleware("http")
+async def _count_requests(request: Request, call_next):
+    # /api 请求计数与端到端耗时（chex_stage_seconds{stage="request"}）
+    if not request.url.path.startswith("/api/"):
+        return await call_next(request)
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        observe_stage("request", time.perf_counter() - t0)
+        REQUESTS.inc(1, request.url.path, str(status))
+
+@app.middleware("http")
+async def _wait_pending_artifacts(request: Request, call_next):
+    # 原图 / 热力图在后台写入；请求到达时若仍在写，先等写完再交给 StaticFiles
+    if request.url.path.startswith("/static/"):
+        path = os.path.join(STATIC_ROOT, request.url.path[len("/static/"):])
+        if _WRITER.is_pending(path):
+            await run_in_threadpool(_WRITER.wait, path, 10.0)
+        elif SERVE_WORKERS > 1 and request.url.path.startswith(("/static/uploads/", "/static/heatmaps/")):
+            # 可能由其他 worker 写入中（写入是 tmp + os.replace，文件出现即完整）
+            give_up = time.monotonic() + STATIC_MISS_WAIT_S
+            while not os.path.exists(path) and time.monotonic() < give_up:
+                await asyncio.sleep(0.02)
+    return await call_next(request)
+
 # =========================
 # 导入模型（建议文件名为 chex_model.py）
 # =========================
-from chex_model import init_model, infer as model_infer  # noqa
+from chex_model import init_model, infer as model_infer, infer_batch, infer_features, classify, heatmap_classes, triage_scores, model_version, backend_name, embedding_space, embedding_dim  # noqa
+from chex_cache import FeatureCache, ResultCache, heatmap_variant, pack_embedding, unpack_embedding  # noqa
+from chex_persist import ArtifactWriter, heatmap_extension  # noqa
+from chex_store import ArtifactStore  # noqa
+from chex_metrics import REGISTRY, REQUESTS, observe_stage, timed  # noqa
+from chex_overlay import cam_grid_payload  # noqa
+from chex_ingest import Upload, UploadError, receive_upload, receive_uploads  # noqa
+from chex_admission import AdmissionController, Rejected, expired, parse_lane, parse_timeouts  # noqa
+from chex_similar import EmbeddingIndex  # noqa
 
-MODEL_PATH = "final_global_model.pth"  # ← 替换为你的权重文件名/路径
+MODEL_PATH = os.environ.get("MODEL_PATH", "final_global_model.pth")  # ← 替换为你的权重文件名/路径
 
 # CheXpert-14 类名
 CHEX_CLASSES: List[str] = [
@@ -53,56 +101,379 @@ CHEX_CLASSES: List[str] = [
     "Pleural Other", "Fracture", "Support Devices"
 ]
 
+# 启动自动调优（见 chex_autotune）：1 = 按 CPU 型号 + 核数 + 权重哈希复用已保存的配置，没有时先扫描一遍；
+# force = 总是重新扫描。调优结果只填充下面未显式设置的 CHEX_* 项
+AUTOTUNE = os.environ.get("CHEX_AUTOTUNE", "0").lower()
+AUTOTUNE_FILE = os.environ.get("CHEX_AUTOTUNE_FILE", os.path.join(DATA_DIR, "autotune.json"))
+AUTOTUNE_SLO_MS = float(os.environ.get("CHEX_AUTOTUNE_SLO_MS", "500"))
+_AUTOTUNED: Optional[dict] = None
+if AUTOTUNE in ("1", "force") and os.path.exists(MODEL_PATH):
+    import chex_autotune  # noqa
+    try:
+        _AUTOTUNED = chex_autotune.load_or_tune(
+            MODEL_PATH, AUTOTUNE_FILE, class_names=CHEX_CLASSES,
+            cores=int(os.environ.get("CHEX_TORCH_THREADS", "0")) or None,   # chex_serve 多 worker 时每个 worker 的核数
+            force=AUTOTUNE == "force", slo_ms=AUTOTUNE_SLO_MS,
+            cache_dir=os.environ.get("CHEX_MODEL_CACHE_DIR", os.path.join(DATA_DIR, "model_cache")) or None,
+        )
+        for _k, _v in chex_autotune.env_overrides(_AUTOTUNED).items():
+            os.environ.setdefault(_k, _v)
+    except Exception as e:
+        print(f"[app] 自动调优失败，使用默认配置：{e}")
+
+# 推理模式：single = 每个请求单独前向；batch = 经 chex_batching 微批合并
+INFER_MODE = os.environ.get("CHEX_INFER_MODE", "single").lower()
+BATCH_MAX_SIZE = int(os.environ.get("CHEX_BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("CHEX_BATCH_MAX_WAIT_MS", "10"))
+# 推理线程数与每线程 torch 线程数（0 表示不限制/不设置）
+INFER_WORKERS = int(os.environ.get("CHEX_INFER_WORKERS", "1"))
+INTRA_OP_THREADS = int(os.environ.get("CHEX_INTRA_OP_THREADS", "0"))
+# 推理后端（见 chex_backends）：eager / torchscript / compile / onnx，以及 BN 折叠、NHWC 布局
+BACKEND = os.environ.get("CHEX_BACKEND", "eager").lower()
+FOLD_BN = os.environ.get("CHEX_FOLD_BN", "0") == "1"
+CHANNELS_LAST = os.environ.get("CHEX_CHANNELS_LAST", "0") == "1"
+ONNX_PATH = os.environ.get("CHEX_ONNX_PATH") or None
+# 推理精度：fp32 / bf16 / int8；int8 需要校准图片（目录或 CSV 清单）
+PRECISION = os.environ.get("CHEX_PRECISION", "fp32").lower()
+CALIB_DIR = os.environ.get("CHEX_CALIB_DIR") or None
+CALIB_IMAGES = int(os.environ.get("CHEX_CALIB_IMAGES", "256"))
+# 集成与测试时增强（见 chex_ensemble）：附加权重（逗号分隔，可含通配符）与 TTA 视图（flip,crops）
+ENSEMBLE = [p for p in os.environ.get("CHEX_ENSEMBLE", "").split(",") if p.strip()]
+TTA = [v.strip() for v in os.environ.get("CHEX_TTA", "").lower().split(",") if v.strip()]
+# 冷启动：按权重哈希缓存的模型产物目录（空串关闭），以及加载后是否预热
+MODEL_CACHE_DIR = os.environ.get("CHEX_MODEL_CACHE_DIR", os.path.join(DATA_DIR, "model_cache"))
+WARMUP = os.environ.get("CHEX_WARMUP", "1") == "1"
+# 进程级 torch 线程数（多 worker 部署时由 chex_serve 按核数均分后设置；0 表示不设置）
+TORCH_THREADS = int(os.environ.get("CHEX_TORCH_THREADS", "0"))
+INTEROP_THREADS = int(os.environ.get("CHEX_INTEROP_THREADS", "0"))
+if TORCH_THREADS > 0:
+    torch.set_num_threads(TORCH_THREADS)
+if INTEROP_THREADS > 0:
+    try:
+        torch.set_interop_threads(INTEROP_THREADS)
+    except RuntimeError as e:   # 已有并行任务运行过时不可再设
+        print(f"[app] set_interop_threads 跳过：{e}")
+# DICOM 降采样：要保存原图（analyze / batch）时的长边上限（原图/热力图分辨率），以及不保存原图时的长边
+DICOM_MAX_SIDE = int(os.environ.get("CHEX_DICOM_MAX_SIDE", "2048"))
+DICOM_MODEL_SIDE = 448
+# 结果缓存：内存层容量（MB，0 关闭）与可选磁盘层目录
+CACHE_MB = int(os.environ.get("CHEX_CACHE_MB", "64"))
+CACHE_DIR = os.environ.get("CHEX_CACHE_DIR", "")
+_CACHE = ResultCache(CACHE_MB << 20, disk_dir=CACHE_DIR or None) if CACHE_MB > 0 else None
+# 后台持久化：线程数、排队上限（满了阻塞请求形成背压）、热力图编码
+PERSIST_WORKERS = int(os.environ.get("CHEX_PERSIST_WORKERS", "2"))
+PERSIST_MAX_PENDING = int(os.environ.get("CHEX_PERSIST_MAX_PENDING", "64"))
+HEATMAP_FORMAT = os.environ.get("CHEX_HEATMAP_FORMAT", "png").lower()
+HEATMAP_QUALITY = int(os.environ.get("CHEX_HEATMAP_QUALITY", "85"))
+HEATMAP_MAX_SIDE = int(os.environ.get("CHEX_HEATMAP_MAX_SIDE", "0"))   # 叠加时即按该长边渲染，而非渲染原尺寸后再缩
+HEATMAP_MODES = ("image", "grid")
+_WRITER = ArtifactWriter(PERSIST_WORKERS, PERSIST_MAX_PENDING)
+HEATMAP_EXT = heatmap_extension(HEATMAP_FORMAT)
+# 上传接收：单文件上限、内存中缓冲的上限（超出后溢出到临时文件）；解码 / 推理专用线程数
+MAX_UPLOAD_BYTES = int(float(os.environ.get("CHEX_MAX_UPLOAD_MB", "100")) * (1 << 20))
+UPLOAD_SPOOL_BYTES = int(float(os.environ.get("CHEX_UPLOAD_SPOOL_MB", "8")) * (1 << 20))
+ANALYZE_WORKERS = int(os.environ.get("CHEX_ANALYZE_WORKERS", "8"))
+_ANALYZE_POOL = ThreadPoolExecutor(max_workers=max(1, ANALYZE_WORKERS), thread_name_prefix="chex-analyze")
+# 准入控制（见 chex_admission）：同时执行的 analyze / analyze_batch 数、排队上限、各优先级通道的缺省截止时间；
+# 优先级由请求头 X-Priority 或表单字段 priority 指定（stat / routine / bulk），
+# 截止时间由请求头 X-Request-Timeout-Ms 或表单字段 timeout_ms 覆盖
+ADMISSION = os.environ.get("CHEX_ADMISSION", "1") == "1"
+MAX_INFLIGHT = int(os.environ.get("CHEX_MAX_INFLIGHT", str(ANALYZE_WORKERS)))
+MAX_QUEUE = int(os.environ.get("CHEX_MAX_QUEUE", "64"))
+LANE_TIMEOUTS = parse_timeouts(os.environ.get("CHEX_LANE_TIMEOUTS", ""))
+_ADMISSION = AdmissionController(MAX_INFLIGHT, MAX_QUEUE, LANE_TIMEOUTS) if ADMISSION else None
+# 分诊模式（analyze 的 triage 字段缺省值）：先返回分类，只有分诊分数 >= CHEX_TRIAGE_HEATMAP_THRESHOLD 的图
+# 当场生成热力图，其余暂缓，CAM 特征图按 request_id 存入 LRU（容量 CHEX_FEATURE_CACHE_MB），
+# 由 POST /api/v1/image/heatmap/{request_id} 按需补算
+TRIAGE = os.environ.get("CHEX_TRIAGE", "0") == "1"
+TRIAGE_HEATMAP_THRESHOLD = float(os.environ.get("CHEX_TRIAGE_HEATMAP_THRESHOLD", "0.5"))
+FEATURE_CACHE_MB = int(os.environ.get("CHEX_FEATURE_CACHE_MB", "64"))
+_FEATURES = FeatureCache(FEATURE_CACHE_MB << 20) if FEATURE_CACHE_MB > 0 else None
+# 产物存储（见 chex_store）：按请求登记的清单索引；保留天数 / 总容量（0 不限制）由后台线程定期清理；
+# CHEX_ARTIFACT_SHARD=1 时按文件名哈希前缀而不是按天分目录
+ARTIFACT_SHARD = os.environ.get("CHEX_ARTIFACT_SHARD", "0") == "1"
+ARTIFACT_MAX_AGE_DAYS = float(os.environ.get("CHEX_ARTIFACT_MAX_AGE_DAYS", "0"))
+ARTIFACT_MAX_BYTES = int(float(os.environ.get("CHEX_ARTIFACT_MAX_GB", "0")) * (1 << 30))
+ARTIFACT_GC_INTERVAL_S = float(os.environ.get("CHEX_ARTIFACT_GC_INTERVAL_S", "600"))
+_STORE = ArtifactStore(STATIC_ROOT, os.path.join(DATA_DIR, "artifacts.sqlite3"), "/static", shard=ARTIFACT_SHARD,
+                       max_age_days=ARTIFACT_MAX_AGE_DAYS, max_bytes=ARTIFACT_MAX_BYTES).start_gc(ARTIFACT_GC_INTERVAL_S)
+
 # 仅一次加载模型
 _MODEL = None
 _CLASS_NAMES: Optional[List[str]] = None
+_BATCHER = None
 try:
     _MODEL, _CLASS_NAMES = init_model(
         MODEL_PATH,
         class_names=CHEX_CLASSES,
-        use_imagenet_norm=False
+        use_imagenet_norm=False,
+        backend=BACKEND,
+        fold_bn=FOLD_BN,
+        channels_last=CHANNELS_LAST,
+        onnx_path=ONNX_PATH,
+        precision=PRECISION,
+        calib_dir=CALIB_DIR,
+        calib_images=CALIB_IMAGES,
+        cache_dir=MODEL_CACHE_DIR or None,
+        warmup=WARMUP,
+        ensemble=ENSEMBLE,
+        tta=TTA,
     )
     print("[app] 模型加载 OK，classes:", len(_CLASS_NAMES))
+    if INFER_MODE == "batch" or INFER_WORKERS > 1 or INTRA_OP_THREADS > 0:
+        from chex_batching import BatchingEngine  # noqa
+        # single 模式下 batch=1、不等待，即 N 个独立推理线程
+        batch_size, wait_ms = (BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS) if INFER_MODE == "batch" else (1, 0.0)
+        _BATCHER = BatchingEngine(
+            batch_size, wait_ms,
+            num_workers=INFER_WORKERS,
+            intra_op_threads=INTRA_OP_THREADS or None,
+        ).start()
+        model_infer = _BATCHER.infer  # noqa: F811  签名与 chex_model.infer 一致
+        print(f"[app] 推理调度：mode={INFER_MODE} max_batch_size={batch_size} max_wait_ms={wait_ms} "
+              f"workers={INFER_WORKERS} intra_op_threads={INTRA_OP_THREADS or 'default'}")
 except Exception as e:
     print("[app] 模型加载失败：", e)
 
+# 相似病例检索（见 chex_similar）：分析时顺带保存池化后的嵌入，按历史记录 id 建索引；
+# 索引目录按特征空间（权重哈希等）区分，与历史库放在一起。NLIST>0 启用 IVF 粗划分，PQ_M>0 启用乘积量化
+SIMILAR = os.environ.get("CHEX_SIMILAR", "0") == "1"
+SIMILAR_NLIST = int(os.environ.get("CHEX_SIMILAR_NLIST", "0"))
+SIMILAR_NPROBE = int(os.environ.get("CHEX_SIMILAR_NPROBE", "8"))
+SIMILAR_PQ_M = int(os.environ.get("CHEX_SIMILAR_PQ_M", "0"))
+SIMILAR_TRAIN_SIZE = int(os.environ.get("CHEX_SIMILAR_TRAIN_SIZE", "65536"))
+SIMILAR_MAX_K = 50
+_SIMILAR: Optional[EmbeddingIndex] = None
+if SIMILAR and _MODEL is not None:
+    try:
+        _SIMILAR = EmbeddingIndex(
+            os.path.join(DATA_DIR, "embeddings", embedding_space()), dim=embedding_dim(), space=embedding_space(),
+            nlist=SIMILAR_NLIST, nprobe=SIMILAR_NPROBE, pq_m=SIMILAR_PQ_M, train_size=SIMILAR_TRAIN_SIZE,
+        )
+        print(f"[app] 相似病例索引：{len(_SIMILAR)} 条")
+    except Exception as e:
+        print(f"[app] 相似病例索引不可用：{e}")
+
+# =========================
+# 指标（GET /metrics，Prometheus 文本格式）
+# =========================
+def _model_bytes() -> Optional[float]:
+    if _MODEL is None:
+        return None
+    return float(sum(t.numel() * t.element_size() for t in list(_MODEL.parameters()) + list(_MODEL.buffers())))
+
+_MODEL_BYTES = _model_bytes()
+REGISTRY.gauge("chex_model_bytes", "Parameter and buffer bytes of the loaded model", fn=lambda: _MODEL_BYTES)
+REGISTRY.gauge("chex_infer_queue_depth", "Images waiting in the batching queue",
+               fn=lambda: _BATCHER.qsize() if _BATCHER is not None else 0)
+REGISTRY.gauge("chex_persist_pending", "Background writes not yet finished", fn=lambda: _WRITER.pending())
+REGISTRY.gauge("chex_persist_failed", "Background writes that raised", fn=lambda: _WRITER.failed)
+REGISTRY.gauge("chex_cache_hit_ratio", "Result cache hit ratio since start",
+               fn=lambda: _CACHE.stats()["hit_rate"] if _CACHE is not None else None)
+REGISTRY.gauge("chex_cache_entries", "Result cache in-memory entries",
+               fn=lambda: _CACHE.stats()["entries"] if _CACHE is not None else None)
+REGISTRY.gauge("chex_admission_queued", "Requests waiting for admission per lane", labelnames=("lane",),
+               fn=lambda: {(k,): v for k, v in _ADMISSION.stats()["queued"].items()} if _ADMISSION is not None else {})
+REGISTRY.gauge("chex_admission_inflight", "Admitted requests currently executing",
+               fn=lambda: _ADMISSION.stats()["inflight"] if _ADMISSION is not None else None)
+REGISTRY.gauge("chex_artifact_bytes", "Bytes of indexed upload / heatmap artifacts", fn=lambda: _STORE.stats()["bytes"])
+REGISTRY.gauge("chex_artifact_count", "Indexed upload / heatmap artifacts", fn=lambda: _STORE.stats()["count"])
+REGISTRY.gauge("chex_similar_vectors", "Embeddings in the similar-case index",
+               fn=lambda: len(_SIMILAR) if _SIMILAR is not None else None)
+REGISTRY.gauge("chex_feature_cache_bytes", "Deferred-heatmap feature cache bytes",
+               fn=lambda: _FEATURES.stats()["bytes"] if _FEATURES is not None else None)
+
 # =========================
 # 工具函数
 # =========================
-def _to_pil_from_upload(f: UploadFile) -> Image.Image:
-    name = (f.filename or "").lower()
-    data = f.file.read()
-    if name.endswith(".dcm"):
-        import pydicom
-        ds = pydicom.dcmread(io.BytesIO(data))
-        arr = ds.pixel_array.astype(np.float32)
-        arr = (255 * (arr - arr.min()) / (arr.max() - arr.min() + 1e-6)).astype(np.uint8)
-        if arr.ndim == 2:
-            return Image.fromarray(arr).convert("RGB")
-        else:
-            return Image.fromarray(arr[..., :3])
-    return Image.open(io.BytesIO(data)).convert("RGB")
-
-def _append_history(item: dict) -> None:
-    # item: {"date","file_name","diagnosis","confidence","status"}
-    with open(HISTORY_FILE, "a", encoding="utf-8") as f:
-        f.write(json.dumps(item, ensure_ascii=False) + "\n")
-
-def _read_history() -> List[dict]:
-    if not os.path.exists(HISTORY_FILE):
-        return []
-    out: List[dict] = []
-    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
+def _read_source(name: str, fp: BinaryIO, keep_original: bool = True, kind: Optional[str] = None) -> Union[bytes, np.ndarray]:
+    """
+    读取一个上传文件（或 zip 成员），返回交给 model_infer 的输入：
+    - jpg/png：原始字节，由 chex_preprocess 解码（灰度直读、JPEG 可缩放解码）
+    - dcm：chex_dicom 直接从文件对象流式读取，输出已窗宽窗位的 uint8 灰度数组；
+      结果要作为原图保存（keep_original）时长边降到 DICOM_MAX_SIDE —— 即使本次不要热力图：
+      原图会进结果缓存，之后同一图片的热力图请求直接复用它；只检索不保存时直接降到接近模型输入尺寸
+    - kind: 已按魔数识别的类型（chex_ingest.sniff）；给出时 DICOM 不再依赖扩展名
+    """
+    if kind == "dicom" or name.lower().endswith(".dcm"):
+        from chex_dicom import read_dicom  # noqa
+        return read_dicom(fp, max_side=DICOM_MAX_SIDE if keep_original else DICOM_MODEL_SIDE)
+    data = fp.read()
+    # 在请求线程里完整解码一遍，尽早拒绝非图片和截断 / 损坏的文件（400 而不是进模型后 500）；
+    # JPEG 用 draft 按 1/8 缩放解码，仍会读完整个数据流，开销很小
+    im = Image.open(io.BytesIO(data))
+    im.draft("L", (1, 1))
+    im.load()
+    return data
+
+# 原图按上传格式原样保存时使用的扩展名
+_ORIGINAL_EXTS = {"JPEG": "jpg", "PNG": "png", "BMP": "bmp", "TIFF": "tif", "WEBP": "webp", "GIF": "gif"}
+
+def _original_ext(src: Union[bytes, np.ndarray]) -> str:
+    if isinstance(src, bytes):
+        fmt = Image.open(io.BytesIO(src)).format or ""
+        return _ORIGINAL_EXTS.get(fmt, fmt.lower() or "bin")
+    return "png"  # DICOM 等已解码的数组编码为 PNG
+
+def _save_original(src: Union[bytes, np.ndarray], path: str):
+    """后台保存原图：上传字节原样写入；数组（DICOM 渲染）编码为 PNG。"""
+    if isinstance(src, bytes):
+        return _WRITER.write_bytes(path, src)
+    return _WRITER.write_image(path, Image.fromarray(src))
+
+def _register(fut, request_id: str, name: str, rel: str) -> None:
+    """后台写入成功后把产物登记到清单索引（写失败的不登记）。"""
+    def _done(f):
+        if f.exception() is not None:
+            return
+        try:
+            _STORE.add(request_id, name, rel)
+        except Exception as e:
+            print(f"[app] 产物登记失败 {rel}: {e}")
+    fut.add_done_callback(_done)
+
+def _store_original(src: Union[bytes, np.ndarray], day: str, uid: str, request_id: str) -> str:
+    rel = _STORE.place("uploads", uid, _original_ext(src), day)
+    _register(_save_original(src, _STORE.path(rel)), request_id, "original", rel)
+    return _STORE.url(rel)
+
+def _store_heatmap(img: Image.Image, day: str, uid: str, request_id: str, name: str = "heatmap") -> str:
+    rel = _STORE.place("heatmaps", uid, HEATMAP_EXT, day)
+    fut = _WRITER.write_heatmap(_STORE.path(rel), img, HEATMAP_FORMAT, HEATMAP_QUALITY, HEATMAP_MAX_SIDE)
+    _register(fut, request_id, name, rel)
+    return _STORE.url(rel)
+
+def _summarize(out: dict) -> Tuple[List[dict], str, float]:
+    """infer 结果 -> (前端 classifications, 历史记录用的诊断, 置信度)。"""
+    classifications = [
+        {"label": it["label"], "confidence": it["confidence"], "description": ""}
+        for it in out.get("positive_findings", [])
+    ]
+    # 若无阳性，也给出 Top-1 作为参考
+    best_label, best_prob = None, None
+    if out.get("probs"):
+        best_label, best_prob = max(out["probs"].items(), key=lambda kv: kv[1])
+    if not classifications and best_label is not None:
+        classifications = [{"label": best_label, "confidence": float(best_prob), "description": ""}]
+    diag_label = classifications[0]["label"] if classifications else (best_label or "-")
+    diag_conf = classifications[0]["confidence"] if classifications else float(best_prob or 0.0)
+    return classifications, diag_label, float(diag_conf)
+
+def _meta(infer_ms: int, threshold: float, **extra) -> dict:
+    meta = {
+        "model_name": "DenseNet121",
+        "inference_time_ms": infer_ms,
+        "threshold": float(threshold),
+        "device": "cuda:0" if torch.cuda.is_available() else "cpu",
+    }
+    meta.update(extra)
+    return meta
+
+def _artifact_path(url: str) -> str:
+    """/static/... URL -> 文件路径（在 STATIC_ROOT 下，不是 ROOT）。"""
+    return _STORE.path(_STORE.rel(url))
+
+def _artifact_ready(url: Optional[str]) -> bool:
+    """
+    按 URL 判断产物文件已落盘或仍在后台写入中（都视为可用）。
+    缓存条目里的 path 字段只作记录，这里总是从 URL 重新解析（旧条目里的 path 可能指错根目录）。
+    """
+    if not url:
+        return False
+    path = _artifact_path(url)
+    return os.path.exists(path) or _WRITER.is_pending(path)
+
+def _record_history(items: List[dict], embeddings: List[Optional[np.ndarray]]) -> None:
+    """写入历史记录；带嵌入的逐条写入以取得 id，再按 id 追加到相似病例索引。"""
+    if _SIMILAR is None or all(e is None for e in embeddings):
+        _HISTORY.extend(items)
+        return
+    keys, vectors = [], []
+    for item, emb in zip(items, embeddings):
+        hid = _HISTORY.append(item)
+        if emb is not None:
+            keys.append(hid)
+            vectors.append(emb)
+    _SIMILAR.add_many(keys, np.stack(vectors))
+
+def _append_history(item: dict, embedding: Optional[np.ndarray] = None) -> None:
+    # item: {"date","file_name","diagnosis","confidence","status","request_id"}
+    if embedding is None:
+        _WRITER.submit(_HISTORY.append, item, stage="history")
+    else:
+        _WRITER.submit(_record_history, [item], [embedding], stage="history")
+
+def _stages_ms(timings: Dict[str, float]) -> Dict[str, float]:
+    return {k: round(v, 2) for k, v in timings.items()}
+
+def _rejected(e: Rejected) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail={"error_code": e.error_code, "message": str(e)},
+                         headers={"Retry-After": str(e.retry_after)})
+
+def _lane_and_deadline(request: Request, fields: Dict[str, Optional[str]], default_lane: str, start: float) -> Tuple[str, float]:
+    """优先级通道与截止时间（time.monotonic() 时刻，自请求到达 start 起算）；请求头优先于表单字段。"""
+    try:
+        lane = parse_lane(request.headers.get("x-priority") or fields.get("priority"), default_lane)
+        raw = request.headers.get("x-request-timeout-ms") or fields.get("timeout_ms")
+        timeout_s = float(raw) / 1000.0 if raw not in (None, "") else LANE_TIMEOUTS[lane]
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail={"error_code": "BAD_PRIORITY", "message": str(e)})
+    return lane, start + timeout_s
+
+async def _run_admitted(lane: str, deadline: float, fn, cleanup=None):
+    """
+    经准入控制后在 _ANALYZE_POOL 中执行 fn；名额在 fn 真正结束时才交还（客户端断开也一样）。
+    cleanup（如关闭上传的临时文件）同样在 fn 结束后调用；未能提交执行时立即调用。
+    """
+    loop = asyncio.get_running_loop()
+    ticket = None
+    try:
+        if _ADMISSION is not None:
             try:
-                out.append(json.loads(line))
-            except Exception:
-                continue
-    # 最新的排前面
-    return list(reversed(out))
+                ticket = await _ADMISSION.acquire(lane, deadline)
+            except Rejected as e:
+                raise _rejected(e)
+        cf = _ANALYZE_POOL.submit(fn)
+    except BaseException:
+        if ticket is not None:
+            _ADMISSION.release(ticket)
+        if cleanup is not None:
+            cleanup()
+        raise
+
+    def _done(_f) -> None:
+        # 在工作线程中回调：取消 await 不会中断 fn，这里才是 fn 真正结束的时刻
+        if cleanup is not None:
+            cleanup()
+        if ticket is not None:
+            try:
+                loop.call_soon_threadsafe(_ADMISSION.release, ticket)
+            except RuntimeError:
+                pass   # 事件循环已关闭（进程退出中）
+
+    cf.add_done_callback(_done)
+    return await asyncio.shield(asyncio.wrap_future(cf))
+
+def _check_deadline(deadline: Optional[float]) -> None:
+    """进入模型前再检查一次：已过期的请求不再前向。"""
+    if expired(deadline):
+        raise HTTPException(status_code=503, detail={"error_code": "DEADLINE_EXCEEDED", "message": "Request deadline exceeded."},
+                            headers={"Retry-After": str(_ADMISSION.retry_after() if _ADMISSION is not None else 1)})
+
+def _infer_deadline(deadline: Optional[float]) -> dict:
+    # 微批调度器在发车时丢弃过期的图；直接调用 chex_model.infer 时不支持该参数
+    return {"deadline": deadline} if _BATCHER is not None else {}
+
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+def _client_request_id(raw: Optional[str]) -> Optional[str]:
+    """
+    客户端给出的关联 id（合法时保留，否则丢弃）。只原样回显并记入历史，不作任何键：
+    request_id 总是由服务端生成，它是特征缓存 / 产物清单 / 补算热力图的键，客户端可控会串到别人的请求上。
+    """
+    if raw and _REQUEST_ID_RE.match(raw):
+        return raw
+    return None
 
 # =========================
 # 健康检查
@@ -114,112 +485,649 @@ def healthz():
         "status": "ok" if ok else "not_ready",
         "model_loaded": ok,
         "model_name": "DenseNet121",
+        "infer_mode": INFER_MODE,
+        "backend": backend_name(),
+        "admission": _ADMISSION.stats() if _ADMISSION is not None else None,
+        "autotune": {k: v for k, v in _AUTOTUNED.items() if k != "trials"} if _AUTOTUNED is not None else None,
+        "similar": _SIMILAR.stats() if _SIMILAR is not None else None,
+        "pid": os.getpid(),
+        "torch_threads": torch.get_num_threads(),
         "device": "cuda:0" if torch.cuda.is_available() else "cpu"
     }, status_code=200 if ok else 503)
 
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 # =========================
 # 历史记录查询
 # =========================
 @app.get("/api/v1/history")
-def get_history(page: int = 1, page_size: int = 10):
-    data = _read_history()
-    total = len(data)
-    start = max(0, (page - 1) * page_size)
-    end = start + page_size
+def get_history(
+    page: int = 1,
+    page_size: int = 10,
+    before_id: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    diagnosis: Optional[str] = None,
+    min_confidence: Optional[float] = None,
+    max_confidence: Optional[float] = None,
+):
+    # 最新的排前面；before_id 为游标（上一页 next_cursor），深翻页时用它代替 page
+    filters = dict(date_from=date_from, date_to=date_to, diagnosis=diagnosis,
+                   min_confidence=min_confidence, max_confidence=max_confidence)
+    items = _HISTORY.page(page=page, page_size=page_size, before_id=before_id, **filters)
     return {
         "success": True,
-        "total": total,
+        "total": _HISTORY.count(**filters),
         "page": page,
         "page_size": page_size,
-        "items": data[start:end],
+        "items": items,
+        "next_cursor": items[-1]["id"] if items and len(items) == page_size else None,
     }
 
+@app.get("/api/v1/history/stats")
+def get_history_stats(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    diagnosis: Optional[str] = None,
+    status: Optional[str] = None,
+):
+    # 按天 / 诊断的计数、平均置信度与置信度直方图；读增量维护的聚合表，代价与历史总量无关
+    return dict(_HISTORY.stats(date_from=date_from, date_to=date_to, diagnosis=diagnosis, status=status), success=True)
+
 # =========================
 # 推理接口（与前端契约一致）
 # =========================
+_FORM_TRUE, _FORM_FALSE = {"1", "true", "on", "yes"}, {"0", "false", "off", "no"}
+
+def _form_value(fields: Dict[str, str], name: str, cast, default):
+    """按 FastAPI Form 的规则解析流式接收到的表单字段；空值取默认值。"""
+    raw = fields.get(name)
+    if raw is None or raw.strip() == "":
+        return default
+    try:
+        if cast is bool:
+            v = raw.strip().lower()
+            if v not in _FORM_TRUE | _FORM_FALSE:
+                raise ValueError(raw)
+            return v in _FORM_TRUE
+        return cast(raw)
+    except ValueError:
+        raise HTTPException(status_code=422, detail={"error_code": "BAD_FORM_FIELD", "message": f"Invalid {name}: {raw!r}"})
+
 @app.post("/api/v1/image/analyze")
-def analyze(
-    request: Request,
-    file: UploadFile = File(...),
-    generate_heatmap: bool = Form(True),
-    threshold: float = Form(0.5),
-    alpha: float = Form(0.45),
-    return_top_k: Optional[int] = Form(None),
-):
+async def analyze(request: Request):
+    """
+    multipart/form-data：file（必填）与以下可选表单字段
+    - generate_heatmap=true / threshold=0.5 / alpha=0.45 / return_top_k
+    - return_timings=true 时在 meta.stages 中返回本次请求的分阶段耗时（毫秒）
+    - heatmap_mode: image = 服务端渲染叠加图（heatmap_image_url）；
+      grid = 只返回低分辨率 CAM 网格与伪彩查找表（heatmap_grid），由前端叠加，不生成热力图文件
+    - triage（缺省 CHEX_TRIAGE）/ heatmap_threshold（缺省 CHEX_TRIAGE_HEATMAP_THRESHOLD）：分诊模式，
+      分诊分数低于 heatmap_threshold 的图不生成热力图，返回 heatmap_deferred=true 与 request_id，
+      之后可调用 POST /api/v1/image/heatmap/{request_id} 补算
+    - client_request_id: 可选，客户端关联 id，原样回显并记入历史（旧字段名 request_id 同义）；
+      补算热力图 / 查产物用的 request_id 总是由服务端生成
+    - priority（或请求头 X-Priority）: stat / routine（缺省）/ bulk；timeout_ms（或 X-Request-Timeout-Ms）: 截止时间
+      准入控制（chex_admission）：队列满时 429、被更高优先级挤掉或超过截止时间时 503，均带 Retry-After
+    上传在事件循环中流式接收（大小上限、增量哈希、魔数识别，见 chex_ingest），
+    其余 CPU 密集的读取 / 推理 / 组装在专用线程池中执行。
+    """
     if _MODEL is None:
         raise HTTPException(status_code=424, detail={"error_code": "MODEL_NOT_READY", "message": "Model not loaded"})
-
-    # 1) 读入图片
+    start = time.monotonic()
+    t0 = time.perf_counter()
     try:
-        pil = _to_pil_from_upload(file)
-    except Exception:
-        raise HTTPException(status_code=400, detail={"error_code": "BAD_FILE_TYPE", "message": "Only jpg/png/dcm supported."})
-
-    # 2) 推理
+        upload = await receive_upload(request, "file", MAX_UPLOAD_BYTES, UPLOAD_SPOOL_BYTES)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail={"error_code": e.error_code, "message": str(e)})
+    stages: Dict[str, float] = {"upload": (time.perf_counter() - t0) * 1000.0}
+    observe_stage("upload", stages["upload"] / 1000.0)
     try:
-        t0 = time.time()
-        out = model_infer(
-            pil,
-            generate_heatmap=generate_heatmap,
-            threshold=float(threshold),
-            alpha=float(alpha),
-            return_top_k=return_top_k
+        f = upload.fields
+        opts = dict(
+            generate_heatmap=_form_value(f, "generate_heatmap", bool, True),
+            threshold=_form_value(f, "threshold", float, 0.5),
+            alpha=_form_value(f, "alpha", float, 0.45),
+            return_top_k=_form_value(f, "return_top_k", int, None),
+            return_timings=_form_value(f, "return_timings", bool, False),
+            heatmap_mode=_form_value(f, "heatmap_mode", str, "image"),
+            triage=_form_value(f, "triage", bool, TRIAGE),
+            heatmap_threshold=_form_value(f, "heatmap_threshold", float, TRIAGE_HEATMAP_THRESHOLD),
+            client_request_id=_form_value(f, "client_request_id", str, None) or _form_value(f, "request_id", str, None),
         )
-        infer_ms = int((time.time() - t0) * 1000)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail={"error_code": "INFERENCE_ERROR", "message": str(e)})
+        lane, deadline = _lane_and_deadline(request, f, "routine", start)
+    except BaseException:
+        upload.close()
+        raise
+    # 上传由 _run_admitted 在 _analyze 结束后关闭（客户端断开时工作线程可能仍在读）
+    return await _run_admitted(lane, deadline, functools.partial(_analyze, upload, stages, deadline=deadline, **opts),
+                               cleanup=upload.close)
 
-    # 3) 保存原图与热力图（当天目录）
-    day = datetime.date.today().isoformat()
-    up_dir = os.path.join(UPLOAD_DIR, day)
-    hm_dir = os.path.join(HEATMAP_DIR, day)
-    os.makedirs(up_dir, exist_ok=True)
-    os.makedirs(hm_dir, exist_ok=True)
+def _analyze(
+    upload: Upload,
+    stages: Dict[str, float],
+    generate_heatmap: bool = True,
+    threshold: float = 0.5,
+    alpha: float = 0.45,
+    return_top_k: Optional[int] = None,
+    return_timings: bool = False,
+    heatmap_mode: str = "image",
+    triage: bool = False,
+    heatmap_threshold: float = 0.5,
+    client_request_id: Optional[str] = None,
+    deadline: Optional[float] = None,
+) -> dict:
+    heatmap_mode = (heatmap_mode or "image").lower()
+    if heatmap_mode not in HEATMAP_MODES:
+        raise HTTPException(status_code=400, detail={"error_code": "BAD_HEATMAP_MODE", "message": "heatmap_mode must be image/grid"})
+    grid = generate_heatmap and heatmap_mode == "grid"
+    triage = triage and generate_heatmap
+    min_prob = float(heatmap_threshold) if triage else 0.0
 
+    # 1) 内容哈希查缓存：命中时阈值 / top_k 由缓存概率重新计算，不跑模型（哈希已在接收时增量算好）
+    cache_key, cached, cache_status = None, None, "off"
+    heatmap_url, original_url = None, None
+    if _CACHE is not None:
+        cache_key = _CACHE.key(upload.sha256, model_version())
+        cached = _CACHE.get(cache_key)
+        cache_status = "miss" if cached is None else "hit"
+    if cached is not None and not grid:
+        hm = cached["heatmaps"].get(heatmap_variant(alpha, heatmap_classes(cached["probs"], float(threshold)), HEATMAP_FORMAT))
+        if hm is not None and _artifact_ready(hm["url"]):
+            heatmap_url = hm["url"]
+        if _artifact_ready(cached.get("original_url")):
+            original_url = cached["original_url"]
+
+    # 概率命中但这组叠加类别还没有热力图时才需要重跑模型；仅缺原图时只需重新读取上传
+    # CAM 网格不进缓存（只有几十字节，但需要特征图），grid 模式总是重跑
+    # 分诊模式下缓存概率已判为阴性的，热力图照样暂缓，也不重跑（补算时特征图缺失则从原图重新推理）
+    if cached is not None and grid and _artifact_ready(cached.get("original_url")):
+        original_url = cached["original_url"]
+    cached_deferred = (cached is not None and triage and heatmap_url is None
+                       and float(triage_scores(cached["probs"])) < min_prob)
+    # 开启相似检索时嵌入也要从缓存取得；旧条目没有嵌入的重跑一次模型补上，否则这条历史不会进索引
+    cached_embedding = unpack_embedding(cached.get("embedding")) if cached is not None and _SIMILAR is not None else None
+    need_model = (cached is None or (generate_heatmap and heatmap_url is None and not cached_deferred)
+                  or (_SIMILAR is not None and cached_embedding is None))
+    need_upload = need_model or original_url is None
+    if cached is not None and need_upload:
+        cache_status = "partial"
+
+    # 2) 读入图片
+    src = None
+    if need_upload:
+        try:
+            with timed("read", stages):
+                src = _read_source(upload.filename, upload.file, True, upload.kind)
+        except Exception:
+            raise HTTPException(status_code=400, detail={"error_code": "BAD_FILE_TYPE", "message": "Only jpg/png/dcm supported."})
+
+    # 3) 推理
+    t0 = time.time()
+    if need_model:
+        _check_deadline(deadline)
+        try:
+            out = model_infer(
+                src,
+                # 缓存里已有可用热力图、只为补嵌入而重跑时不再生成热力图
+                generate_heatmap=generate_heatmap and (cached is None or heatmap_url is None),
+                threshold=float(threshold),
+                alpha=float(alpha),
+                return_top_k=return_top_k,
+                heatmap_mode=heatmap_mode,
+                heatmap_max_side=HEATMAP_MAX_SIDE,
+                heatmap_min_prob=min_prob,
+                return_features=triage and _FEATURES is not None,
+                return_embedding=_SIMILAR is not None,
+                **_infer_deadline(deadline),
+            )
+        except Rejected as e:
+            raise _rejected(e)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail={"error_code": "INFERENCE_ERROR", "message": str(e)})
+        stages.update(out.pop("timings", None) or {})
+    else:
+        out = classify(np.asarray(cached["probs"], dtype=np.float32), float(threshold), return_top_k)
+        out["heatmap"] = None
+        out["heatmap_deferred"] = cached_deferred
+        if cached_embedding is not None:
+            out["embedding"] = cached_embedding
+    infer_ms = int((time.time() - t0) * 1000)
+
+    # 保存原图与热力图（当天目录，后台写入），已缓存的直接复用
+    day = datetime.date.today().isoformat()
+    rid = uuid.uuid4().hex
+    client_request_id = _client_request_id(client_request_id)
     uid = uuid.uuid4().hex[:8]
-    orig_path = os.path.join(up_dir, f"{uid}.png")
-    pil.save(orig_path)
+    if original_url is None:
+        original_url = _store_original(src, day, uid, rid)
 
-    heatmap_url = None
-    if generate_heatmap and out.get("heatmap") is not None:
-        hm_path = os.path.join(hm_dir, f"{uid}.png")
-        out["heatmap"].save(hm_path)
-        heatmap_url = f"/static/heatmaps/{day}/{uid}.png"
+    new_heatmap = generate_heatmap and heatmap_url is None and out.get("heatmap") is not None
+    if new_heatmap:
+        heatmap_url = _store_heatmap(out["heatmap"], day, uid, rid)
+    if not generate_heatmap or grid:
+        heatmap_url = None
+    heatmap_grid = cam_grid_payload(out["cam_grid"], float(alpha), out.get("image_size")) if out.get("cam_grid") is not None else None
 
-    original_url = f"/static/uploads/{day}/{uid}.png"
+    # 回写缓存（保留已有的其他热力图变体）
+    if cache_key is not None and need_upload:
+        entry = cached or {"probs": [out["probs"][c] for c in _CLASS_NAMES], "heatmaps": {}}
+        entry["original_url"] = original_url
+        entry["original_path"] = _artifact_path(original_url)
+        if need_model and out.get("embedding") is not None:
+            entry["embedding"] = pack_embedding(out["embedding"])
+        if new_heatmap:
+            variant = heatmap_variant(alpha, heatmap_classes(entry["probs"], float(threshold)), HEATMAP_FORMAT)
+            entry["heatmaps"][variant] = {"url": heatmap_url, "path": _artifact_path(heatmap_url)}
+        _CACHE.put(cache_key, entry)
+
+    # 分诊暂缓：记下补算热力图所需的一切（特征图可能缺失，此时补算退回到从原图重新推理）
+    deferred = bool(out.get("heatmap_deferred"))
+    features = out.pop("features", None)
+    if deferred and _FEATURES is not None:
+        _FEATURES.put(rid, {
+            "features": features,
+            "probs": [out["probs"][c] for c in _CLASS_NAMES],
+            "image_size": out.get("image_size"),
+            "original_path": _artifact_path(original_url),
+            "day": day, "uid": uid, "cache_key": cache_key,
+            "threshold": float(threshold), "alpha": float(alpha), "heatmap_mode": heatmap_mode,
+            "heatmaps": {},
+        }, 1024 + (features.numel() * features.element_size() if features is not None else 0))
 
     # 4) 组装返回（与前端契约一致）
-    classifications = [
-        {"label": it["label"], "confidence": it["confidence"], "description": ""}
-        for it in out.get("positive_findings", [])
-    ]
-    # 若无阳性，也给出 Top-1 作为参考
-    best_label, best_prob = None, None
-    if out.get("probs"):
-        best_label, best_prob = max(out["probs"].items(), key=lambda kv: kv[1])
-    if not classifications and best_label is not None:
-        classifications = [{"label": best_label, "confidence": float(best_prob), "description": ""}]
+    classifications, diag_label, diag_conf = _summarize(out)
 
-    # 5) 记录历史（文件名、诊断、置信度）
-    diag_label = classifications[0]["label"] if classifications else (best_label or "-")
-    diag_conf = classifications[0]["confidence"] if classifications else float(best_prob or 0.0)
+    # 5) 记录历史（文件名、诊断、置信度；request_id 用于查回原图 / 热力图），有嵌入时一并建索引
     _append_history({
         "date": day,
-        "file_name": file.filename or f"{uid}.png",
+        "file_name": upload.filename or original_url.rsplit("/", 1)[-1],
         "diagnosis": diag_label,
         "confidence": float(diag_conf),
-        "status": "completed"
-    })
+        "status": "completed",
+        "request_id": rid,
+        **({"client_request_id": client_request_id} if client_request_id else {}),
+    }, out.pop("embedding", None))
 
     return {
         "success": True,
         "classifications": classifications,
         "heatmap_image_url": heatmap_url,     # 相对路径；前端可用 API_BASE_URL 拼绝对
         "original_image_url": original_url,   # 如果前端不展示原图可忽略
-        "meta": {
-            "model_name": "DenseNet121",
-            "inference_time_ms": infer_ms,
-            "threshold": float(threshold),
-            "device": "cuda:0" if torch.cuda.is_available() else "cpu"
-        }
+        "heatmap_grid": heatmap_grid,          # 仅 heatmap_mode=grid：前端叠加用的 CAM 网格
+        "heatmap_deferred": deferred,          # 分诊暂缓：用 request_id 调 /api/v1/image/heatmap/{request_id}
+        "request_id": rid,
+        "client_request_id": client_request_id,
+        "meta": _meta(
+            infer_ms, threshold,
+            cache=dict(_CACHE.stats(), status=cache_status) if _CACHE is not None else {"status": cache_status},
+            **({"stages": _stages_ms(stages)} if return_timings else {}),
+            **({"triage": {"score": float(triage_scores([out["probs"][c] for c in _CLASS_NAMES])),
+                           "heatmap_threshold": min_prob}} if triage else {}),
+        )
+    }
+
+@app.post("/api/v1/image/heatmap/{request_id}")
+def deferred_heatmap(
+    request_id: str,
+    alpha: Optional[float] = Form(None),
+    threshold: Optional[float] = Form(None),
+    heatmap_mode: Optional[str] = Form(None),
+    return_timings: bool = Form(False),
+):
+    """
+    补算分诊时暂缓的热力图。alpha / threshold / heatmap_mode 缺省沿用 analyze 时的取值。
+    特征图仍在 LRU 中时只做 CAM 与叠加；特征图缺失（结果缓存命中时未前向）时从已保存的原图重新推理。
+    条目已被淘汰时返回 404（HEATMAP_EXPIRED），前端可关闭 triage 重新分析。
+    """
+    if _MODEL is None:
+        raise HTTPException(status_code=424, detail={"error_code": "MODEL_NOT_READY", "message": "Model not loaded"})
+    entry = _FEATURES.get(request_id) if _FEATURES is not None else None
+    if entry is None:
+        raise HTTPException(status_code=404, detail={"error_code": "HEATMAP_EXPIRED",
+                                                      "message": "No deferred heatmap for this request_id."})
+    alpha = float(entry["alpha"] if alpha is None else alpha)
+    threshold = float(entry["threshold"] if threshold is None else threshold)
+    heatmap_mode = (heatmap_mode or entry["heatmap_mode"]).lower()
+    if heatmap_mode not in HEATMAP_MODES:
+        raise HTTPException(status_code=400, detail={"error_code": "BAD_HEATMAP_MODE", "message": "heatmap_mode must be image/grid"})
+    grid = heatmap_mode == "grid"
+
+    variant = heatmap_variant(alpha, heatmap_classes(entry["probs"], threshold), HEATMAP_FORMAT)
+    url = entry["heatmaps"].get(variant)
+    if not grid and _artifact_ready(url):
+        return {"success": True, "request_id": request_id, "heatmap_image_url": url, "heatmap_grid": None,
+                "meta": _meta(0, threshold, source="stored")}
+
+    path = entry["original_path"]
+    if _WRITER.is_pending(path):
+        _WRITER.wait(path, 10.0)
+    if not os.path.exists(path):   # 原图已被保留策略清理
+        raise HTTPException(status_code=404, detail={"error_code": "HEATMAP_EXPIRED",
+                                                      "message": "Original image is no longer stored."})
+    t0 = time.time()
+    try:
+        if entry["features"] is not None:
+            source = "features"
+            out = infer_features(entry["features"], entry["probs"], None if grid else path, entry["image_size"],
+                                 threshold=threshold, alpha=alpha, heatmap_mode=heatmap_mode,
+                                 heatmap_max_side=HEATMAP_MAX_SIDE)
+        else:
+            source = "recompute"
+            out = model_infer(path, generate_heatmap=True, threshold=threshold, alpha=alpha,
+                              heatmap_mode=heatmap_mode, heatmap_max_side=HEATMAP_MAX_SIDE)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={"error_code": "INFERENCE_ERROR", "message": str(e)})
+    infer_ms = int((time.time() - t0) * 1000)
+    stages = out.pop("timings", None) or {}
+
+    heatmap_url, heatmap_grid = None, None
+    if grid:
+        heatmap_grid = cam_grid_payload(out["cam_grid"], alpha, out.get("image_size"))
+    elif out.get("heatmap") is not None:
+        # 同一请求可能以不同 alpha / 阈值补算多次，文件名带上序号
+        heatmap_url = _store_heatmap(out["heatmap"], entry["day"], f"{entry['uid']}-{len(entry['heatmaps'])}", request_id)
+        entry["heatmaps"][variant] = heatmap_url
+        if _CACHE is not None and entry["cache_key"] is not None:
+            cached = _CACHE.get(entry["cache_key"])
+            if cached is not None:
+                cached["heatmaps"][variant] = {"url": heatmap_url, "path": _artifact_path(heatmap_url)}
+                _CACHE.put(entry["cache_key"], cached)
+    return {
+        "success": True,
+        "request_id": request_id,
+        "heatmap_image_url": heatmap_url,
+        "heatmap_grid": heatmap_grid,
+        "meta": _meta(infer_ms, threshold, source=source,
+                      **({"stages": _stages_ms(stages)} if return_timings else {})),
+    }
+
+@app.get("/api/v1/artifacts/{request_id}")
+def get_artifacts(request_id: str):
+    """按 request_id 查该请求保存的原图 / 热力图（清单索引查找，不扫目录）。"""
+    items = _STORE.lookup(request_id)
+    if not items:
+        raise HTTPException(status_code=404, detail={"error_code": "NOT_FOUND", "message": "No artifacts for this request_id."})
+    return {
+        "success": True,
+        "request_id": request_id,
+        "artifacts": {name: {"url": it["url"], "bytes": it["bytes"], "created": it["created"]} for name, it in items.items()},
+    }
+
+# =========================
+# 相似病例检索
+# =========================
+def _similar_ready() -> None:
+    if _SIMILAR is None:
+        raise HTTPException(status_code=424, detail={"error_code": "SIMILAR_DISABLED",
+                                                      "message": "Similar-case index is not enabled (CHEX_SIMILAR=1)."})
+
+def _similar_k(k: int) -> int:
+    if not 1 <= k <= SIMILAR_MAX_K:
+        raise HTTPException(status_code=422, detail={"error_code": "BAD_K", "message": f"k must be 1..{SIMILAR_MAX_K}"})
+    return k
+
+def _similar_hits(query: np.ndarray, k: int, exclude: Tuple[int, ...] = ()) -> List[dict]:
+    """top-k 近邻 -> 历史记录 + 已保存的原图 / 热力图（历史已删除的近邻跳过）。"""
+    hits = _SIMILAR.search(query, k=k, exclude=exclude)[0]
+    items = _HISTORY.get(key for key, _ in hits)
+    out = []
+    for key, score in hits:
+        item = items.get(key)
+        if item is None:
+            continue
+        artifacts = _STORE.lookup(item["request_id"]) if item.get("request_id") else {}
+        out.append(dict(item, similarity=round(score, 4),
+                        original_image_url=(artifacts.get("original") or {}).get("url"),
+                        heatmap_image_url=(artifacts.get("heatmap") or {}).get("url")))
+    return out
+
+@app.get("/api/v1/image/similar")
+def similar_by_history(history_id: int, k: int = 5):
+    """与某条历史记录（已建索引的）最相似的 k 条历史记录（不含其自身）。"""
+    _similar_ready()
+    query = _SIMILAR.vector(history_id)
+    if query is None:
+        raise HTTPException(status_code=404, detail={"error_code": "NOT_INDEXED", "message": "No embedding for this history_id."})
+    return {"success": True, "history_id": history_id, "items": _similar_hits(query, _similar_k(k), (history_id,))}
+
+@app.post("/api/v1/image/similar")
+async def similar(request: Request):
+    """
+    multipart/form-data：file（必填），k（缺省 5）。前向一次取嵌入（不生成热力图、不写历史），
+    返回最相似的 k 条历史记录（含 similarity 与原图 / 热力图地址）。priority / timeout_ms 同 analyze。
+    """
+    if _MODEL is None:
+        raise HTTPException(status_code=424, detail={"error_code": "MODEL_NOT_READY", "message": "Model not loaded"})
+    _similar_ready()
+    start = time.monotonic()
+    try:
+        upload = await receive_upload(request, "file", MAX_UPLOAD_BYTES, UPLOAD_SPOOL_BYTES)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail={"error_code": e.error_code, "message": str(e)})
+    try:
+        k = _similar_k(_form_value(upload.fields, "k", int, 5))
+        lane, deadline = _lane_and_deadline(request, upload.fields, "routine", start)
+    except BaseException:
+        upload.close()
+        raise
+    return await _run_admitted(lane, deadline, functools.partial(_similar, upload, k, deadline), cleanup=upload.close)
+
+def _similar(upload: Upload, k: int, deadline: Optional[float]) -> dict:
+    stages: Dict[str, float] = {}
+    try:
+        with timed("read", stages):
+            src = _read_source(upload.filename, upload.file, False, upload.kind)
+    except Exception:
+        raise HTTPException(status_code=400, detail={"error_code": "BAD_FILE_TYPE", "message": "Only jpg/png/dcm supported."})
+    _check_deadline(deadline)
+    try:
+        out = model_infer(src, generate_heatmap=False, return_embedding=True, **_infer_deadline(deadline))
+    except Rejected as e:
+        raise _rejected(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={"error_code": "INFERENCE_ERROR", "message": str(e)})
+    stages.update(out.pop("timings", None) or {})
+    with timed("search", stages):
+        items = _similar_hits(out["embedding"], k)
+    return {"success": True, "items": items, "meta": {"stages": _stages_ms(stages), "index": len(_SIMILAR)}}
+
+# =========================
+# 批量推理接口（多视图 study / PACS 批量推送）
+# =========================
+BATCH_MAX_FILES = int(os.environ.get("CHEX_BATCH_MAX_FILES", "512"))
+# 一次批量请求所有上传文件合计的上限（流式接收，超出即 413）
+BATCH_MAX_UPLOAD_BYTES = int(float(os.environ.get("CHEX_BATCH_MAX_UPLOAD_MB", "1024")) * (1 << 20))
+
+def _iter_batch_sources(files: List[Upload]):
+    """展开上传列表：普通文件原样给出，.zip 展开为其中的成员（保留包内路径作为文件名）。"""
+    for f in files:
+        name = f.filename or ""
+        if f.kind == "zip" or name.lower().endswith(".zip"):
+            with zipfile.ZipFile(f.file) as zf:
+                for info in zf.infolist():
+                    if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                        continue
+                    with zf.open(info) as member:
+                        yield info.filename, member, None
+        else:
+            yield name, f.file, f.kind
+
+def _study_of(name: str) -> str:
+    # CheXpert 目录结构 patientXXXX/studyN/viewM_frontal.jpg：取父目录作为 study
+    parent = os.path.dirname(name.replace("\\", "/"))
+    return parent or "default"
+
+@app.post("/api/v1/image/analyze_batch")
+async def analyze_batch(request: Request):
+    """
+    多文件（multipart 或 zip）批量分析：按 BATCH_MAX_SIZE 组成真实的张量 batch 前向，
+    逐图返回与 analyze 相同结构的结果，历史记录一次性批量写入。
+    multipart/form-data：files（必填，可多个）与以下可选表单字段
+    - generate_heatmap=true / threshold=0.5 / alpha=0.45 / return_top_k
+    - aggregate: none / max / mean，按 study 聚合各视图概率
+    - study_ids: 可选，逗号分隔，与展开后的文件一一对应；缺省按文件所在目录分组
+    - return_timings: 逐图 meta.stages 返回分阶段耗时（毫秒）
+    - priority / timeout_ms: 同 analyze，缺省走 bulk 通道
+    上传同 analyze 由 chex_ingest 流式接收（合计上限 CHEX_BATCH_MAX_UPLOAD_MB），类型不对的文件逐个标记失败。
+    """
+    if _MODEL is None:
+        raise HTTPException(status_code=424, detail={"error_code": "MODEL_NOT_READY", "message": "Model not loaded"})
+    start = time.monotonic()
+    try:
+        uploads = await receive_uploads(request, "files", BATCH_MAX_UPLOAD_BYTES, UPLOAD_SPOOL_BYTES,
+                                        kinds=None, max_files=BATCH_MAX_FILES)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail={"error_code": e.error_code, "message": str(e)})
+
+    def _close() -> None:
+        for up in uploads:
+            up.close()
+
+    try:
+        f = uploads[0].fields
+        opts = dict(
+            generate_heatmap=_form_value(f, "generate_heatmap", bool, True),
+            threshold=_form_value(f, "threshold", float, 0.5),
+            alpha=_form_value(f, "alpha", float, 0.45),
+            return_top_k=_form_value(f, "return_top_k", int, None),
+            aggregate=_form_value(f, "aggregate", str, "none"),
+            study_ids=_form_value(f, "study_ids", str, None),
+            return_timings=_form_value(f, "return_timings", bool, False),
+        )
+        lane, deadline = _lane_and_deadline(request, f, "bulk", start)
+    except BaseException:
+        _close()
+        raise
+    # 上传文件归本请求所有，由 _run_admitted 在 _analyze_batch 真正结束后关闭（客户端断开时工作线程可能仍在读）
+    return await _run_admitted(lane, deadline, functools.partial(_analyze_batch, uploads, deadline=deadline, **opts),
+                               cleanup=_close)
+
+def _analyze_batch(
+    files: List[Upload],
+    generate_heatmap: bool = True,
+    threshold: float = 0.5,
+    alpha: float = 0.45,
+    return_top_k: Optional[int] = None,
+    aggregate: str = "none",
+    study_ids: Optional[str] = None,
+    return_timings: bool = False,
+    deadline: Optional[float] = None,
+) -> dict:
+    aggregate = (aggregate or "none").lower()
+    if aggregate not in ("none", "max", "mean"):
+        raise HTTPException(status_code=400, detail={"error_code": "BAD_AGGREGATE", "message": "aggregate must be none/max/mean"})
+
+    # 1) 读入所有图片（坏文件单独标记，不影响其他文件）
+    names: List[str] = []
+    srcs: List[Optional[Union[bytes, np.ndarray]]] = []
+    read_ms: List[Dict[str, float]] = []
+    try:
+        for name, fp, kind in _iter_batch_sources(files):
+            if len(names) >= BATCH_MAX_FILES:
+                raise HTTPException(status_code=413, detail={"error_code": "TOO_MANY_FILES",
+                                                              "message": f"At most {BATCH_MAX_FILES} images per batch."})
+            names.append(name)
+            read_ms.append({})
+            try:
+                with timed("read", read_ms[-1]):
+                    srcs.append(_read_source(name, fp, kind=kind))
+            except Exception:
+                srcs.append(None)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail={"error_code": "BAD_FILE_TYPE", "message": "Invalid zip archive."})
+    if not names:
+        raise HTTPException(status_code=400, detail={"error_code": "NO_FILES", "message": "No images found."})
+
+    studies = [s.strip() for s in study_ids.split(",")] if study_ids else [_study_of(n) for n in names]
+    if len(studies) != len(names):
+        raise HTTPException(status_code=400, detail={"error_code": "BAD_STUDY_IDS",
+                                                      "message": "study_ids must match the number of images."})
+
+    # 2) 分块批量推理
+    ok = [i for i, src in enumerate(srcs) if src is not None]
+    outs: Dict[int, dict] = {}
+    t0 = time.time()
+    try:
+        for k in range(0, len(ok), max(1, BATCH_MAX_SIZE)):
+            chunk = ok[k:k + max(1, BATCH_MAX_SIZE)]
+            _check_deadline(deadline)
+            results = infer_batch(
+                [srcs[i] for i in chunk],
+                generate_heatmap=generate_heatmap,
+                threshold=float(threshold),
+                alpha=float(alpha),
+                return_top_k=return_top_k,
+                heatmap_max_side=HEATMAP_MAX_SIDE,
+                return_embedding=_SIMILAR is not None,
+                return_errors=True,
+            )
+            # 通过了文件头检查却解码失败的图：只给该文件记错误，不影响同批其他文件
+            outs.update((i, res) for i, res in zip(chunk, results) if not isinstance(res, BaseException))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={"error_code": "INFERENCE_ERROR", "message": str(e)})
+    infer_ms = int((time.time() - t0) * 1000)
+    per_image_ms = int(infer_ms / max(1, len(ok)))
+
+    # 3) 落盘 + 组装逐图结果
+    day = datetime.date.today().isoformat()
+    results_json: List[dict] = []
+    history: List[dict] = []
+    embeddings: List[Optional[np.ndarray]] = []
+    for i, name in enumerate(names):
+        if i not in outs:
+            results_json.append({"success": False, "file_name": name,
+                                 "error": {"error_code": "BAD_FILE_TYPE", "message": "Only jpg/png/dcm supported."}})
+            continue
+        out = outs[i]
+        rid = uuid.uuid4().hex
+        uid = rid[:8]
+        original_url = _store_original(srcs[i], day, uid, rid)
+        heatmap_url = _store_heatmap(out["heatmap"], day, uid, rid) if generate_heatmap and out.get("heatmap") is not None else None
+        classifications, diag_label, diag_conf = _summarize(out)
+        stages = dict(read_ms[i], **(out.pop("timings", None) or {}))
+        history.append({"date": day, "file_name": name or original_url.rsplit("/", 1)[-1],
+                        "diagnosis": diag_label, "confidence": diag_conf, "status": "completed", "request_id": rid})
+        embeddings.append(out.pop("embedding", None))
+        results_json.append({
+            "success": True,
+            "file_name": name,
+            "study_id": studies[i],
+            "request_id": rid,
+            "classifications": classifications,
+            "heatmap_image_url": heatmap_url,
+            "original_image_url": original_url,
+            "meta": _meta(per_image_ms, threshold, **({"stages": _stages_ms(stages)} if return_timings else {})),
+        })
+    _WRITER.submit(_record_history, history, embeddings, stage="history")
+
+    # 4) 按 study 聚合
+    study_json: List[dict] = []
+    if aggregate != "none":
+        groups: Dict[str, List[int]] = {}
+        for i in outs:
+            groups.setdefault(studies[i], []).append(i)
+        for sid, idx in groups.items():
+            mat = np.array([[outs[i]["probs"][c] for c in _CLASS_NAMES] for i in idx], dtype=np.float32)
+            agg = mat.max(axis=0) if aggregate == "max" else mat.mean(axis=0)
+            classifications, _, _ = _summarize(classify(agg, float(threshold), return_top_k))
+            study_json.append({
+                "study_id": sid,
+                "files": [names[i] for i in idx],
+                "aggregate": aggregate,
+                "probs": {c: float(p) for c, p in zip(_CLASS_NAMES, agg)},
+                "classifications": classifications,
+            })
+
+    return {
+        "success": True,
+        "count": len(names),
+        "succeeded": len(outs),
+        "results": results_json,
+        "studies": study_json,
+        "meta": _meta(infer_ms, threshold, batch_size=BATCH_MAX_SIZE),
     }
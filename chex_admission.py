@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+chex_admission.py — 推理前的准入控制：有界队列、优先级通道、截止时间与快速拒绝
+
+流量突增时，analyze 请求原本全部进入线程池，CPU 密集的前向互相拖慢，所有请求的延迟一起失控，
+急诊（STAT）检查排在常规检查后面。AdmissionController 放在推理之前（事件循环中）：
+- 同时执行的请求数不超过 max_inflight，其余在有界队列（max_queue）中等待；
+- 优先级通道（LANES，越靠前越优先）：空出执行名额时总是先放行最高优先级、其次最早到达的请求；
+- 队列满时，新请求若比队列中最低优先级的请求更优先，则挤掉后者（503 + Retry-After），否则自己
+  立即被拒（429 + Retry-After）；Retry-After 按当前排队量与平均服务时间估算；
+- 每个请求带截止时间（缺省按通道），排队中过期的直接丢弃（503），不会再进入模型；
+  放行后调用方在真正前向之前还可用 expired(deadline) 再检查一次（例如微批队列里，见 chex_batching）。
+只在单个事件循环中使用（每个 uvicorn worker 一个实例），不需要锁。
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Dict, List, Optional
+
+from chex_metrics import REGISTRY, observe_stage
+
+# 优先级通道：越靠前越优先
+LANES = ("stat", "routine", "bulk")
+DEFAULT_TIMEOUTS_S = {"stat": 10.0, "routine": 30.0, "bulk": 120.0}
+
+ADMISSIONS = REGISTRY.counter("chex_admission_total", "Admission decisions", labelnames=("lane", "outcome"))
+
+
+class Rejected(Exception):
+    """请求未被执行；status_code / error_code / retry_after 直接用于 HTTP 错误响应。"""
+
+    status_code = 503
+    error_code = "OVERLOADED"
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = int(retry_after)
+
+
+class QueueFull(Rejected):
+    status_code = 429
+    error_code = "QUEUE_FULL"
+
+
+class Shed(Rejected):
+    """排队中被更高优先级的请求挤掉。"""
+
+    status_code = 503
+    error_code = "SHED"
+
+
+class DeadlineExceeded(Rejected):
+    status_code = 503
+    error_code = "DEADLINE_EXCEEDED"
+
+
+def parse_lane(value: Optional[str], default: str = "routine") -> str:
+    """通道名（大小写不敏感；也接受 0/1/2 这样的序号，0 最高）。"""
+    if value is None or str(value).strip() == "":
+        return default
+    v = str(value).strip().lower()
+    if v.isdigit() and int(v) < len(LANES):
+        return LANES[int(v)]
+    if v in LANES:
+        return v
+    raise ValueError(f"未知优先级 {value!r}（可选 {', '.join(LANES)}）")
+
+
+def parse_timeouts(spec: str) -> Dict[str, float]:
+    """'stat=10,routine=30,bulk=120' -> {lane: 秒}；未给出的通道用缺省值。"""
+    out = dict(DEFAULT_TIMEOUTS_S)
+    for part in (spec or "").split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[parse_lane(k)] = float(v)
+    return out
+
+
+def expired(deadline: Optional[float]) -> bool:
+    """deadline 为 time.monotonic() 时刻。"""
+    return deadline is not None and time.monotonic() >= deadline
+
+
+class Ticket:
+    """放行凭证；执行完成后交还 release()。"""
+
+    __slots__ = ("lane", "deadline", "enqueued", "admitted")
+
+    def __init__(self, lane: str, deadline: float):
+        self.lane = lane
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.admitted: Optional[float] = None
+
+
+class _Waiter:
+    __slots__ = ("rank", "seq", "ticket", "fut", "gone")
+
+    def __init__(self, rank: int, seq: int, ticket: Ticket, fut: "asyncio.Future"):
+        self.rank, self.seq, self.ticket, self.fut = rank, seq, ticket, fut
+        self.gone = False   # 已离开队列（超时 / 被挤掉 / 调用方断开），堆中惰性删除
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.rank, self.seq) < (other.rank, other.seq)
+
+
+class AdmissionController:
+    """
+    - max_inflight: 同时执行的请求数（通常等于推理线程池大小）
+    - max_queue: 等待执行的请求上限（所有通道合计）
+    - timeouts: 各通道缺省截止时间（秒，自请求到达起算）
+    """
+
+    def __init__(self, max_inflight: int = 8, max_queue: int = 64, timeouts: Optional[Dict[str, float]] = None):
+        if max_inflight < 1:
+            raise ValueError("max_inflight 必须 >= 1")
+        self.max_inflight = int(max_inflight)
+        self.max_queue = max(0, int(max_queue))
+        self.timeouts = dict(DEFAULT_TIMEOUTS_S, **(timeouts or {}))
+        self._heap: List[_Waiter] = []
+        self._queued: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._inflight = 0
+        self._seq = itertools.count()
+        self._service_s = 0.5   # 服务时间的指数滑动平均，用于估算 Retry-After
+
+    # ---------------------------
+    # 查询
+    # ---------------------------
+    def deadline(self, lane: str, timeout_s: Optional[float] = None, start: Optional[float] = None) -> float:
+        """截止时刻（time.monotonic()）；timeout_s 缺省取通道配置。"""
+        t = self.timeouts[lane] if timeout_s is None else float(timeout_s)
+        return (time.monotonic() if start is None else start) + t
+
+    def queued(self) -> int:
+        return sum(self._queued.values())
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "inflight": self._inflight,
+            "max_inflight": self.max_inflight,
+            "max_queue": self.max_queue,
+            "queued": dict(self._queued),
+            "service_ms": round(self._service_s * 1000.0, 1),
+        }
+
+    def retry_after(self) -> int:
+        """按排队量估算多久后再试（秒，至少 1）。"""
+        backlog = self.queued() + self._inflight
+        return max(1, int(math.ceil(backlog / float(self.max_inflight) * self._service_s)))
+
+    # ---------------------------
+    # 准入
+    # ---------------------------
+    async def acquire(self, lane: str, deadline: float) -> Ticket:
+        """等待执行名额；被拒时抛 Rejected 的子类。"""
+        ticket = Ticket(lane, deadline)
+        if expired(deadline):
+            self._count(lane, "expired")
+            raise DeadlineExceeded("请求在排队前已超过截止时间", self.retry_after())
+        if self._inflight < self.max_inflight and not self.queued():
+            return self._grant(ticket)
+
+        rank = LANES.index(lane)
+        if self.queued() >= self.max_queue:
+            victim = self._lowest()
+            if victim is None or victim.rank <= rank:
+                self._count(lane, "rejected")
+                raise QueueFull("队列已满", self.retry_after())
+            self._leave(victim)
+            victim.fut.set_exception(Shed("被更高优先级的请求挤出队列", self.retry_after()))
+            self._count(victim.ticket.lane, "shed")
+
+        waiter = _Waiter(rank, next(self._seq), ticket, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, waiter)
+        self._queued[lane] += 1
+        try:
+            await asyncio.wait({waiter.fut}, timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.CancelledError:
+            # 调用方断开：已放行的交还名额，仍在排队的离开队列
+            if waiter.fut.done():
+                if not waiter.fut.cancelled() and waiter.fut.exception() is None:
+                    self.release(ticket)
+            else:
+                self._leave(waiter)
+                waiter.fut.cancel()
+            raise
+        if not waiter.fut.done():
+            self._leave(waiter)
+            waiter.fut.cancel()
+        if waiter.fut.cancelled():
+            self._count(lane, "expired")
+            raise DeadlineExceeded("排队超过截止时间", self.retry_after())
+        waiter.fut.result()   # Shed 时抛出
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        """执行结束（无论成败）后交还名额并放行下一个请求。"""
+        if ticket.admitted is not None:
+            dt = time.monotonic() - ticket.admitted
+            self._service_s = 0.8 * self._service_s + 0.2 * dt
+        self._inflight -= 1
+        self._dispatch()
+
+    # ---------------------------
+    # 内部
+    # ---------------------------
+    def _grant(self, ticket: Ticket) -> Ticket:
+        self._inflight += 1
+        ticket.admitted = time.monotonic()
+        observe_stage("admission", ticket.admitted - ticket.enqueued)
+        self._count(ticket.lane, "admitted")
+        return ticket
+
+    def _dispatch(self) -> None:
+        while self._inflight < self.max_inflight and self._heap:
+            waiter = heapq.heappop(self._heap)
+            if waiter.gone:
+                continue
+            self._leave(waiter, popped=True)
+            if expired(waiter.ticket.deadline):
+                # 过期的请求在进入模型之前丢弃
+                self._count(waiter.ticket.lane, "expired")
+                waiter.fut.set_exception(DeadlineExceeded("排队超过截止时间", self.retry_after()))
+                continue
+            self._grant(waiter.ticket)
+            waiter.fut.set_result(None)
+
+    def _leave(self, waiter: _Waiter, popped: bool = False) -> None:
+        if not waiter.gone:
+            waiter.gone = True
+            self._queued[waiter.ticket.lane] -= 1
+        if not popped and len(self._heap) > 4 * max(1, self.queued()) + 64:
+            # 惰性删除积累过多时重建堆
+            self._heap = [w for w in self._heap if not w.gone]
+            heapq.heapify(self._heap)
+
+    def _lowest(self) -> Optional[_Waiter]:
+        """队列中最低优先级、最晚到达的请求（被挤掉的候选）。"""
+        live = [w for w in self._heap if not w.gone]
+        return max(live, key=lambda w: (w.rank, w.seq)) if live else None
+
+    @staticmethod
+    def _count(lane: str, outcome: str) -> None:
+        ADMISSIONS.inc(1, lane, outcome)
+
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+chex_artifact.py — 已初始化模型的缓存产物（加速冷启动）
+
+init_model 首次加载时要 torch.load 训练权重、随机初始化一个 densenet121 再拷贝 state_dict、
+（可选）折叠 BN 并做一致性自检；这些结果与权重内容一一对应，因此按权重哈希缓存为一个产物文件：
+    <cache_dir>/densenet121-<sha256[:16]>[-fold].pt
+    {"state_dict": ..., "class_names": [...], "num_classes": K, "fold_bn": bool, "format": 1}
+
+再次启动时：
+- torch.load(mmap=True, weights_only=True) 直接映射文件，参数不读入堆内存（多进程共享页缓存）；
+- 模型骨架在 meta 设备上构建（跳过随机初始化），load_state_dict(assign=True) 直接采用映射的张量；
+- 旧版本 PyTorch 不支持上述参数时退回普通加载，结果相同。
+"""
+
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+FORMAT_VERSION = 1
+
+
+def artifact_path(cache_dir: str, weights_hash: str, fold_bn: bool = False) -> str:
+    return os.path.join(cache_dir, f"densenet121-{weights_hash}{'-fold' if fold_bn else ''}.pt")
+
+
+def save_model(path: str, model: nn.Module, class_names: List[str], fold_bn: bool = False) -> None:
+    """保存为可 mmap 的产物（先写临时文件再改名，并发启动的进程不会读到半个文件）。"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    state = {
+        "state_dict": {k: v.detach().cpu().contiguous() for k, v in model.state_dict().items()},
+        "class_names": list(class_names),
+        "num_classes": len(class_names),
+        "fold_bn": bool(fold_bn),
+        "format": FORMAT_VERSION,
+    }
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+
+def _torch_load(path: str) -> Dict[str, Any]:
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except TypeError:   # PyTorch < 2.1：无 mmap 参数
+        return torch.load(path, map_location="cpu")
+
+
+def _skeleton(build: Callable[[int], nn.Module], num_classes: int, fold_bn: bool, meta: bool = True) -> Tuple[nn.Module, bool]:
+    """构建与产物结构一致的空模型；返回 (模型, 是否在 meta 设备上)。"""
+    from chex_backends import fold_batchnorm
+
+    model = None
+    if meta:
+        try:
+            with torch.device("meta"):
+                model = build(num_classes)
+        except (AttributeError, TypeError, RuntimeError):   # PyTorch < 2.0：无 device 上下文
+            model = None
+    on_meta = model is not None
+    if model is None:
+        model = build(num_classes)
+    if fold_bn:
+        fold_batchnorm(model.eval())
+    return model, on_meta
+
+
+def load_model(path: str, build: Callable[[int], nn.Module]) -> Tuple[nn.Module, List[str], bool]:
+    """
+    读取产物：返回 (eval 模式的模型, class_names, fold_bn)。
+    - build: 按类别数构建模型骨架的函数（chex_model._build_densenet121）
+    """
+    state = _torch_load(path)
+    if state.get("format") != FORMAT_VERSION:
+        raise ValueError(f"不支持的产物格式: {path}")
+    num_classes, fold_bn = int(state["num_classes"]), bool(state["fold_bn"])
+    model, on_meta = _skeleton(build, num_classes, fold_bn)
+    try:
+        model.load_state_dict(state["state_dict"], assign=True)
+    except TypeError:   # PyTorch < 2.1：无 assign 参数，只能拷贝进普通 CPU 模型
+        if on_meta:
+            model, _ = _skeleton(build, num_classes, fold_bn, meta=False)
+        model.load_state_dict(state["state_dict"])
+    return model.eval(), list(state["class_names"]), fold_bn
+
+
+def load_or_none(path: Optional[str], build: Callable[[int], nn.Module]) -> Optional[Tuple[nn.Module, List[str], bool]]:
+    """产物不存在或损坏时返回 None（由调用方走正常加载并重新生成）。"""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return load_model(path, build)
+    except Exception as e:
+        print(f"[artifact] 产物不可用，重新生成：{path}（{e}）")
+        return None
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+chex_autotune.py — 按本机 CPU 自动选择推理配置（后端 / torch 线程数 / 推理线程数 / 微批大小）
+
+同一份服务在 8 核边缘盒子和 64 核服务器上的最优配置差别很大。autotune 用合成输入和已加载的 DenseNet121
+做一次短时扫描，选出 p95 延迟满足 SLO 的配置中吞吐最高的一个：
+- 负载：闭环客户端经 chex_batching.BatchingEngine 调用 chex_model.infer_batch（含预处理、CAM 与叠加，
+  与 analyze 相同的路径），客户端数 = 推理线程数 × 微批大小，保证每个 trial 都能凑满批；
+  每个 trial 开头的一小段时间只预热、不计入统计；
+- 扫描按坐标下降分三段，trial 数随核数对数增长：
+  1) 后端：eager / eager+BN 折叠 / eager+BN 折叠+NHWC / torchscript / onnx（各自构建失败或自检退回的跳过），
+     单推理线程、用满全部核；
+  2) 线程划分：torch 线程数 t 取 2 的幂（以及核数本身），推理线程数 = 核数 // t；
+  3) 微批大小：BATCH_SIZES。
+  每段保留满足 SLO 的最优者；都不满足时取 p95 最低的（结果中 met_slo=False）。
+- 结果写入 JSON 配置文件，以 “CPU 型号|可用核数|权重哈希” 为键；之后启动命中即直接复用，不再扫描。
+- load_or_tune 在配置文件旁的 .lock 上持文件锁：多个进程同时启动（uvicorn --workers）时只有一个扫描，
+  其余等锁后复用它刚保存的结果，不会在彼此的负载下各测一遍。chex_serve 在启动 worker 之前就调优一次。
+
+用法：
+    python chex_autotune.py --model final_global_model.pth --slo-ms 500
+    python chex_autotune.py --show
+app.py 中 CHEX_AUTOTUNE=1 时启动即按上述方式取得配置（只覆盖未显式设置的 CHEX_* 项），=force 时总是重新扫描。
+"""
+
+import argparse
+import datetime
+import json
+import os
+import contextlib
+import platform
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:   # Windows：不做跨进程互斥
+    fcntl = None
+
+# 后端候选：(backend, fold_bn, channels_last)
+CANDIDATES: Tuple[Tuple[str, bool, bool], ...] = (
+    ("eager", False, False),
+    ("eager", True, False),
+    ("eager", True, True),
+    ("torchscript", True, False),
+    ("onnx", True, False),
+)
+BATCH_SIZES = (1, 2, 4, 8, 16)
+FORMAT_VERSION = 1
+
+
+# ---------------------------
+# 配置文件
+# ---------------------------
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.lower().startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine() or "unknown"
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:   # 非 Linux
+        return os.cpu_count() or 1
+
+
+def config_key(weights_hash: str, cores: int) -> str:
+    return f"{cpu_model()}|{int(cores)}c|{weights_hash}"
+
+
+def _read(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if data.get("format") == FORMAT_VERSION else {}
+
+
+def load_config(path: str, key: str) -> Optional[Dict[str, Any]]:
+    return _read(path).get("configs", {}).get(key)
+
+
+def save_config(path: str, key: str, config: Dict[str, Any]) -> None:
+    """合并写入（同一文件可保存多种机器 / 权重的配置）；先写临时文件再改名。"""
+    data = _read(path) or {"format": FORMAT_VERSION, "configs": {}}
+    data["configs"][key] = config
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def env_overrides(config: Dict[str, Any]) -> Dict[str, str]:
+    """调优结果 -> app.py 读取的 CHEX_* 环境变量。"""
+    batch = int(config["batch_size"])
+    return {
+        "CHEX_BACKEND": config["backend"],
+        "CHEX_FOLD_BN": "1" if config["fold_bn"] else "0",
+        "CHEX_CHANNELS_LAST": "1" if config["channels_last"] else "0",
+        "CHEX_INFER_MODE": "batch" if batch > 1 else "single",
+        "CHEX_BATCH_MAX_SIZE": str(batch),
+        "CHEX_BATCH_MAX_WAIT_MS": str(config["max_wait_ms"]),
+        "CHEX_INFER_WORKERS": str(config["infer_workers"]),
+        "CHEX_INTRA_OP_THREADS": str(config["torch_threads"]),
+    }
+
+
+# ---------------------------
+# 单次测量
+# ---------------------------
+def synthetic_input(size: int = 1024, seed: int = 0) -> np.ndarray:
+    """单通道 uint8 噪声图，尺寸与常见胸片缩略后相当（预处理 / 叠加的开销与真实输入同量级）。"""
+    return np.random.default_rng(seed).integers(0, 256, size=(size, size), dtype=np.uint8)
+
+
+def run_trial(
+    workers: int,
+    threads: int,
+    batch_size: int,
+    image: np.ndarray,
+    seconds: float = 2.0,
+    max_wait_ms: float = 10.0,
+    generate_heatmap: bool = True,
+) -> Dict[str, Any]:
+    """闭环压测当前已加载的模型一次；返回 {throughput, p50_ms, p95_ms, n}。"""
+    from chex_batching import BatchingEngine
+
+    engine = BatchingEngine(batch_size, max_wait_ms if batch_size > 1 else 0.0,
+                            num_workers=workers, intra_op_threads=threads).start()
+    warm = min(0.5, seconds / 4.0)
+    t_start = time.perf_counter()
+    t_count, t_end = t_start + warm, t_start + warm + seconds
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def client() -> None:
+        while True:
+            t0 = time.perf_counter()
+            if t0 >= t_end:
+                return
+            engine.infer(image, generate_heatmap=generate_heatmap)
+            t1 = time.perf_counter()
+            if t0 >= t_count and t1 <= t_end:
+                with lock:
+                    latencies.append(t1 - t0)
+
+    clients = [threading.Thread(target=client, daemon=True) for _ in range(workers * batch_size)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    engine.stop()
+    lat = np.sort(np.asarray(latencies or [float("inf")])) * 1000.0
+    return {
+        "throughput": round(len(latencies) / seconds, 2),
+        "p50_ms": round(float(np.percentile(lat, 50)), 1),
+        "p95_ms": round(float(np.percentile(lat, 95)), 1),
+        "n": len(latencies),
+    }
+
+
+def _best(trials: List[Dict[str, Any]], slo_ms: float) -> Dict[str, Any]:
+    ok = [t for t in trials if t["p95_ms"] <= slo_ms]
+    return max(ok, key=lambda t: t["throughput"]) if ok else min(trials, key=lambda t: t["p95_ms"])
+
+
+def _thread_splits(cores: int) -> List[Tuple[int, int]]:
+    """(推理线程数, 每线程 torch 线程数)，t 取 2 的幂与核数本身。"""
+    ts, t = [], 1
+    while t < cores:
+        ts.append(t)
+        t *= 2
+    ts.append(cores)
+    return [(max(1, cores // t), t) for t in ts]
+
+
+# ---------------------------
+# 扫描
+# ---------------------------
+def tune(
+    model_path: str,
+    class_names: Optional[List[str]] = None,
+    cores: Optional[int] = None,
+    slo_ms: float = 500.0,
+    seconds: float = 2.0,
+    candidates: Sequence[Tuple[str, bool, bool]] = CANDIDATES,
+    batch_sizes: Sequence[int] = BATCH_SIZES,
+    max_wait_ms: float = 10.0,
+    generate_heatmap: bool = True,
+    cache_dir: Optional[str] = None,
+    use_imagenet_norm: bool = False,
+) -> Dict[str, Any]:
+    """
+    扫描并返回最优配置（含全部 trial 记录）。会多次调用 chex_model.init_model，
+    调用方随后应按返回的配置重新 init_model。
+    - cores: 可用的核数预算（多 worker 部署时为每个 worker 分到的核数）；默认本进程可用核数
+    """
+    import chex_model
+
+    cores = int(cores or available_cores())
+    image = synthetic_input()
+    trials: List[Dict[str, Any]] = []
+
+    def measure(stage: str, backend: Tuple[str, bool, bool], workers: int, threads: int, batch: int) -> Dict[str, Any]:
+        trial = {
+            "stage": stage, "backend": backend[0], "fold_bn": backend[1], "channels_last": backend[2],
+            "infer_workers": workers, "torch_threads": threads, "batch_size": batch,
+        }
+        trial.update(run_trial(workers, threads, batch, image, seconds, max_wait_ms, generate_heatmap))
+        print(f"[autotune] {stage:<8} {chex_model.backend_name():<18} workers={workers:<3} threads={threads:<3} "
+              f"batch={batch:<3} {trial['throughput']:8.1f} img/s  p95 {trial['p95_ms']:8.1f} ms")
+        trials.append(trial)
+        return trial
+
+    def load(backend: Tuple[str, bool, bool]) -> bool:
+        name, fold_bn, channels_last = backend
+        try:
+            chex_model.init_model(model_path, class_names=class_names, use_imagenet_norm=use_imagenet_norm,
+                                  backend=name, fold_bn=fold_bn, channels_last=channels_last,
+                                  cache_dir=cache_dir, warmup=True)
+        except Exception as e:
+            print(f"[autotune] 跳过 {name}：{e}")
+            return False
+        # 构建失败 / 自检超出容差时 init_model 会退回 eager，这样的候选不参与比较
+        return name == "eager" or chex_model.backend_name().split("-")[0] == name
+
+    t0 = time.perf_counter()
+    # 1) 后端
+    stage1 = [measure("backend", c, 1, cores, 1) for c in candidates if load(c)]
+    if not stage1:
+        raise RuntimeError("没有可用的推理后端")
+    best = _best(stage1, slo_ms)
+    backend = (best["backend"], best["fold_bn"], best["channels_last"])
+    if tuple(candidates[-1]) != backend:   # 当前加载的是最后一个候选
+        load(backend)
+    # 2) 线程划分
+    stage2 = [best] + [measure("threads", backend, w, t, 1) for w, t in _thread_splits(cores) if (w, t) != (1, cores)]
+    best = _best(stage2, slo_ms)
+    workers, threads = best["infer_workers"], best["torch_threads"]
+    # 3) 微批大小
+    stage3 = [best] + [measure("batch", backend, workers, threads, b) for b in batch_sizes if b > 1]
+    best = _best(stage3, slo_ms)
+
+    weights_hash = chex_model.file_sha256(model_path)[:16]
+    config = {
+        "backend": best["backend"],
+        "fold_bn": best["fold_bn"],
+        "channels_last": best["channels_last"],
+        "infer_workers": best["infer_workers"],
+        "torch_threads": best["torch_threads"],
+        "batch_size": best["batch_size"],
+        "max_wait_ms": float(max_wait_ms),
+        "throughput": best["throughput"],
+        "p95_ms": best["p95_ms"],
+        "slo_ms": float(slo_ms),
+        "met_slo": best["p95_ms"] <= slo_ms,
+        "baseline": stage1[0] if stage1[0]["backend"] == "eager" else None,
+        "cpu": cpu_model(),
+        "cores": cores,
+        "weights_hash": weights_hash,
+        "heatmap": bool(generate_heatmap),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "tune_seconds": round(time.perf_counter() - t0, 1),
+        "trials": trials,
+    }
+    print(f"[autotune] 选定 backend={config['backend']} fold_bn={config['fold_bn']} "
+          f"channels_last={config['channels_last']} workers={config['infer_workers']} "
+          f"threads={config['torch_threads']} batch={config['batch_size']}："
+          f"{config['throughput']:.1f} img/s p95 {config['p95_ms']:.1f} ms（SLO {slo_ms:.0f} ms"
+          f"{'' if config['met_slo'] else '，未满足'}），耗时 {config['tune_seconds']:.0f} s")
+    return config
+
+
+def load_or_tune(
+    model_path: str,
+    path: str,
+    class_names: Optional[List[str]] = None,
+    cores: Optional[int] = None,
+    force: bool = False,
+    **kwargs: Any,
+) -> Dict[str, Any]:
+    """
+    按 “CPU 型号|核数|权重哈希” 查找已保存的配置；没有（或 force）时扫描并保存。kwargs 同 tune。
+    扫描在跨进程文件锁内进行，拿到锁后重新查一次：force 时本次调用开始之后其他进程保存的结果也直接复用。
+    """
+    from chex_model import file_sha256
+
+    started = time.time()
+    cores = int(cores or available_cores())
+    key = config_key(file_sha256(model_path)[:16], cores)
+    config = None if force else load_config(path, key)
+    if config is not None:
+        print(f"[autotune] 复用已保存的配置 {key}")
+        return config
+    with _file_lock(path + ".lock"):
+        config = load_config(path, key)
+        if config is not None and (not force or os.path.getmtime(path) >= started):
+            print(f"[autotune] 复用其他进程刚保存的配置 {key}")
+            return config
+        print(f"[autotune] 开始扫描 {key}")
+        config = tune(model_path, class_names, cores=cores, **kwargs)
+        save_config(path, key, config)
+    return config
+
+
+@contextlib.contextmanager
+def _file_lock(path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# ---------------------------
+# 命令行
+# ---------------------------
+def main(argv: Optional[List[str]] = None) -> None:
+    data_dir = os.environ.get("CHEX_DATA_DIR", os.path.join(os.path.abspath(os.path.dirname(__file__)), "data"))
+    parser = argparse.ArgumentParser(description="CheXpert 推理配置自动调优")
+    parser.add_argument("--model", type=str, default=os.environ.get("MODEL_PATH", "final_global_model.pth"))
+    parser.add_argument("--file", type=str, default=os.environ.get("CHEX_AUTOTUNE_FILE", os.path.join(data_dir, "autotune.json")))
+    parser.add_argument("--slo-ms", type=float, default=float(os.environ.get("CHEX_AUTOTUNE_SLO_MS", "500")))
+    parser.add_argument("--seconds", type=float, default=2.0, help="每个 trial 的计时长度")
+    parser.add_argument("--cores", type=int, default=0, help="核数预算；0 表示本进程可用核数")
+    parser.add_argument("--backends", type=str, default="", help="只扫描这些后端（逗号分隔）")
+    parser.add_argument("--batch-sizes", type=str, default=",".join(map(str, BATCH_SIZES)))
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--no-heatmap", action="store_true", help="只测分类（不生成热力图）")
+    parser.add_argument("--cache-dir", type=str, default=os.environ.get("CHEX_MODEL_CACHE_DIR", os.path.join(data_dir, "model_cache")))
+    parser.add_argument("--force", action="store_true", help="忽略已保存的配置，重新扫描")
+    parser.add_argument("--show", action="store_true", help="只列出已保存的配置")
+    args = parser.parse_args(argv)
+
+    if args.show:
+        for key, cfg in _read(args.file).get("configs", {}).items():
+            print(f"{key}\n  " + " ".join(f"{k}={v}" for k, v in env_overrides(cfg).items())
+                  + f"\n  {cfg['throughput']} img/s p95 {cfg['p95_ms']} ms（SLO {cfg['slo_ms']} ms） {cfg['created']}")
+        return
+    backends = {b.strip().lower() for b in args.backends.split(",") if b.strip()}
+    config = load_or_tune(
+        args.model, args.file, cores=args.cores or None, force=args.force,
+        slo_ms=args.slo_ms, seconds=args.seconds,
+        candidates=[c for c in CANDIDATES if not backends or c[0] in backends],
+        batch_sizes=[int(b) for b in args.batch_sizes.split(",") if b.strip()],
+        max_wait_ms=args.max_wait_ms, generate_heatmap=not args.no_heatmap,
+        cache_dir=args.cache_dir or None,
+    )
+    print(json.dumps(env_overrides(config), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
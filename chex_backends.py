@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+chex_backends.py — 推理后端：把加载好的 eager DenseNet121 转成更快的推理形态
+
+所有后端都是同一个调用约定：runner(batch [B,3,S,S]) -> (feats [B,C,h,w], outputs [B,K])，
+与 chex_model.forward_features 一致（CAM 需要 features 输出，所以导出 / 编译的都是“特征 + 分类头”）。
+
+- eager:        原始 nn.Module
+- torchscript:  torch.jit.trace + freeze（常量折叠、BN 融合）+ optimize_for_inference
+- compile:      torch.compile（PyTorch 2.x）
+- onnx:         导出 ONNX（batch 维动态），ONNX Runtime CPUExecutionProvider 执行
+
+与后端正交的两项图变换：
+- fold_batchnorm: 把 Conv2d 后紧跟的 BatchNorm2d 折叠进卷积权重
+  （DenseNet 为 BN-ReLU-Conv 预激活结构，只有 conv0→norm0 与每个 dense layer 的 conv1→norm2 可折叠）；
+- channels_last:  权重与输入改为 NHWC 内存布局，CPU 上的 oneDNN 卷积通常更快。
+
+check_parity 在同一输入上比较两个 runner 的概率与 CAM，init_model 用它在启用优化后做自检，
+超出容差时退回 eager。
+"""
+
+import os
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+import chex_model
+
+Runner = Callable[[torch.Tensor], Tuple[torch.Tensor, torch.Tensor]]
+
+BACKENDS = ("eager", "torchscript", "compile", "onnx")
+
+
+class FeatureHead(nn.Module):
+    """把 forward_features 包成普通 forward，供 trace / compile / ONNX 导出。"""
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return chex_model.forward_features(self.model, x)
+
+
+# ---------------------------
+# 图变换
+# ---------------------------
+def fold_batchnorm(model: nn.Module) -> int:
+    """
+    原地把“Conv2d 之后紧跟注册的 BatchNorm2d”折叠进卷积，BN 替换为 Identity；返回折叠的对数。
+    依赖 torchvision DenseNet 中子模块注册顺序与数据流一致；只能用于 eval 模式。
+    """
+    n = 0
+    for parent in model.modules():
+        children = list(parent.named_children())
+        for (conv_name, conv), (bn_name, bn) in zip(children, children[1:]):
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(parent, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(parent, bn_name, nn.Identity())
+                n += 1
+    return n
+
+
+def _contiguous(x: torch.Tensor, channels_last: bool) -> torch.Tensor:
+    return x.contiguous(memory_format=torch.channels_last) if channels_last else x
+
+
+# ---------------------------
+# 各后端
+# ---------------------------
+def _eager(model: nn.Module, channels_last: bool) -> Runner:
+    def run(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        with torch.no_grad():
+            return chex_model.forward_features(model, _contiguous(x, channels_last))
+    return run
+
+
+def _torchscript(model: nn.Module, example: torch.Tensor, channels_last: bool, cache_path: Optional[str] = None) -> Runner:
+    with torch.no_grad():
+        if cache_path and os.path.exists(cache_path):
+            module = torch.jit.load(cache_path, map_location=example.device)
+        else:
+            traced = torch.jit.trace(FeatureHead(model).eval(), _contiguous(example, channels_last))
+            module = torch.jit.freeze(traced)
+            if cache_path:
+                # 缓存 freeze 之后的图；optimize_for_inference 的结果与机器相关，每次加载后再做
+                os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+                torch.jit.save(module, f"{cache_path}.{os.getpid()}.tmp")
+                os.replace(f"{cache_path}.{os.getpid()}.tmp", cache_path)
+        try:
+            module = torch.jit.optimize_for_inference(module)
+        except Exception as e:   # 部分版本 / 设备不支持，freeze 之后的图已可用
+            print(f"[backends] optimize_for_inference 跳过：{e}")
+
+    def run(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        with torch.no_grad():
+            return module(_contiguous(x, channels_last))
+    return run
+
+
+def _compile(model: nn.Module, channels_last: bool) -> Runner:
+    if not hasattr(torch, "compile"):
+        raise RuntimeError("当前 PyTorch 不支持 torch.compile（需要 2.x）")
+    compiled = torch.compile(FeatureHead(model).eval())
+
+    def run(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        with torch.no_grad():
+            return compiled(_contiguous(x, channels_last))
+    return run
+
+
+def export_onnx(model: nn.Module, path: str, example: torch.Tensor, opset: int = 17) -> str:
+    """导出 features + 分类头，输入 / 输出的 batch 维为动态。先写临时文件再改名。"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            FeatureHead(model).eval(), example.cpu(), tmp,
+            input_names=["input"], output_names=["feats", "probs"],
+            dynamic_axes={"input": {0: "batch"}, "feats": {0: "batch"}, "probs": {0: "batch"}},
+            opset_version=opset,
+        )
+    os.replace(tmp, path)
+    return path
+
+
+def _onnx(model: nn.Module, example: torch.Tensor, path: str, threads: Optional[int]) -> Runner:
+    import onnxruntime as ort
+
+    if not os.path.exists(path):
+        export_onnx(model, path, example)
+        print(f"[backends] 已导出 ONNX: {path}")
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.intra_op_num_threads = int(threads or torch.get_num_threads())
+    session = ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+
+    def run(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        feats, probs = session.run(None, {"input": x.detach().cpu().numpy()})
+        return torch.from_numpy(feats), torch.from_numpy(probs)
+    return run
+
+
+def build_runner(
+    model: nn.Module,
+    backend: str = "eager",
+    channels_last: bool = False,
+    example: Optional[torch.Tensor] = None,
+    onnx_path: Optional[str] = None,
+    threads: Optional[int] = None,
+    cache_path: Optional[str] = None,
+) -> Runner:
+    """
+    按 backend 构建 runner。model 须已 eval() 并位于目标设备；
+    channels_last 会就地转换 model 的内存布局（onnx 后端忽略该项，布局由 ORT 决定）。
+    - cache_path: torchscript 后端冻结后的图的缓存文件，存在时直接加载，跳过 trace
+    """
+    backend = (backend or "eager").lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"未知后端: {backend}（可选 {', '.join(BACKENDS)}）")
+    device = next(model.parameters()).device
+    if example is None:
+        example = torch.rand(2, 3, 224, 224, generator=torch.Generator().manual_seed(0))
+    example = example.to(device)
+    if backend == "onnx":
+        if onnx_path is None:
+            raise ValueError("onnx 后端需要 onnx_path")
+        return _onnx(model, example, onnx_path, threads)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if backend == "torchscript":
+        return _torchscript(model, example, channels_last, cache_path)
+    if backend == "compile":
+        return _compile(model, channels_last)
+    return _eager(model, channels_last)
+
+
+# ---------------------------
+# 一致性检查
+# ---------------------------
+def check_parity(
+    reference: Runner,
+    candidate: Runner,
+    weight: torch.Tensor,
+    example: torch.Tensor,
+    atol_probs: float = 1e-3,
+    atol_cam: float = 1e-2,
+) -> Dict[str, Any]:
+    """
+    在 example 上比较两个 runner：概率最大绝对差，以及所有类别逐类 CAM（0~1 归一化后）的最大绝对差。
+    返回 {'max_prob_diff', 'max_cam_diff', 'ok'}。
+    """
+    ref_feats, ref_out = reference(example)
+    cand_feats, cand_out = candidate(example)
+    select = torch.ones(ref_out.shape, dtype=torch.bool)
+    ref_cams = chex_model.compute_cams(ref_feats.float(), weight, select, per_class=True)
+    cand_cams = chex_model.compute_cams(cand_feats.float(), weight, select, per_class=True)
+    prob_diff = float(np.abs(ref_out.float().cpu().numpy() - cand_out.float().cpu().numpy()).max())
+    cam_diff = float(np.abs(ref_cams - cand_cams).max())
+    return {
+        "max_prob_diff": prob_diff,
+        "max_cam_diff": cam_diff,
+        "ok": prob_diff <= atol_probs and cam_diff <= atol_cam,
+    }
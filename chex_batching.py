@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+chex_batching.py — 动态微批调度器（位于 chex_model.infer 之前）
+
+思路：
+- 各请求线程调用 BatchingEngine.infer(...)，图片进入队列后阻塞等待自己的结果；
+- 后台单线程从队列取请求，凑满 max_batch_size 或等满 max_wait_ms 即合并为一个 batch，
+  调用 chex_model.infer_batch 做一次前向，再把逐张结果分发回各自的调用方。
+- 返回结构与 chex_model.infer 完全一致，app.py 可直接替换 model_infer。
+- chex_model 的前向可重入，因此可开多个 worker 线程并行消费队列，
+  每个 worker 各自设置 torch 线程数（intra_op_threads），避免多个 worker 争抢同一批核。
+- max_batch_size=1、max_wait_ms=0 时退化为“N 线程单张推理池”。
+- 每张图在队列中的等待时间记为 "queue" 阶段（chex_metrics），并写入结果的 timings。
+- submit 可带截止时间（time.monotonic() 时刻，见 chex_admission）：发车时已过期的图直接以
+  DeadlineExceeded 结束，不进入前向。
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+
+import chex_model
+from chex_admission import DeadlineExceeded, expired
+from chex_metrics import observe_stage
+
+# 队列项：(image, kwargs, future, 入队时间 perf_counter, 截止时间 monotonic 或 None)
+_Item = Tuple[Any, Dict[str, Any], Future, float, Optional[float]]
+
+_STOP = object()
+
+
+class BatchingEngine:
+    """
+    微批推理引擎。
+    - max_batch_size: 单次前向的最大图片数
+    - max_wait_ms: 第一张图入队后最多等待多久再发车
+    - batch_fn: 批推理函数，签名同 chex_model.infer_batch（便于测试替换）；以 return_errors=True 调用，
+      解码失败的图在对应位置返回异常，只让该图的调用方失败
+    - num_workers: 并行消费队列的推理线程数
+    - intra_op_threads: 每个推理线程的 torch 线程数；None 表示不设置
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10.0,
+        batch_fn: Optional[Callable[..., List[Dict[str, Any]]]] = None,
+        num_workers: int = 1,
+        intra_op_threads: Optional[int] = None,
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size 必须 >= 1")
+        if num_workers < 1:
+            raise ValueError("num_workers 必须 >= 1")
+        self.max_batch_size = int(max_batch_size)
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._batch_fn = batch_fn or chex_model.infer_batch
+        self.num_workers = int(num_workers)
+        self.intra_op_threads = intra_op_threads
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        # 凑批阶段串行化，避免多个 worker 各拿一张图导致 batch 过小
+        self._collect_lock = threading.Lock()
+
+    # ---------------------------
+    # 生命周期
+    # ---------------------------
+    def start(self) -> "BatchingEngine":
+        with self._lock:
+            if not self._threads:
+                for i in range(self.num_workers):
+                    t = threading.Thread(target=self._loop, name=f"chex-batcher-{i}", daemon=True)
+                    t.start()
+                    self._threads.append(t)
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(_STOP)
+        for t in threads:
+            t.join(timeout)
+
+    # ---------------------------
+    # 对外接口
+    # ---------------------------
+    def submit(self, image: Any, deadline: Optional[float] = None, **kwargs: Any) -> Future:
+        """提交单张图片，返回 Future；kwargs 同 chex_model.infer。"""
+        if not self._threads:
+            raise RuntimeError("BatchingEngine 未启动，请先调用 start()")
+        fut: Future = Future()
+        self._queue.put((image, kwargs, fut, time.perf_counter(), deadline))
+        return fut
+
+    def infer(self, image: Any, deadline: Optional[float] = None, **kwargs: Any) -> Dict[str, Any]:
+        """阻塞版本，签名与返回结构同 chex_model.infer（另可带 deadline）。"""
+        return self.submit(image, deadline, **kwargs).result()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    # ---------------------------
+    # 后台调度
+    # ---------------------------
+    def _collect(self, first: _Item) -> Tuple[List[_Item], bool]:
+        """以 first 为起点凑一个 batch；返回 (batch, 是否收到停止信号)。"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self, batch: List[_Item]) -> None:
+        # 调用方可能已经取消
+        batch = [b for b in batch if b[2].set_running_or_notify_cancel()]
+        # 排队期间已过截止时间的不再前向
+        live = []
+        for b in batch:
+            if expired(b[4]):
+                b[2].set_exception(DeadlineExceeded("微批队列中超过截止时间"))
+            else:
+                live.append(b)
+        batch = live
+        if not batch:
+            return
+        now = time.perf_counter()
+        waits = [now - b[3] for b in batch]
+        for w in waits:
+            observe_stage("queue", w)
+        try:
+            results = self._batch_fn([b[0] for b in batch], options=[b[1] for b in batch], return_errors=True)
+        except Exception as e:
+            for b in batch:
+                b[2].set_exception(e)
+            return
+        for b, w, res in zip(batch, waits, results):
+            if isinstance(res, BaseException):
+                b[2].set_exception(res)
+                continue
+            if isinstance(res, dict):
+                res.setdefault("timings", {})["queue"] = w * 1000.0
+            b[2].set_result(res)
+
+    def _loop(self) -> None:
+        if self.intra_op_threads:
+            # OpenMP 线程数按调用线程生效，各 worker 互不影响
+            torch.set_num_threads(int(self.intra_op_threads))
+        while True:
+            with self._collect_lock:
+                first = self._queue.get()
+                if first is _STOP:
+                    break
+                batch, stop = self._collect(first)
+            self._run(batch)
+            if stop:
+                break
+        # 退出前把剩余请求以异常结束，避免调用方永久阻塞；其他 worker 的停止信号放回队列
+        stops = 0
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stops += 1
+            elif item[2].set_running_or_notify_cancel():
+                item[2].set_exception(RuntimeError("BatchingEngine 已停止"))
+        for _ in range(stops):
+            self._queue.put(_STOP)
@@ -0,0 +1,2048 @@
+# -*- coding: utf-8 -*-
+"""
+chex_bench.py — 推理侧基准测试（无需网络、无需真实权重）
+
+用法：
+    python chex_bench.py batching --clients 1 8 32 --requests 64
+    python chex_bench.py stress --clients 32 --requests 512
+    python chex_bench.py cam --positives 1 5 14 --batch 1 8
+    python chex_bench.py preprocess --width 2500 --height 3000
+    python chex_bench.py dicom --width 2500 --height 3000
+    python chex_bench.py history --rows 1000000
+    python chex_bench.py history-stats --rows 1000000
+    python chex_bench.py persist --width 2500 --height 3000
+    python chex_bench.py analyze-batch --images 16 --batch-size 8
+    python chex_bench.py backends --backends eager torchscript compile onnx --batch 1 8
+    python chex_bench.py quant --calib /data/calib --eval /data/CheXpert-v1.0-small/valid.csv
+    python chex_bench.py startup --backend eager --app
+    python chex_bench.py serve --workers 1 2 4 8 --clients 16 --requests 200
+    python chex_bench.py metrics --requests 200 --heatmap
+    python chex_bench.py overlay --width 2500 --height 3000 --max-side 1024
+    python chex_bench.py slow-upload --clients 64 --file-mb 20 --delay-ms 50
+    python chex_bench.py ensemble --models 1 2 3 --batch 1 8
+    python chex_bench.py triage --images 64 --positive-rates 0.1 0.3 0.6 --batch 8
+    python chex_bench.py artifacts --counts 10000 100000 1000000 --scan-max 100000
+    python chex_bench.py admission --overload 3 --duration 30 --mix stat=0.1 routine=0.6 bulk=0.3
+    python chex_bench.py similar --sizes 100000 1000000 --nprobe 8 32 --pq-m 64
+    python chex_bench.py suite --transports inproc http --clients 1 8 --json out.json --baseline baseline.json
+
+说明：
+- 未指定 --model 时，自动生成随机初始化的 DenseNet121 权重（14 类）到临时目录；
+- 输入为合成的“类 X 光”灰度图，尺寸可通过 --size 调整；
+- 结果以表格打印，--json 可额外写出 JSON；
+- suite 为回归基准：--save-baseline 保存基线，--baseline 对比基线，有退化时以退出码 1 结束。
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+import torch
+
+import chex_model
+
+CHEX_CLASSES: List[str] = [
+    "No Finding", "Enlarged Cardiomediastinum", "Cardiomegaly",
+    "Lung Lesion", "Lung Opacity", "Edema", "Consolidation",
+    "Pneumonia", "Atelectasis", "Pneumothorax", "Pleural Effusion",
+    "Pleural Other", "Fracture", "Support Devices"
+]
+
+
+# ---------------------------
+# 合成数据
+# ---------------------------
+def make_checkpoint(path: str, num_classes: int = len(CHEX_CLASSES), seed: int = 0) -> str:
+    """生成随机初始化的 DenseNet121 权重，格式与训练产物一致（model_state_dict）。"""
+    torch.manual_seed(seed)
+    model = chex_model._build_densenet121(num_classes)
+    torch.save({"model_state_dict": model.state_dict()}, path)
+    return path
+
+
+def synthetic_xray_array(width: int = 1024, height: Optional[int] = None, seed: int = 0) -> np.ndarray:
+    """合成单通道“胸片”（0~1 float32）：暗背景 + 两个亮椭圆肺野 + 噪声。"""
+    height = height or width
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    yy /= height
+    xx /= width
+    img = 0.15 + 0.05 * rng.standard_normal((height, width)).astype(np.float32)
+    for cx in (0.32 + 0.05 * rng.random(), 0.68 - 0.05 * rng.random()):
+        lung = ((xx - cx) / 0.17) ** 2 + ((yy - 0.5) / 0.32) ** 2 < 1.0
+        img[lung] += 0.5 + 0.1 * rng.random()
+    return np.clip(img, 0, 1)
+
+
+def synthetic_xray(size: int = 1024, seed: int = 0, height: Optional[int] = None) -> Image.Image:
+    return Image.fromarray((synthetic_xray_array(size, height, seed) * 255).astype(np.uint8), mode="L")
+
+
+def encode_image(pil: Image.Image, fmt: str, **kwargs: Any) -> bytes:
+    buf = io.BytesIO()
+    pil.save(buf, format=fmt, **kwargs)
+    return buf.getvalue()
+
+
+def synthetic_dicom(arr: np.ndarray, **attrs: Any) -> bytes:
+    """
+    把 uint16 数组封装成最小可读的 DICOM（Explicit VR Little Endian）。
+    attrs 可附加 WindowCenter / RescaleSlope / PhotometricInterpretation 等标签。
+    """
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, SecondaryCaptureImageStorage, generate_uid
+
+    arr = np.ascontiguousarray(arr, dtype=np.uint16)
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = "CR"
+    ds.Rows, ds.Columns = arr.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    for k, v in attrs.items():
+        setattr(ds, k, v)
+    ds.PixelData = arr.tobytes()
+
+    buf = io.BytesIO()
+    if int(pydicom.__version__.split(".")[0]) >= 3:
+        pydicom.dcmwrite(buf, ds, enforce_file_format=True)
+    else:
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        pydicom.dcmwrite(buf, ds, write_like_original=False)
+    return buf.getvalue()
+
+
+def ensure_model(model_path: Optional[str], workdir: str) -> str:
+    if model_path:
+        return model_path
+    return make_checkpoint(os.path.join(workdir, "random_densenet121.pth"))
+
+
+# ---------------------------
+# 统计
+# ---------------------------
+def summarize(latencies_s: List[float], wall_s: float) -> Dict[str, float]:
+    lat = np.asarray(latencies_s, dtype=np.float64) * 1000.0
+    return {
+        "n": int(lat.size),
+        "p50_ms": float(np.percentile(lat, 50)) if lat.size else 0.0,
+        "p95_ms": float(np.percentile(lat, 95)) if lat.size else 0.0,
+        "p99_ms": float(np.percentile(lat, 99)) if lat.size else 0.0,
+        "images_per_s": float(lat.size / wall_s) if wall_s > 0 else 0.0,
+    }
+
+
+def run_clients(fn: Callable[[int], Any], clients: int, requests_per_client: int) -> Dict[str, float]:
+    """clients 个线程各自串行调用 fn(i) requests_per_client 次，统计延迟与吞吐。"""
+    latencies: List[float] = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def _client(cid: int) -> None:
+        local = []
+        barrier.wait()
+        for k in range(requests_per_client):
+            t0 = time.perf_counter()
+            fn(cid * requests_per_client + k)
+            local.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=_client, args=(c,)) for c in range(clients)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    return summarize(latencies, time.perf_counter() - t0)
+
+
+def print_table(rows: List[Dict[str, Any]], columns: List[str]) -> None:
+    widths = [max(len(c), *(len(_fmt(r.get(c))) for r in rows)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    print("  ".join("-" * w for w in widths))
+    for r in rows:
+        print("  ".join(_fmt(r.get(c)).ljust(w) for c, w in zip(columns, widths)))
+
+
+def _fmt(v: Any) -> str:
+    if isinstance(v, float):
+        return f"{v:.2f}"
+    return "" if v is None else str(v)
+
+
+def _dump(rows: List[Dict[str, Any]], path: Optional[str]) -> None:
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+        print(f"[bench] 已写出 {path}")
+
+
+# ---------------------------
+# 基准：微批 vs 单张
+# ---------------------------
+def bench_batching(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_batching import BatchingEngine
+
+    chex_model.init_model(ensure_model(args.model, workdir), class_names=None if args.model else CHEX_CLASSES)
+    images = [synthetic_xray(args.size, seed=i) for i in range(8)]
+    kw = {"generate_heatmap": args.heatmap}
+
+    # 预热
+    chex_model.infer(images[0], **kw)
+
+    rows = []
+    for clients in args.clients:
+        single = run_clients(lambda i: chex_model.infer(images[i % len(images)], **kw), clients, args.requests)
+        rows.append(dict(mode="single", clients=clients, **single))
+
+        engine = BatchingEngine(args.max_batch_size, args.max_wait_ms).start()
+        try:
+            batched = run_clients(lambda i: engine.infer(images[i % len(images)], **kw), clients, args.requests)
+        finally:
+            engine.stop()
+        rows.append(dict(mode=f"batch({args.max_batch_size}/{args.max_wait_ms:g}ms)", clients=clients, **batched))
+
+    print_table(rows, ["mode", "clients", "n", "p50_ms", "p99_ms", "images_per_s"])
+    return rows
+
+
+# ---------------------------
+# 压测：并发请求的热力图是否与各自图片一一对应
+# ---------------------------
+def bench_stress(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_batching import BatchingEngine
+
+    chex_model.init_model(ensure_model(args.model, workdir), class_names=None if args.model else CHEX_CLASSES)
+    # 尺寸各异，串图时连形状都会对不上
+    images = [synthetic_xray(args.size + 16 * (i % 5), seed=i) for i in range(args.images)]
+    refs = [np.asarray(chex_model.infer(img)["heatmap"], dtype=np.int16) for img in images]
+
+    def _check(idx: int, heatmap: Optional[Image.Image]) -> int:
+        """返回与参考图的最大差值；形状不符或更接近其他图片时返回 -1。"""
+        if heatmap is None:
+            return -1
+        got = np.asarray(heatmap, dtype=np.int16)
+        if got.shape != refs[idx].shape:
+            return -1
+        own = np.abs(got - refs[idx]).mean()
+        for j, ref in enumerate(refs):
+            if j != idx and ref.shape == got.shape and np.abs(got - ref).mean() < own:
+                return -1
+        return int(np.abs(got - refs[idx]).max())
+
+    engine = BatchingEngine(args.max_batch_size, args.max_wait_ms, num_workers=args.workers).start()
+    modes = {
+        "threads": chex_model.infer,
+        f"batch x{args.workers}": engine.infer,
+    }
+    order = np.random.default_rng(0).integers(0, len(images), size=args.requests)
+    rows = []
+    try:
+        for mode, fn in modes.items():
+            with ThreadPoolExecutor(args.clients) as pool:
+                diffs = list(pool.map(lambda i: _check(int(i), fn(images[int(i)])["heatmap"]), order))
+            bad = sum(1 for d in diffs if d < 0 or d > args.tolerance)
+            rows.append({
+                "mode": mode, "clients": args.clients, "requests": len(diffs),
+                "mismatches": bad, "max_abs_diff": max((d for d in diffs if d >= 0), default=0),
+            })
+    finally:
+        engine.stop()
+
+    print_table(rows, ["mode", "clients", "requests", "mismatches", "max_abs_diff"])
+    if any(r["mismatches"] for r in rows):
+        raise SystemExit("[bench] 压测失败：存在热力图与图片不匹配")
+    return rows
+
+
+# ---------------------------
+# 微基准：CAM 计算（旧的逐类 NumPy 循环 vs 批量 einsum）
+# ---------------------------
+def _legacy_cam(f: np.ndarray, w: np.ndarray, pos_indices: List[int]) -> np.ndarray:
+    """重构前 _make_cam 的逐类循环（不含放大），作为对照。"""
+    cams = []
+    for idx in pos_indices:
+        cam = (w[idx][:, None, None] * f).sum(axis=0)
+        cam = np.maximum(cam, 0)
+        cam -= cam.min()
+        if cam.max() > 0:
+            cam /= cam.max()
+        cams.append(cam)
+    return np.clip(np.sum(cams, axis=0), 0, 1)
+
+
+def _time_it(fn: Callable[[], Any], repeat: int) -> float:
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1000.0
+
+
+def bench_cam(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    rng = np.random.default_rng(0)
+    num_classes, channels = len(CHEX_CLASSES), 1024
+    w = torch.from_numpy(rng.standard_normal((num_classes, channels)).astype(np.float32) * 0.05)
+    rows = []
+    for batch in args.batch:
+        feats = torch.from_numpy(np.abs(rng.standard_normal((batch, channels, 7, 7))).astype(np.float32))
+        for k in args.positives:
+            pos = list(range(min(k, num_classes)))
+            select = torch.zeros(batch, num_classes, dtype=torch.bool)
+            select[:, pos] = True
+
+            def _legacy():
+                # 旧实现：每张图各自转 NumPy 再逐类计算
+                return [_legacy_cam(feats[b].numpy(), w.numpy(), pos) for b in range(batch)]
+
+            def _vectorized():
+                return chex_model.compute_cams(feats, w, select)
+
+            diff = float(np.abs(np.stack(_legacy()) - _vectorized()).max())
+            legacy_ms = _time_it(_legacy, args.repeat)
+            vec_ms = _time_it(_vectorized, args.repeat)
+            rows.append({
+                "batch": batch, "positives": len(pos),
+                "loop_ms": legacy_ms, "einsum_ms": vec_ms,
+                "speedup": legacy_ms / vec_ms if vec_ms > 0 else 0.0,
+                "max_abs_diff": diff,
+            })
+
+    print_table(rows, ["batch", "positives", "loop_ms", "einsum_ms", "speedup", "max_abs_diff"])
+    return rows
+
+
+# ---------------------------
+# 基准：前处理（PIL RGB + T.Resize + ToTensor vs chex_preprocess）
+# ---------------------------
+def _legacy_dicom_pil(data: bytes) -> Image.Image:
+    """重构前 app._to_pil_from_upload 的 DICOM 分支。"""
+    import pydicom
+    ds = pydicom.dcmread(io.BytesIO(data))
+    arr = ds.pixel_array.astype(np.float32)
+    arr = (255 * (arr - arr.min()) / (arr.max() - arr.min() + 1e-6)).astype(np.uint8)
+    return Image.fromarray(arr).convert("RGB")
+
+
+def bench_preprocess(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    import torchvision.transforms as T
+    from chex_preprocess import Preprocessor
+
+    legacy_tf = T.Compose([T.Resize((224, 224)), T.ToTensor()])
+    pre = Preprocessor(224)
+    arr = synthetic_xray_array(args.width, args.height, seed=0)
+    pil = Image.fromarray((arr * 255).astype(np.uint8), mode="L")
+
+    inputs = {
+        "png": encode_image(pil, "PNG"),
+        "jpeg": encode_image(pil, "JPEG", quality=90),
+    }
+    try:
+        inputs["dicom"] = synthetic_dicom((arr * 4095).astype(np.uint16))
+    except ImportError:
+        print("[bench] 未安装 pydicom，跳过 DICOM")
+
+    def _legacy(fmt: str, data: bytes) -> torch.Tensor:
+        src = _legacy_dicom_pil(data) if fmt == "dicom" else Image.open(io.BytesIO(data)).convert("RGB")
+        return legacy_tf(src).unsqueeze(0)
+
+    def _fast(fmt: str, data: bytes, keep_full: bool) -> torch.Tensor:
+        if fmt == "dicom":
+            data = np.asarray(_legacy_dicom_pil(data).convert("L"))
+        return pre.to_batch([pre.decode(data, keep_full=keep_full).small])
+
+    rows = []
+    for fmt, data in inputs.items():
+        ref = _legacy(fmt, data)
+        rows.append({
+            "format": fmt, "size": f"{args.width}x{args.height}", "bytes": len(data),
+            "legacy_ms": _time_it(lambda: _legacy(fmt, data), args.repeat),
+            "fast_ms": _time_it(lambda: _fast(fmt, data, False), args.repeat),
+            "fast_keep_full_ms": _time_it(lambda: _fast(fmt, data, True), args.repeat),
+            "max_abs_diff": float((_fast(fmt, data, False) - ref).abs().max()),
+            "max_abs_diff_full": float((_fast(fmt, data, True) - ref).abs().max()),
+        })
+
+    print_table(rows, ["format", "size", "bytes", "legacy_ms", "fast_ms", "fast_keep_full_ms",
+                       "max_abs_diff", "max_abs_diff_full"])
+    return rows
+
+
+# ---------------------------
+# 基准：DICOM 读取（旧的全量读入 + float32 vs chex_dicom）
+# ---------------------------
+def _peak_mem(fn: Callable[[], Any]) -> Tuple[Any, float]:
+    """返回 (结果, tracemalloc 峰值 MB)；NumPy 的数组分配也会被统计。"""
+    tracemalloc.start()
+    try:
+        res = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return res, peak / 2 ** 20
+
+
+def bench_dicom(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_dicom import read_dicom
+
+    raw = (synthetic_xray_array(args.width, args.height, seed=0) * 4095).astype(np.uint16)
+    cases = {
+        "plain": {},
+        "window+rescale": {"RescaleSlope": 1, "RescaleIntercept": -1024,
+                           "WindowCenter": 1024, "WindowWidth": 3000},
+        "monochrome1": {"PhotometricInterpretation": "MONOCHROME1"},
+    }
+
+    def _legacy(path: str) -> Image.Image:
+        with open(path, "rb") as f:
+            return _legacy_dicom_pil(f.read())
+
+    def _fast(path: str, max_side: Optional[int]) -> np.ndarray:
+        with open(path, "rb") as f:
+            return read_dicom(f, max_side=max_side)
+
+    rows = []
+    for case, attrs in cases.items():
+        path = os.path.join(workdir, f"{case}.dcm")
+        with open(path, "wb") as f:
+            f.write(synthetic_dicom(raw, **attrs))
+        variants = [("legacy", lambda: _legacy(path))]
+        variants += [(f"stream max_side={m or 'full'}", (lambda m=m: _fast(path, m))) for m in args.max_side]
+        for name, fn in variants:
+            out, peak = _peak_mem(fn)
+            shape = np.asarray(out).shape
+            rows.append({
+                "case": case, "path": name, "out_shape": "x".join(map(str, shape)),
+                "latency_ms": _time_it(fn, args.repeat), "peak_mb": peak,
+            })
+
+    print_table(rows, ["case", "path", "out_shape", "latency_ms", "peak_mb"])
+    return rows
+
+
+# ---------------------------
+# 基准：历史记录（JSONL 全量扫描 vs SQLite 索引分页）
+# ---------------------------
+def synthetic_history(n: int, seed: int = 0):
+    """按时间顺序生成 n 条历史记录（结构同 app._append_history）。"""
+    import datetime
+    rng = np.random.default_rng(seed)
+    start = datetime.date(2024, 1, 1)
+    per_day = max(1, n // 365)
+    labels = rng.integers(0, len(CHEX_CLASSES), size=n)
+    confs = rng.random(n)
+    for i in range(n):
+        yield {
+            "date": (start + datetime.timedelta(days=i // per_day)).isoformat(),
+            "file_name": f"study_{i:07d}.png",
+            "diagnosis": CHEX_CLASSES[labels[i]],
+            "confidence": float(confs[i]),
+            "status": "completed",
+        }
+
+
+def _legacy_read_history(path: str) -> List[dict]:
+    """重构前 app._read_history：逐行解析后整体反转。"""
+    out: List[dict] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                out.append(json.loads(line))
+    return list(reversed(out))
+
+
+def bench_history(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_history import HistoryStore
+
+    jsonl = os.path.join(workdir, "analysis_history.jsonl")
+    with open(jsonl, "w", encoding="utf-8") as f:
+        for item in synthetic_history(args.rows):
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+    rows = []
+    ps = args.page_size
+    t0 = time.perf_counter()
+    data = _legacy_read_history(jsonl)
+    _ = data[:ps]
+    rows.append({"backend": "jsonl", "query": "page 1 (full scan)", "ms": (time.perf_counter() - t0) * 1000})
+    del data
+
+    t0 = time.perf_counter()
+    store = HistoryStore(os.path.join(workdir, "history.sqlite3"), legacy_jsonl=jsonl)
+    rows.append({"backend": "sqlite", "query": f"migrate {args.rows} rows", "ms": (time.perf_counter() - t0) * 1000})
+
+    deep = max(1, args.rows // ps // 2)
+    cursor = store.page(page=deep, page_size=ps)[0]["id"] + 1
+    queries = {
+        "page 1": lambda: store.page(1, ps),
+        f"page {deep} (offset)": lambda: store.page(deep, ps),
+        f"page {deep} (cursor)": lambda: store.page(page_size=ps, before_id=cursor),
+        "total": lambda: store.count(),
+        "diagnosis=Edema page 1": lambda: store.page(1, ps, diagnosis="Edema"),
+        "date range page 1": lambda: store.page(1, ps, date_from="2024-03-01", date_to="2024-03-31"),
+        "confidence>=0.9 page 1": lambda: store.page(1, ps, min_confidence=0.9),
+    }
+    for name, fn in queries.items():
+        rows.append({"backend": "sqlite", "query": name, "ms": _time_it(fn, args.repeat)})
+
+    print_table(rows, ["backend", "query", "ms"])
+    return rows
+
+
+def bench_history_stats(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_history import STATS_BINS, HistoryStore
+
+    rows = []
+    # 写入开销：带 / 不带统计触发器各写一遍
+    plain = HistoryStore(os.path.join(workdir, "plain.sqlite3"))
+    plain._conn().execute("DROP TRIGGER trg_stats_insert")
+    t0 = time.perf_counter()
+    plain.extend(synthetic_history(args.rows))
+    rows.append({"query": f"insert {args.rows} rows (no stats)", "ms": (time.perf_counter() - t0) * 1000})
+    t0 = time.perf_counter()
+    store = HistoryStore(os.path.join(workdir, "history.sqlite3"))
+    store.extend(synthetic_history(args.rows))
+    rows.append({"query": f"insert {args.rows} rows (incremental stats)", "ms": (time.perf_counter() - t0) * 1000})
+    t0 = time.perf_counter()
+    groups = store.rebuild_stats()
+    rows.append({"query": f"rebuild stats ({groups} groups)", "ms": (time.perf_counter() - t0) * 1000})
+
+    jsonl = os.path.join(workdir, "analysis_history.jsonl")
+    with open(jsonl, "w", encoding="utf-8") as f:
+        for item in synthetic_history(args.rows):
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+    def _jsonl_scan() -> Dict[Tuple[str, str], List[float]]:
+        # 旧方式：读全部历史后在客户端按天 / 诊断聚合
+        agg: Dict[Tuple[str, str], List[float]] = {}
+        for item in _legacy_read_history(jsonl):
+            a = agg.setdefault((item["date"], item["diagnosis"]), [0, 0.0] + [0] * STATS_BINS)
+            a[0] += 1
+            a[1] += item["confidence"]
+            a[2 + min(STATS_BINS - 1, int(item["confidence"] * STATS_BINS))] += 1
+        return agg
+
+    def _sql_scan() -> list:
+        return store._conn().execute(
+            "SELECT date, diagnosis, COUNT(*), AVG(confidence) FROM history GROUP BY date, diagnosis").fetchall()
+
+    queries = {
+        "full scan: jsonl + python": (_jsonl_scan, 1),
+        "full scan: sqlite GROUP BY": (_sql_scan, args.repeat),
+        "stats(): all": (lambda: store.stats(), args.repeat),
+        "stats(): one month": (lambda: store.stats(date_from="2024-03-01", date_to="2024-03-31"), args.repeat),
+        "stats(): diagnosis=Edema": (lambda: store.stats(diagnosis="Edema"), args.repeat),
+    }
+    for name, (fn, repeat) in queries.items():
+        rows.append({"query": name, "ms": _time_it(fn, repeat)})
+    full = store.stats()
+    assert full["total"] == args.rows
+    print_table(rows, ["query", "ms"])
+    return rows
+
+
+# ---------------------------
+# 基准：analyze 的落盘阶段（同步 PNG 重编码 vs 后台写入）
+# ---------------------------
+def bench_persist(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_history import HistoryStore
+    from chex_persist import ArtifactWriter
+
+    pil = synthetic_xray(args.width, seed=0, height=args.height)
+    upload = encode_image(pil, "JPEG", quality=90)
+    heatmap = Image.fromarray(np.stack([np.asarray(pil)] * 3, axis=-1))
+    store = HistoryStore(os.path.join(workdir, "history.sqlite3"))
+    item = {"date": "2024-01-01", "file_name": "x.jpg", "diagnosis": "Edema", "confidence": 0.9, "status": "completed"}
+
+    def _sync(i: int) -> None:
+        # 重构前：解码后整图 PNG 重编码原图 + PNG 热力图 + 同步追加历史
+        Image.open(io.BytesIO(upload)).convert("RGB").save(os.path.join(workdir, f"sync_{i}_orig.png"))
+        heatmap.save(os.path.join(workdir, f"sync_{i}_hm.png"))
+        store.append(item)
+
+    rows = []
+    lat = []
+    t_all = time.perf_counter()
+    for i in range(args.requests):
+        t0 = time.perf_counter()
+        _sync(i)
+        lat.append(time.perf_counter() - t0)
+    rows.append(dict(mode="sync png", **summarize(lat, time.perf_counter() - t_all)))
+
+    for fmt in args.formats:
+        writer = ArtifactWriter(args.workers, args.max_pending)
+        lat = []
+        t_all = time.perf_counter()
+        for i in range(args.requests):
+            t0 = time.perf_counter()
+            writer.write_bytes(os.path.join(workdir, f"{fmt}_{i}_orig.jpg"), upload)
+            writer.write_heatmap(os.path.join(workdir, f"{fmt}_{i}_hm.{fmt}"), heatmap, fmt, 85, args.heatmap_max_side)
+            writer.submit(store.append, item)
+            lat.append(time.perf_counter() - t0)
+        writer.shutdown(wait=True)
+        stats = summarize(lat, time.perf_counter() - t_all)
+        rows.append(dict(mode=f"async {fmt}", **stats))
+
+    for r in rows:
+        r["drain_images_per_s"] = r.pop("images_per_s")
+    print_table(rows, ["mode", "n", "p50_ms", "p99_ms", "drain_images_per_s"])
+    return rows
+
+
+# ---------------------------
+# 基准：N 次 /analyze vs 一次 /analyze_batch（进程内 TestClient）
+# ---------------------------
+def _load_app(model_path: str, workdir: str, batch_size: int):
+    """在临时目录中导入 app（模型、静态目录、数据目录均通过环境变量指向 workdir）。"""
+    os.environ.update({
+        "MODEL_PATH": model_path,
+        "CHEX_STATIC_ROOT": os.path.join(workdir, "static"),
+        "CHEX_DATA_DIR": os.path.join(workdir, "data"),
+        "CHEX_BATCH_MAX_SIZE": str(batch_size),
+        "CHEX_CACHE_MB": "0",
+    })
+    import app
+    return app
+
+
+def bench_analyze_batch(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from fastapi.testclient import TestClient
+
+    app = _load_app(ensure_model(args.model, workdir), workdir, args.batch_size)
+    client = TestClient(app.app)
+    images = [encode_image(synthetic_xray(args.size, seed=i), "PNG") for i in range(args.images)]
+    form = {"generate_heatmap": str(args.heatmap).lower()}
+
+    rows = []
+    for r in range(args.repeat + 1):
+        t0 = time.perf_counter()
+        for i, data in enumerate(images):
+            resp = client.post("/api/v1/image/analyze", files={"file": (f"img_{i}.png", data, "image/png")}, data=form)
+            resp.raise_for_status()
+        seq_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        files = [("files", (f"study/img_{i}.png", data, "image/png")) for i, data in enumerate(images)]
+        resp = client.post("/api/v1/image/analyze_batch", files=files, data=dict(form, aggregate="max"))
+        resp.raise_for_status()
+        batch_s = time.perf_counter() - t0
+        if r == 0:
+            continue    # 首轮预热
+        rows.append(dict(mode="sequential", n=args.images, wall_ms=seq_s * 1000, images_per_s=args.images / seq_s))
+        rows.append(dict(mode="batch", n=args.images, wall_ms=batch_s * 1000, images_per_s=args.images / batch_s))
+    app._WRITER.shutdown(wait=True)
+    print_table(rows, ["mode", "n", "wall_ms", "images_per_s"])
+    return rows
+
+
+# ---------------------------
+# 基准：推理后端（eager / TorchScript / torch.compile / ONNX Runtime，± BN 折叠 / channels_last）
+# ---------------------------
+def bench_backends(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    import copy
+
+    import chex_backends
+
+    path = ensure_model(args.model, workdir)
+    chex_model.init_model(path, class_names=None if args.model else CHEX_CLASSES)
+    eager = chex_model._MODEL
+    weight = chex_model._find_linear(eager.classifier).weight
+    reference = chex_model._eager_runner(eager)
+    gen = torch.Generator().manual_seed(0)
+
+    variants = []
+    for backend in args.backends:
+        variants.append((backend, False, False))
+        if args.optimizations:
+            variants += [(backend, True, False), (backend, True, True)]
+
+    rows = []
+    for backend, fold, cl in variants:
+        name = "-".join([backend] + (["fold"] if fold else []) + (["cl"] if cl else []))
+        if backend == "onnx" and cl:
+            continue
+        model = copy.deepcopy(eager)
+        if fold:
+            chex_backends.fold_batchnorm(model)
+        try:
+            runner = chex_backends.build_runner(
+                model, backend, cl, onnx_path=os.path.join(workdir, f"{name}.onnx"), threads=args.threads or None,
+            )
+        except Exception as e:
+            print(f"[bench] {name} 跳过：{e}")
+            continue
+        for batch in args.batch:
+            x = torch.rand(batch, 3, 224, 224, generator=gen)
+            parity = chex_backends.check_parity(reference, runner, weight, x)
+            ms = _time_it(lambda: runner(x), args.repeat)
+            rows.append({
+                "backend": name, "batch": batch,
+                "latency_ms": ms, "images_per_s": batch / ms * 1000.0 if ms > 0 else 0.0,
+                "max_prob_diff": parity["max_prob_diff"], "max_cam_diff": parity["max_cam_diff"],
+                "parity": "ok" if parity["ok"] else "FAIL",
+            })
+
+    base = {r["batch"]: r["latency_ms"] for r in rows if r["backend"] == "eager"}
+    for r in rows:
+        r["speedup"] = base[r["batch"]] / r["latency_ms"] if r["batch"] in base and r["latency_ms"] > 0 else 0.0
+    print_table(rows, ["backend", "batch", "latency_ms", "images_per_s", "speedup", "max_prob_diff", "max_cam_diff", "parity"])
+    if any(r["parity"] != "ok" for r in rows):
+        raise SystemExit("[bench] 一致性检查失败：存在超出容差的后端")
+    return rows
+
+
+# ---------------------------
+# 基准：低精度（fp32 / bf16 / INT8）的精度回归、延迟与内存
+# ---------------------------
+def _rss_mb() -> float:
+    """当前进程常驻内存（Linux /proc）；不可用时为 0。"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return 0.0
+
+
+def _state_mb(module: torch.nn.Module) -> float:
+    buf = io.BytesIO()
+    torch.save(module.state_dict(), buf)
+    return buf.tell() / float(1 << 20)
+
+
+def _write_synthetic_dir(path: str, n: int, seed: int, size: int) -> str:
+    os.makedirs(path, exist_ok=True)
+    for i in range(n):
+        synthetic_xray(size, seed=seed + i).save(os.path.join(path, f"img_{i:05d}.png"))
+    return path
+
+
+def _eval_set(src: str, classes: List[str], limit: int, batch: int) -> Tuple[List[torch.Tensor], Optional[np.ndarray]]:
+    """读取评估集：返回已归一化的 batch 列表，以及 CSV 清单含类别列时的标签 [N,K]（1/0，其余为 nan）。"""
+    import csv
+
+    from chex_bulk import iter_source
+
+    labels_by_path: Dict[str, List[float]] = {}
+    if src.lower().endswith(".csv"):
+        with open(src, "r", encoding="utf-8", newline="") as f:
+            reader = csv.DictReader(f)
+            if all(c in (reader.fieldnames or []) for c in classes):
+                for k, row in enumerate(reader):
+                    if k >= limit:
+                        break
+                    labels_by_path[row["Path"].strip()] = [
+                        {"1.0": 1.0, "1": 1.0, "0.0": 0.0, "0": 0.0}.get((row[c] or "").strip(), np.nan) for c in classes
+                    ]
+
+    pre = chex_model._PREPROCESSOR
+    batches, smalls, labels = [], [], []
+    for k, (rel, path) in enumerate(iter_source(src)):
+        if k >= limit:
+            break
+        try:
+            smalls.append(pre.decode(path, keep_full=False).small)
+        except Exception:
+            continue
+        labels.append(labels_by_path.get(rel, [np.nan] * len(classes)))
+        if len(smalls) == batch:
+            batches.append(pre.to_batch(smalls).clone())
+            smalls = []
+    if smalls:
+        batches.append(pre.to_batch(smalls).clone())
+    y = np.array(labels, dtype=np.float32) if labels_by_path else None
+    return batches, y
+
+
+def bench_quant(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    import copy
+
+    import chex_quant
+
+    chex_model.init_model(ensure_model(args.model, workdir), class_names=None if args.model else CHEX_CLASSES)
+    classes = list(chex_model._CLASS_NAMES)
+    eager = chex_model._MODEL
+    calib = args.calib or _write_synthetic_dir(os.path.join(workdir, "calib"), args.calib_images, 1000, args.size)
+    src = args.eval or _write_synthetic_dir(os.path.join(workdir, "eval"), args.eval_images, 5000, args.size)
+    batches, labels = _eval_set(src, classes, args.eval_images, args.batch)
+    print(f"[bench] 评估集 {sum(b.shape[0] for b in batches)} 张，标签: {'有' if labels is not None else '无'}")
+
+    rows = []
+    ref_probs: Optional[np.ndarray] = None
+    for precision in args.precisions:
+        model = copy.deepcopy(eager)
+        size_mb = _state_mb(model)
+        try:
+            if precision == "fp32":
+                runner = chex_model._eager_runner(model)
+            elif precision == "int8":
+                qmodel = chex_quant.quantize_int8(model, chex_quant.calibration_batches(calib, args.calib_images))
+                runner, size_mb = chex_quant.int8_runner(qmodel), _state_mb(qmodel)
+            else:
+                runner = chex_quant.build_runner(model, precision)
+        except Exception as e:
+            print(f"[bench] {precision} 跳过：{e}")
+            continue
+
+        probs = np.concatenate([runner(b)[1].float().numpy() for b in batches])
+        ms = _time_it(lambda: runner(batches[0]), args.repeat)
+        row: Dict[str, Any] = {
+            "precision": precision, "batch": int(batches[0].shape[0]),
+            "latency_ms": ms, "images_per_s": batches[0].shape[0] / ms * 1000.0 if ms > 0 else 0.0,
+            "weights_mb": size_mb, "rss_mb": _rss_mb(),
+        }
+        if ref_probs is None:
+            ref_probs = probs
+        delta = np.abs(probs - ref_probs)
+        row["max_prob_delta"] = float(delta.max())
+        row["mean_prob_delta"] = float(delta.mean())
+        if labels is not None:
+            aucs = []
+            for k in range(len(classes)):
+                known = ~np.isnan(labels[:, k])
+                aucs.append(chex_quant.auroc(probs[known, k], labels[known, k]))
+            row["mean_auroc"] = float(np.nanmean(aucs)) if not np.all(np.isnan(aucs)) else float("nan")
+            row["per_class_auroc"] = {c: a for c, a in zip(classes, aucs)}
+        rows.append(row)
+        model = runner = None  # 先释放本精度的模型再复制下一份（不用 del：上面的 lambda 仍引用这些名字）
+
+    cols = ["precision", "batch", "latency_ms", "images_per_s", "weights_mb", "rss_mb", "max_prob_delta", "mean_prob_delta"]
+    if labels is not None:
+        cols.append("mean_auroc")
+    print_table(rows, cols)
+    return rows
+
+
+# ---------------------------
+# 基准：冷启动（每个场景一个全新的解释器进程）
+# ---------------------------
+_STARTUP_PROBE = r"""
+import json, os, sys, time
+cfg = json.loads(sys.argv[1])
+t0 = time.perf_counter()
+if cfg["app"]:
+    os.environ.update(cfg["env"])
+    import app
+    from fastapi.testclient import TestClient
+    t1 = t2 = time.perf_counter()
+    client = TestClient(app.app)
+    data = open(cfg["image"], "rb").read()
+    def request():
+        r = client.post("/api/v1/image/analyze", files={"file": ("x.png", data, "image/png")})
+        r.raise_for_status()
+else:
+    import chex_model
+    t1 = time.perf_counter()
+    chex_model.init_model(cfg["model"], class_names=cfg["classes"], backend=cfg["backend"],
+                          cache_dir=cfg["cache_dir"], warmup=cfg["warmup"])
+    t2 = time.perf_counter()
+    def request():
+        chex_model.infer(cfg["image"], generate_heatmap=True)
+t3 = time.perf_counter()
+request()
+t4 = time.perf_counter()
+request()
+t5 = time.perf_counter()
+print("__RESULT__" + json.dumps({
+    "import_ms": (t1 - t0) * 1000, "load_ms": (t2 - t1) * 1000,
+    "first_request_ms": (t4 - t3) * 1000, "second_request_ms": (t5 - t4) * 1000,
+}))
+"""
+
+
+def _run_probe(cfg: Dict[str, Any]) -> Dict[str, float]:
+    import subprocess
+    import sys
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    t0 = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", _STARTUP_PROBE, json.dumps(cfg)],
+        cwd=here, capture_output=True, text=True, env=dict(os.environ, PYTHONPATH=here),
+    )
+    wall = (time.perf_counter() - t0) * 1000
+    line = next((l for l in out.stdout.splitlines() if l.startswith("__RESULT__")), None)
+    if out.returncode != 0 or line is None:
+        raise RuntimeError(f"启动探针失败：\n{out.stderr[-2000:]}")
+    return dict(json.loads(line[len("__RESULT__"):]), process_ms=wall)
+
+
+def bench_startup(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    path = ensure_model(args.model, workdir)
+    image = os.path.join(workdir, "startup.png")
+    synthetic_xray(args.size, seed=0).save(image)
+    cache_dir = os.path.join(workdir, "model_cache")
+    base = {"model": path, "classes": None if args.model else CHEX_CLASSES, "backend": args.backend,
+            "image": image, "app": False, "env": {}}
+
+    scenarios = [
+        ("no cache", dict(cache_dir=None, warmup=False)),
+        ("no cache + warmup", dict(cache_dir=None, warmup=True)),
+        ("cache miss + warmup", dict(cache_dir=cache_dir, warmup=True)),     # 首次运行，写入产物
+        ("cache hit + warmup", dict(cache_dir=cache_dir, warmup=True)),
+        ("cache hit", dict(cache_dir=cache_dir, warmup=False)),
+    ]
+    if args.app:
+        # 完整的 app 进程：import app（含模型加载与预热）+ 首个 /analyze 请求
+        app_cache = os.path.join(workdir, "app_model_cache")
+        for name, cache in (("app, no cache", ""), ("app, cache miss", app_cache), ("app, cache hit", app_cache)):
+            env = {
+                "MODEL_PATH": path, "CHEX_BACKEND": args.backend, "CHEX_MODEL_CACHE_DIR": cache,
+                "CHEX_STATIC_ROOT": os.path.join(workdir, "static"), "CHEX_DATA_DIR": os.path.join(workdir, "data"),
+            }
+            scenarios.append((name, dict(app=True, env=env)))
+
+    rows = []
+    for name, cfg in scenarios:
+        runs = [_run_probe(dict(base, **cfg)) for _ in range(1 if "miss" in name else args.repeat)]
+        row = {"scenario": name}
+        for key in ("import_ms", "load_ms", "first_request_ms", "second_request_ms", "process_ms"):
+            row[key] = float(np.median([r[key] for r in runs]))
+        rows.append(row)
+
+    print_table(rows, ["scenario", "import_ms", "load_ms", "first_request_ms", "second_request_ms", "process_ms"])
+    return rows
+
+
+# ---------------------------
+# 基准：多 worker 部署（chex_serve）的每 worker 内存与总吞吐
+# ---------------------------
+def _multipart(field: str, filename: str, data: bytes, fields: Dict[str, str]) -> Tuple[bytes, str]:
+    boundary = f"chexbench{os.getpid()}{time.time_ns()}"
+    parts = []
+    for k, v in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n".encode() + data + b"\r\n"
+    )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def _proc_mem_mb(pid: int) -> Tuple[float, float]:
+    """(RSS, PSS)，单位 MB；PSS 把共享页（如 mmap 的权重）按共享进程数均摊。"""
+    rss = pss = 0.0
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith("Rss:"):
+                    rss = int(line.split()[1]) / 1024.0
+                elif line.startswith("Pss:"):
+                    pss = int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return rss, pss
+
+
+def _children(pid: int) -> List[int]:
+    out = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            out.append(int(name))
+    return out
+
+
+def bench_serve(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    import subprocess
+    import sys
+    import urllib.request
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = ensure_model(args.model, workdir)
+    images = [encode_image(synthetic_xray(args.size, seed=i), "PNG") for i in range(8)]
+    fields = {"generate_heatmap": str(args.heatmap).lower()}
+
+    rows = []
+    for n, workers in enumerate(args.workers):
+        port = args.port + n
+        env = dict(
+            os.environ, PYTHONPATH=here, MODEL_PATH=path, CHEX_CACHE_MB="0",
+            CHEX_STATIC_ROOT=os.path.join(workdir, f"static_{workers}"), CHEX_DATA_DIR=os.path.join(workdir, "data"),
+        )
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(here, "chex_serve.py"), "--workers", str(workers),
+             "--port", str(port), "--log-level", "warning"],
+            cwd=here, env=env,
+        )
+        base = f"http://127.0.0.1:{port}"
+        try:
+            # 等待 worker 就绪：首个 /healthz 成功后，再等到见过 workers 个不同 pid（最多 20s，连接分配不保证均匀）
+            pids, deadline = set(), time.time() + args.startup_timeout
+            while len(pids) < workers and time.time() < deadline:
+                try:
+                    with urllib.request.urlopen(base + "/healthz", timeout=2) as r:
+                        pids.add(json.loads(r.read())["pid"])
+                    deadline = min(deadline, time.time() + 20.0)
+                    time.sleep(0.05)
+                except Exception:
+                    time.sleep(0.2)
+            if not pids:
+                raise RuntimeError(f"{workers} worker 启动超时")
+
+            def _call(i: int) -> None:
+                body, ctype = _multipart("file", f"img_{i}.png", images[i % len(images)], fields)
+                req = urllib.request.Request(base + "/api/v1/image/analyze", data=body, headers={"Content-Type": ctype})
+                with urllib.request.urlopen(req, timeout=120) as r:
+                    r.read()
+
+            run_clients(_call, args.clients, max(1, args.requests // args.clients))      # 预热各 worker
+            stats = run_clients(_call, args.clients, max(1, args.requests // args.clients))
+            mems = [_proc_mem_mb(p) for p in _children(server.pid)]
+            mems = [m for m in mems if m[0] > 50] or mems      # 排除 uvicorn 的轻量辅助进程
+            rows.append({
+                "workers": workers, "clients": args.clients, "n": stats["n"],
+                "p50_ms": stats["p50_ms"], "p99_ms": stats["p99_ms"], "images_per_s": stats["images_per_s"],
+                "rss_mb_per_worker": float(np.mean([m[0] for m in mems])) if mems else 0.0,
+                "pss_mb_per_worker": float(np.mean([m[1] for m in mems])) if mems else 0.0,
+                "pss_mb_total": float(sum(m[1] for m in mems)),
+            })
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    print_table(rows, ["workers", "clients", "n", "p50_ms", "p99_ms", "images_per_s",
+                       "rss_mb_per_worker", "pss_mb_per_worker", "pss_mb_total"])
+    return rows
+
+
+# ---------------------------
+# 基准：指标采集开销（CHEX_METRICS 开 / 关）
+# ---------------------------
+def bench_metrics(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    import chex_metrics
+
+    chex_model.init_model(ensure_model(args.model, workdir), class_names=None if args.model else CHEX_CLASSES)
+    images = [encode_image(synthetic_xray(args.size, seed=i), "PNG") for i in range(4)]
+    kw = {"generate_heatmap": args.heatmap}
+    chex_model.infer(images[0], **kw)
+
+    # 交替测量，抵消频率 / 缓存漂移
+    lat: Dict[bool, List[float]] = {True: [], False: []}
+    for k in range(args.requests):
+        for enabled in (k % 2 == 0, k % 2 != 0):
+            chex_metrics.ENABLED = enabled
+            t0 = time.perf_counter()
+            chex_model.infer(images[k % len(images)], **kw)
+            lat[enabled].append(time.perf_counter() - t0)
+    chex_metrics.ENABLED = True
+
+    # 单次 timed() 的成本 × 每个请求的观测次数，给出与噪声无关的上界
+    n_obs = len(chex_model.infer(images[0], **kw).get("timings", {})) + 1   # + batch_size 直方图
+    per_obs_us = _time_it(_observe_once, 20000) * 1000.0
+
+    rows = []
+    for enabled in (False, True):
+        rows.append(dict(metrics="on" if enabled else "off", **summarize(lat[enabled], sum(lat[enabled]))))
+    p50_off = rows[0]["p50_ms"]
+    rows[1]["overhead_%"] = (rows[1]["p50_ms"] - p50_off) / p50_off * 100.0 if p50_off else 0.0
+    rows[1]["bound_%"] = n_obs * per_obs_us / 1000.0 / p50_off * 100.0 if p50_off else 0.0
+    print_table(rows, ["metrics", "n", "p50_ms", "p95_ms", "p99_ms", "overhead_%", "bound_%"])
+    print(f"[bench] 每次观测 {per_obs_us:.2f} us，每请求 {n_obs} 次；render() 长度 {len(chex_metrics.REGISTRY.render())} 字节")
+    return rows
+
+
+def _observe_once() -> None:
+    from chex_metrics import timed
+
+    with timed("bench", {}):
+        pass
+
+
+# ---------------------------
+# 基准：大量慢速上传下服务是否仍然响应（流式接收 + 专用推理线程池）
+# ---------------------------
+def _slow_post(port: int, path: str, body: bytes, ctype: str, chunk: int, delay_s: float,
+               chunked: bool = False, timeout: float = 300.0) -> Tuple[int, float, int]:
+    """按 chunk 字节 / delay_s 的速率发送请求体；服务端提前响应（如 413）时停止发送。返回 (状态码, 秒, 已发送字节)。"""
+    import select
+    import socket
+
+    t0 = time.perf_counter()
+    sent = 0
+    with socket.create_connection(("127.0.0.1", port), timeout=timeout) as sock:
+        head = f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: {ctype}\r\nConnection: close\r\n"
+        head += "Transfer-Encoding: chunked\r\n\r\n" if chunked else f"Content-Length: {len(body)}\r\n\r\n"
+        sock.sendall(head.encode())
+        try:
+            for k in range(0, len(body), chunk):
+                if select.select([sock], [], [], 0)[0]:
+                    break       # 服务端已经给出响应
+                piece = body[k:k + chunk]
+                sock.sendall(b"%x\r\n%s\r\n" % (len(piece), piece) if chunked else piece)
+                sent += len(piece)
+                if delay_s:
+                    time.sleep(delay_s)
+            else:
+                if chunked:
+                    sock.sendall(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        resp = b""
+        try:
+            while b"\r\n" not in resp:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                resp += data
+        except (ConnectionResetError, socket.timeout):
+            pass
+    status = int(resp.split(b" ", 2)[1]) if resp.startswith(b"HTTP/") else 0
+    return status, time.perf_counter() - t0, sent
+
+
+def bench_slow_upload(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    import subprocess
+    import sys
+    import urllib.request
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=here, MODEL_PATH=ensure_model(args.model, workdir), CHEX_CACHE_MB="0",
+               CHEX_STATIC_ROOT=os.path.join(workdir, "static"), CHEX_DATA_DIR=os.path.join(workdir, "data"),
+               CHEX_MAX_UPLOAD_MB=str(args.limit_mb))
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(here, "chex_serve.py"), "--workers", "1", "--port", str(args.port),
+         "--log-level", "warning"],
+        cwd=here, env=env,
+    )
+    base = f"http://127.0.0.1:{args.port}"
+
+    def _get(url: str) -> float:
+        t0 = time.perf_counter()
+        with urllib.request.urlopen(url, timeout=60) as r:
+            r.read()
+        return time.perf_counter() - t0
+
+    # 慢上传的文件：DICOM（约 file_mb 大小，无 pydicom 时用同样大小的 PNG 负载）
+    side = int(np.sqrt(args.file_mb * (1 << 20) / 2))
+    arr = synthetic_xray_array(side)
+    try:
+        big, big_name = synthetic_dicom((arr * 4095).astype(np.uint16)), "big.dcm"
+    except ImportError:
+        big, big_name = encode_image(Image.fromarray((arr * 255).astype(np.uint8)), "PNG", compress_level=0), "big.png"
+    small = encode_image(synthetic_xray(args.size), "PNG")
+    big_body, big_ctype = _multipart("file", big_name, big, {"generate_heatmap": "false"})
+    small_body, small_ctype = _multipart("file", "small.png", small, {"generate_heatmap": "false"})
+
+    def _probe(stop: threading.Event, out: List[float], analyze: List[float]) -> None:
+        while not stop.is_set():
+            out.append(_get(base + "/healthz"))
+            t0 = time.perf_counter()
+            req = urllib.request.Request(base + "/api/v1/image/analyze", data=small_body, headers={"Content-Type": small_ctype})
+            with urllib.request.urlopen(req, timeout=120) as r:
+                r.read()
+            analyze.append(time.perf_counter() - t0)
+            time.sleep(0.05)
+
+    rows = []
+    try:
+        deadline = time.time() + args.startup_timeout
+        while True:
+            try:
+                _get(base + "/healthz")
+                break
+            except Exception:
+                if time.time() > deadline or server.poll() is not None:
+                    raise RuntimeError("服务启动失败或超时")
+                time.sleep(0.2)
+
+        # 空闲基线
+        health: List[float] = []
+        analyze: List[float] = []
+        stop = threading.Event()
+        t = threading.Thread(target=_probe, args=(stop, health, analyze))
+        t.start()
+        time.sleep(3.0)
+        stop.set()
+        t.join()
+        rows.append({"scenario": "idle", "uploads": 0,
+                     "healthz_p50_ms": summarize(health, 1)["p50_ms"], "healthz_p99_ms": summarize(health, 1)["p99_ms"],
+                     "analyze_p50_ms": summarize(analyze, 1)["p50_ms"], "analyze_p99_ms": summarize(analyze, 1)["p99_ms"]})
+
+        # N 个慢客户端同时上传大文件，期间持续探测
+        health, analyze = [], []
+        stop = threading.Event()
+        t = threading.Thread(target=_probe, args=(stop, health, analyze))
+        t.start()
+        with ThreadPoolExecutor(args.clients) as pool:
+            futs = [pool.submit(_slow_post, args.port, "/api/v1/image/analyze", big_body, big_ctype,
+                                args.chunk_kb << 10, args.delay_ms / 1000.0) for _ in range(args.clients)]
+            results = [f.result() for f in futs]
+        stop.set()
+        t.join()
+        ok = sum(1 for r in results if r[0] == 200)
+        rows.append({"scenario": f"{args.clients} slow uploads", "uploads": ok,
+                     "upload_s": float(np.mean([r[1] for r in results])),
+                     "healthz_p50_ms": summarize(health, 1)["p50_ms"], "healthz_p99_ms": summarize(health, 1)["p99_ms"],
+                     "analyze_p50_ms": summarize(analyze, 1)["p50_ms"], "analyze_p99_ms": summarize(analyze, 1)["p99_ms"]})
+
+        # 超限：无 Content-Length 的分块上传，服务端应在越过上限时立即 413
+        over = np.random.default_rng(0).integers(0, 255, size=(args.limit_mb + 8) << 20, dtype=np.uint8).tobytes()
+        over_body, over_ctype = _multipart("file", "over.dcm", b"\0" * 128 + b"DICM" + over, {})
+        status, secs, sent = _slow_post(args.port, "/api/v1/image/analyze", over_body, over_ctype,
+                                        args.chunk_kb << 10, 0.0, chunked=True)
+        rows.append({"scenario": f"oversize ({len(over_body) >> 20} MB, limit {args.limit_mb} MB)", "status": status,
+                     "upload_s": secs, "sent_mb": sent / float(1 << 20)})
+        # 类型不符：文件头到达即拒绝
+        bad_body, bad_ctype = _multipart("file", "fake.png", b"not an image" * (1 << 16), {})
+        status, secs, sent = _slow_post(args.port, "/api/v1/image/analyze", bad_body, bad_ctype,
+                                        args.chunk_kb << 10, args.delay_ms / 1000.0)
+        rows.append({"scenario": "bad magic bytes", "status": status, "upload_s": secs, "sent_mb": sent / float(1 << 20)})
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    print_table(rows, ["scenario", "uploads", "status", "upload_s", "sent_mb",
+                       "healthz_p50_ms", "healthz_p99_ms", "analyze_p50_ms", "analyze_p99_ms"])
+    return rows
+
+
+# ---------------------------
+# 基准：TTA / 多模型集成（视图堆叠为一个 batch vs 逐视图、逐模型顺序前向）
+# ---------------------------
+def bench_ensemble(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_ensemble import EnsembleRunner, ModelRegistry
+
+    device = torch.device("cpu")
+    paths = [make_checkpoint(os.path.join(workdir, f"member_{m}.pth"), seed=m) for m in range(max(args.models))]
+    registry = ModelRegistry(CHEX_CLASSES, device)
+    for path in paths:
+        registry.load(path)
+
+    rows = []
+    for batch in args.batch:
+        x = torch.rand(batch, 3, 224, 224, generator=torch.Generator().manual_seed(0))
+        base_ms = None
+        for n_models in args.models:
+            sub = ModelRegistry(CHEX_CLASSES, device)
+            sub.members = registry.members[:n_models]
+            for views in ((), ("flip",), ("flip", "crops")):
+                ens = EnsembleRunner(sub, views)
+                stacked_views, _ = ens.expand(x)
+                chunks = stacked_views.split(batch)
+
+                def _sequential() -> torch.Tensor:
+                    probs = 0
+                    for m in sub.members:
+                        for chunk in chunks:
+                            probs = probs + m.runner(chunk)[1]
+                    return probs / (len(sub.members) * len(chunks))
+
+                stacked_ms = _time_it(lambda: ens(x), args.repeat)
+                seq_ms = _time_it(_sequential, args.repeat)
+                diff = float((ens(x)[1] - _sequential()).abs().max())
+                units = n_models * ens.num_views()
+                if units == 1:
+                    base_ms = stacked_ms
+                rows.append({
+                    "batch": batch, "models": n_models, "views": "+".join(("orig",) + ens.views),
+                    "forwards": units, "stacked_ms": stacked_ms, "sequential_ms": seq_ms,
+                    "speedup": seq_ms / stacked_ms if stacked_ms else 0.0,
+                    "ms_per_extra": (stacked_ms - base_ms) / (units - 1) if units > 1 and base_ms else None,
+                    "max_prob_diff": diff,
+                })
+    print_table(rows, ["batch", "models", "views", "forwards", "stacked_ms", "sequential_ms", "speedup",
+                       "ms_per_extra", "max_prob_diff"])
+    return rows
+
+
+# ---------------------------
+# 基准：分诊模式（阴性图暂缓 CAM / 叠加，按需由缓存的特征图补算）
+# ---------------------------
+def bench_triage(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    chex_model.init_model(ensure_model(args.model, workdir), class_names=None if args.model else CHEX_CLASSES)
+    images = [encode_image(synthetic_xray(args.size, seed=i, height=int(args.size * 1.2)), "JPEG", quality=90)
+              for i in range(args.images)]
+
+    def _run_all(**kw: Any) -> List[Dict[str, Any]]:
+        outs: List[Dict[str, Any]] = []
+        for k in range(0, len(images), args.batch):
+            outs += chex_model.infer_batch(images[k:k + args.batch], **kw)
+        return outs
+
+    # 随机权重没有真实的阴性 / 阳性：按分诊分数的分位数选 heatmap_min_prob，使阳性比例等于 --positive-rates
+    classes = chex_model._CLASS_NAMES
+    probs = np.array([[o["probs"][c] for c in classes] for o in _run_all(generate_heatmap=False)], dtype=np.float32)
+    ranked = np.sort(chex_model.triage_scores(probs))[::-1]
+
+    full_ms = _time_it(lambda: _run_all(generate_heatmap=True), args.repeat)
+    cls_ms = _time_it(lambda: _run_all(generate_heatmap=False), args.repeat)
+    n = len(images)
+    rows = [
+        {"mode": "full", "positive_rate": 1.0, "heatmaps": n, "images_per_s": n / full_ms * 1000.0,
+         "ms_per_image": full_ms / n, "speedup_vs_full": 1.0},
+        {"mode": "classify-only", "positive_rate": 0.0, "heatmaps": 0, "images_per_s": n / cls_ms * 1000.0,
+         "ms_per_image": cls_ms / n, "speedup_vs_full": full_ms / cls_ms},
+    ]
+    for rate in args.positive_rates:
+        k = int(round(rate * n))
+        min_prob = float(ranked[k - 1]) if k > 0 else float(ranked[0]) + 1e-3
+        kw = dict(generate_heatmap=True, heatmap_min_prob=min_prob, return_features=True)
+        triage_ms = _time_it(lambda: _run_all(**kw), args.repeat)
+        outs = _run_all(**kw)
+        deferred = [i for i, o in enumerate(outs) if o.get("heatmap_deferred")]
+
+        # 按需补算：缓存特征 -> CAM + 叠加，对比整张图重新推理；CAM 网格与完整推理的一致性（特征以 float16 缓存）
+        lazy_ms = rerun_ms = diff = feature_kb = None
+        if deferred:
+            sample = deferred[:args.lazy_samples]
+            lazy_ms = _time_it(lambda: [chex_model.infer_features(outs[i]["features"], probs[i], images[i])
+                                        for i in sample], args.repeat) / len(sample)
+            rerun_ms = _time_it(lambda: [chex_model.infer(images[i]) for i in sample], args.repeat) / len(sample)
+            i = sample[0]
+            lazy = chex_model.infer_features(outs[i]["features"], probs[i], image_size=outs[i]["image_size"],
+                                             heatmap_mode="grid")["cam_grid"]
+            diff = float(np.abs(lazy - chex_model.infer(images[i], heatmap_mode="grid")["cam_grid"]).max())
+            feats = outs[i]["features"]
+            feature_kb = feats.numel() * feats.element_size() / 1024.0
+        rows.append({
+            "mode": "triage", "positive_rate": rate, "heatmaps": n - len(deferred),
+            "images_per_s": n / triage_ms * 1000.0, "ms_per_image": triage_ms / n,
+            "speedup_vs_full": full_ms / triage_ms, "lazy_ms": lazy_ms, "rerun_ms": rerun_ms,
+            "cam_max_diff": diff, "feature_kb": feature_kb,
+        })
+    print_table(rows, ["mode", "positive_rate", "heatmaps", "images_per_s", "ms_per_image", "speedup_vs_full",
+                       "lazy_ms", "rerun_ms", "cam_max_diff", "feature_kb"])
+    return rows
+
+
+# ---------------------------
+# 基准：产物查找（目录扫描 vs 清单索引）与保留策略清理
+# ---------------------------
+def bench_artifacts(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_store import ArtifactStore
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for n in args.counts:
+        root = os.path.join(workdir, f"artifacts_{n}")
+        store = ArtifactStore(root, os.path.join(root, "artifacts.sqlite3"), shard=True,
+                              max_bytes=int(n * 0.9) * 1024)
+        rids = [f"{i:032x}" for i in range(n)]
+        now = time.time()
+
+        # 登记 n 个请求的热力图（每个 1KB，created 递增）；文件本身不创建，只测索引
+        t0 = time.perf_counter()
+        for k in range(0, n, 100000):
+            store.add_many([(rid, "heatmap", store.place("heatmaps", rid, "png"), 1024, now - n + k + j)
+                            for j, rid in enumerate(rids[k:k + 100000])])
+        insert_s = time.perf_counter() - t0
+
+        picks = [rids[i] for i in rng.integers(0, n, args.lookups)]
+        t0 = time.perf_counter()
+        for rid in picks:
+            assert store.lookup(rid)
+        lookup_us = (time.perf_counter() - t0) / len(picks) * 1e6
+
+        # 旧 /predict：每次 os.listdir 整个热力图目录并按后缀过滤（只在 n <= --scan-max 时真的建文件）
+        scan_ms = None
+        if n <= args.scan_max:
+            flat = os.path.join(root, "flat")
+            os.makedirs(flat)
+            for rid in rids:
+                open(os.path.join(flat, f"{rid}_Edema_heatmap.jpg"), "wb").close()
+            scan_ms = _time_it(lambda: [f for f in os.listdir(flat) if f.endswith("_heatmap.jpg")], args.repeat)
+
+        # 容量上限为 90%：一次 GC 删除最旧的 10%
+        t0 = time.perf_counter()
+        removed = store.gc()["oversize"]
+        gc_s = time.perf_counter() - t0
+        rows.append({
+            "artifacts": n, "insert_s": insert_s, "index_lookup_us": lookup_us, "dir_scan_ms": scan_ms,
+            "gc_removed": removed, "gc_s": gc_s,
+            "index_mb": os.path.getsize(os.path.join(root, "artifacts.sqlite3")) / float(1 << 20),
+        })
+        store.stop()
+        shutil.rmtree(root, ignore_errors=True)
+    print_table(rows, ["artifacts", "insert_s", "index_lookup_us", "dir_scan_ms", "gc_removed", "gc_s", "index_mb"])
+    return rows
+
+
+# ---------------------------
+# 基准：过载下的准入控制（开环到达，按通道统计延迟与拒绝）
+# ---------------------------
+def bench_admission(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    import urllib.error
+    import urllib.request
+
+    model_path = ensure_model(args.model, workdir)
+    image = encode_image(synthetic_xray(args.size), "JPEG", quality=90)
+    body, ctype = _multipart("file", "x.jpg", image, {"generate_heatmap": "true"})
+    mix = {}
+    for part in args.mix:
+        lane, frac = part.split("=", 1)
+        mix[lane] = float(frac)
+    lanes, weights = list(mix), np.asarray(list(mix.values())) / sum(mix.values())
+
+    def _post(base: str, lane: str) -> Tuple[int, float]:
+        req = urllib.request.Request(base + "/api/v1/image/analyze", data=body,
+                                     headers={"Content-Type": ctype, "X-Priority": lane})
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=300) as r:
+                r.read()
+                code = r.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            code = e.code
+        return code, time.perf_counter() - t0
+
+    rows = []
+    capacity = None
+    for mode in args.modes:
+        env = {"CHEX_ADMISSION": "1" if mode == "admission" else "0",
+               "CHEX_ANALYZE_WORKERS": str(args.inflight), "CHEX_MAX_QUEUE": str(args.max_queue)}
+        base, server = _start_serve(os.path.join(workdir, mode), model_path, args.port, 1, args.startup_timeout, **env)
+        try:
+            # 容量：inflight 个客户端闭环压测的吞吐（只测一次，两种模式用同一到达率）
+            if capacity is None:
+                stats = run_clients(lambda i: _post(base, "routine"), args.inflight, args.calib_requests)
+                capacity = stats["images_per_s"]
+            rate = capacity * args.overload
+            rng = np.random.default_rng(0)
+            n = int(rate * args.duration)
+            arrivals = np.cumsum(rng.exponential(1.0 / rate, n))
+            picks = rng.choice(len(lanes), size=n, p=weights)
+            results: List[Tuple[str, int, float]] = []
+            lock = threading.Lock()
+
+            def _fire(lane: str) -> None:
+                code, dt = _post(base, lane)
+                with lock:
+                    results.append((lane, code, dt))
+
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.max_clients) as pool:
+                for at, li in zip(arrivals, picks):
+                    delay = t0 + at - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    pool.submit(_fire, lanes[li])
+            wall = time.perf_counter() - t0
+        finally:
+            _stop_serve(server)
+
+        for lane in lanes:
+            mine = [(c, dt) for l, c, dt in results if l == lane]
+            ok = [dt for c, dt in mine if c == 200]
+            rejected = [dt for c, dt in mine if c in (429, 503)]
+            lat = summarize(ok, wall) if ok else {}
+            rows.append({
+                "mode": mode, "lane": lane, "offered_rps": rate * mix[lane] / sum(mix.values()),
+                "sent": len(mine), "ok": len(ok),
+                "r429": sum(1 for c, _ in mine if c == 429), "r503": sum(1 for c, _ in mine if c == 503),
+                "other": sum(1 for c, _ in mine if c not in (200, 429, 503)),
+                "p50_ms": lat.get("p50_ms"), "p99_ms": lat.get("p99_ms"),
+                "reject_p99_ms": float(np.percentile(np.asarray(rejected) * 1000.0, 99)) if rejected else None,
+                "goodput_rps": len(ok) / wall if wall else 0.0,
+            })
+    print(f"容量（闭环 {args.inflight} 并发）≈ {capacity:.2f} req/s，开环到达率 = {args.overload:g} x 容量")
+    print_table(rows, ["mode", "lane", "offered_rps", "sent", "ok", "r429", "r503", "other", "p50_ms", "p99_ms",
+                       "reject_p99_ms", "goodput_rps"])
+    return rows
+
+
+# ---------------------------
+# 基准：相似病例检索（chex_similar）
+# ---------------------------
+def synthetic_embeddings(n: int, dim: int = 1024, seed: int = 0, chunk: int = 65536):
+    """分块生成 L2 归一化的合成嵌入：低维潜变量经随机投影 + ReLU + 噪声（与真实池化特征一样本征维度低）。"""
+    rng = np.random.default_rng(seed)
+    proj = rng.standard_normal((48, dim)).astype(np.float32)
+    for s in range(0, n, chunk):
+        m = min(chunk, n - s)
+        x = np.maximum(rng.standard_normal((m, 48)).astype(np.float32) @ proj, 0)
+        x += 0.3 * rng.standard_normal((m, dim)).astype(np.float32)
+        yield x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def _rss_file_mb() -> float:
+    """本进程已映射且驻留的文件页（/proc/self/status RssFile）；非 Linux 返回 0。"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("RssFile:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return 0.0
+
+
+def bench_similar(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    import math
+
+    from chex_similar import EmbeddingIndex
+
+    rows = []
+    for n in args.sizes:
+        base = os.path.join(workdir, f"similar-{n}", "flat")
+        flat = EmbeddingIndex(base, dim=args.dim, train_size=0)
+        t0 = time.perf_counter()
+        for s, x in zip(range(0, n, 65536), synthetic_embeddings(n, args.dim)):
+            flat.add_many(range(s, s + len(x)), x)
+        print(f"[bench] {n} 条向量写入 {time.perf_counter() - t0:.1f} s")
+        # 查询：库中随机向量加小扰动
+        rng = np.random.default_rng(1)
+        q = np.asarray(flat.vectors[np.sort(rng.choice(n, args.queries, replace=False))], dtype=np.float32)
+        q += 0.05 * rng.standard_normal(q.shape).astype(np.float32)
+        q /= np.linalg.norm(q, axis=1, keepdims=True)
+
+        nlist = args.nlist or 2 ** int(round(math.log2(math.sqrt(n))))
+        configs = [(0, 0, 1)] + [(nlist, 0, p) for p in args.nprobe] + [(0, args.pq_m, 1)] \
+            + [(nlist, args.pq_m, p) for p in args.nprobe]
+        truth = None
+        for nl, m, nprobe in configs:
+            root = base if not (nl or m) else os.path.join(workdir, f"similar-{n}", f"ivf{nl}-pq{m}")
+            if not os.path.exists(root):
+                # 原始向量只追加、训练不改动：硬链接共享，不必复制
+                os.makedirs(root)
+                for name in ("vectors.f16", "ids.i64"):
+                    os.link(os.path.join(base, name), os.path.join(root, name))
+            index = EmbeddingIndex(root, dim=args.dim, nlist=nl, pq_m=m, nprobe=nprobe, train_size=0)
+            t0 = time.perf_counter()
+            trained = (nl or m) and not index.meta["trained"]
+            if trained:
+                index.train()
+            train_s = time.perf_counter() - t0 if trained else None
+
+            rss0 = _rss_file_mb()
+            lat = []
+            for i in range(len(q)):
+                t0 = time.perf_counter()
+                index.search(q[i], k=args.k)
+                lat.append((time.perf_counter() - t0) * 1000.0)
+            batched = _time_it(lambda: index.search(q, k=args.k), 1) / len(q)
+            resident = _rss_file_mb() - rss0
+            found = [[key for key, _ in hits] for hits in index.search(q, k=args.k)]
+            truth = truth or found
+            stats = index.stats()
+            rows.append({
+                "vectors": n,
+                "index": "fp16 flat" if not (nl or m) else "+".join(
+                    ([f"ivf{nl}/{nprobe}"] if nl else []) + ([f"pq{m}"] if m else [])),
+                "train_s": train_s,
+                "p50_ms": float(np.percentile(lat, 50)),
+                "p95_ms": float(np.percentile(lat, 95)),
+                "batched_ms": batched,
+                f"recall@{args.k}": float(np.mean([len(set(a) & set(b)) / args.k for a, b in zip(found, truth)])),
+                "resident_mb": resident,
+                "scan_mb": sum(v for f, v in stats["bytes"].items() if f != "vectors.f16" or not m) / 2 ** 20,
+                "disk_mb": sum(stats["bytes"].values()) / 2 ** 20,
+            })
+            index = None  # 释放 memmap，之后才能删除目录
+        flat = None
+        shutil.rmtree(os.path.join(workdir, f"similar-{n}"), ignore_errors=True)
+    print_table(rows, ["vectors", "index", "train_s", "p50_ms", "p95_ms", "batched_ms", f"recall@{args.k}",
+                       "resident_mb", "scan_mb", "disk_mb"])
+    print("batched_ms：一次 search 处理全部查询时摊到每个查询的耗时；resident_mb：查询期间新映射驻留的文件页；"
+          "scan_mb：检索需要常驻的数据量（PQ 时原始向量只在重排时按行读取）")
+    return rows
+
+
+# ---------------------------
+# 回归基准套件：analyze（PNG / JPEG / DICOM，± 热力图）与历史分页，进程内 TestClient 与本地 uvicorn
+# ---------------------------
+def _peak_rss_mb(pid: Any = "self") -> float:
+    """进程生命周期内的峰值常驻内存（VmHWM，MB）；不可用时为 0。"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return 0.0
+
+
+def _suite_inputs(size: int) -> Dict[str, List[Tuple[str, bytes]]]:
+    """各格式 4 张不同的合成图（结果缓存已关闭，同图重复也会真正推理）。"""
+    inputs: Dict[str, List[Tuple[str, bytes]]] = {"png": [], "jpeg": [], "dicom": []}
+    for i in range(4):
+        arr = synthetic_xray_array(size, seed=i)
+        pil = Image.fromarray((arr * 255).astype(np.uint8), mode="L")
+        inputs["png"].append((f"img_{i}.png", encode_image(pil, "PNG")))
+        inputs["jpeg"].append((f"img_{i}.jpg", encode_image(pil, "JPEG", quality=90)))
+        try:
+            inputs["dicom"].append((f"img_{i}.dcm", synthetic_dicom((arr * 4095).astype(np.uint16))))
+        except ImportError:     # 未安装 pydicom 时跳过 DICOM 场景
+            pass
+    return inputs
+
+
+def _suite_scenarios(inputs: Dict[str, List[Tuple[str, bytes]]], history_rows: int) -> Dict[str, Dict[str, Any]]:
+    """场景名 -> {method, path, inputs（上传文件列表或 None）, fields（表单或查询参数）}。"""
+    analyze = "/api/v1/image/analyze"
+    scenarios = {
+        "analyze_png_heatmap": {"inputs": inputs["png"], "fields": {"generate_heatmap": "true"}},
+        "analyze_png_noheatmap": {"inputs": inputs["png"], "fields": {"generate_heatmap": "false"}},
+        "analyze_jpeg_heatmap": {"inputs": inputs["jpeg"], "fields": {"generate_heatmap": "true"}},
+        "analyze_dicom_noheatmap": {"inputs": inputs["dicom"], "fields": {"generate_heatmap": "false"}},
+    }
+    for sc in scenarios.values():
+        sc.update(method="POST", path=analyze)
+    history = {
+        "history_page1": {"page": "1", "page_size": "20"},
+        "history_deep_cursor": {"page_size": "20", "before_id": str(max(1, history_rows // 2))},
+        "history_filter_diagnosis": {"page": "1", "page_size": "20", "diagnosis": "Edema"},
+    }
+    for name, params in history.items():
+        scenarios[name] = {"method": "GET", "path": "/api/v1/history", "inputs": None, "fields": params}
+    return {k: v for k, v in scenarios.items() if v["inputs"] is None or v["inputs"]}
+
+
+def _inproc_caller(workdir: str, model_path: str) -> Tuple[Callable[[Dict[str, Any], int], None], Callable[[], float], Callable[[], None]]:
+    from fastapi.testclient import TestClient
+
+    app = _load_app(model_path, os.path.join(workdir, "inproc"), 16)
+    client = TestClient(app.app)
+
+    def call(sc: Dict[str, Any], i: int) -> None:
+        if sc["inputs"] is None:
+            resp = client.get(sc["path"], params=sc["fields"])
+        else:
+            name, data = sc["inputs"][i % len(sc["inputs"])]
+            resp = client.post(sc["path"], files={"file": (name, data, "application/octet-stream")}, data=sc["fields"])
+        resp.raise_for_status()
+
+    return call, _peak_rss_mb, lambda: app._WRITER.shutdown(wait=True)
+
+
+def _start_serve(root: str, model_path: str, port: int, workers: int, timeout: float, **env: str):
+    """在 root 下启动 chex_serve（uvicorn），等 /healthz 就绪后返回 (base_url, 进程)。"""
+    import subprocess
+    import sys
+    import urllib.request
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=here, MODEL_PATH=model_path, CHEX_CACHE_MB="0",
+               CHEX_STATIC_ROOT=os.path.join(root, "static"), CHEX_DATA_DIR=os.path.join(root, "data"), **env)
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(here, "chex_serve.py"), "--workers", str(workers),
+         "--port", str(port), "--log-level", "warning"],
+        cwd=here, env=env,
+    )
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(base + "/healthz", timeout=2) as r:
+                r.read()
+            return base, server
+        except Exception:
+            if time.time() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError("uvicorn 启动失败或超时")
+            time.sleep(0.2)
+
+
+def _stop_serve(server) -> None:
+    import subprocess
+
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def _http_caller(workdir: str, model_path: str, port: int, workers: int, timeout: float):
+    import urllib.parse
+    import urllib.request
+
+    base, server = _start_serve(os.path.join(workdir, "http"), model_path, port, workers, timeout)
+
+    def call(sc: Dict[str, Any], i: int) -> None:
+        if sc["inputs"] is None:
+            req = urllib.request.Request(f"{base}{sc['path']}?{urllib.parse.urlencode(sc['fields'])}")
+        else:
+            name, data = sc["inputs"][i % len(sc["inputs"])]
+            body, ctype = _multipart("file", name, data, sc["fields"])
+            req = urllib.request.Request(base + sc["path"], data=body, headers={"Content-Type": ctype})
+        with urllib.request.urlopen(req, timeout=120) as r:
+            r.read()
+
+    def peak() -> float:
+        return max([_peak_rss_mb(p) for p in _children(server.pid)] or [0.0])
+
+    def close() -> None:
+        _stop_serve(server)
+
+    return call, peak, close
+
+
+# 回归判定：(字段, 方向) —— +1 表示越大越差
+_REGRESSION_KEYS = (("p95_ms", +1), ("p99_ms", +1), ("req_per_s", -1), ("peak_rss_mb", +1))
+
+
+def compare_baseline(rows: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float,
+                     mem_tolerance: float) -> List[Dict[str, Any]]:
+    """按 (transport, scenario, clients) 对齐基线，在 rows 上就地添加 vs_base_* 与 regression 字段。"""
+    index = {(b["transport"], b["scenario"], b["clients"]): b for b in baseline}
+    for r in rows:
+        base = index.get((r["transport"], r["scenario"], r["clients"]))
+        if base is None:
+            r["regression"] = ""
+            continue
+        bad = []
+        for key, sign in _REGRESSION_KEYS:
+            old, new = float(base.get(key) or 0.0), float(r.get(key) or 0.0)
+            if old <= 0:
+                continue
+            change = (new - old) / old
+            r[f"vs_base_{key}_%"] = change * 100.0
+            if sign * change > (mem_tolerance if key == "peak_rss_mb" else tolerance):
+                bad.append(key)
+        r["regression"] = ",".join(bad)
+    return rows
+
+
+def bench_suite(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_history import HistoryStore
+
+    model_path = ensure_model(args.model, workdir)
+    inputs = _suite_inputs(args.size)
+    scenarios = _suite_scenarios(inputs, args.history_rows)
+    if args.scenarios:
+        scenarios = {k: v for k, v in scenarios.items() if k in args.scenarios}
+
+    rows: List[Dict[str, Any]] = []
+    for t, transport in enumerate(args.transports):
+        # 历史库在应用启动前预先写入，两种传输方式各用一份数据目录
+        data_dir = os.path.join(workdir, transport, "data")
+        os.makedirs(data_dir, exist_ok=True)
+        HistoryStore(os.path.join(data_dir, "analysis_history.sqlite3")).extend(synthetic_history(args.history_rows))
+        if transport == "inproc":
+            call, peak, close = _inproc_caller(workdir, model_path)
+        elif transport == "http":
+            call, peak, close = _http_caller(workdir, model_path, args.port + t, args.workers, args.startup_timeout)
+        else:
+            raise ValueError(f"未知 transport: {transport}")
+        try:
+            for name, sc in scenarios.items():
+                for clients in args.clients:
+                    run_clients(lambda i: call(sc, i), clients, 2)      # 预热
+                    stats = run_clients(lambda i: call(sc, i), clients, max(1, args.requests // clients))
+                    rows.append({
+                        "transport": transport, "scenario": name, "clients": clients, "n": stats["n"],
+                        "p50_ms": stats["p50_ms"], "p95_ms": stats["p95_ms"], "p99_ms": stats["p99_ms"],
+                        "req_per_s": stats["images_per_s"], "peak_rss_mb": peak(),
+                    })
+        finally:
+            close()
+
+    columns = ["transport", "scenario", "clients", "n", "p50_ms", "p95_ms", "p99_ms", "req_per_s", "peak_rss_mb"]
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+        print(f"[bench] 已保存基线 {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            compare_baseline(rows, json.load(f), args.tolerance, args.mem_tolerance)
+        columns += ["vs_base_p95_ms_%", "vs_base_req_per_s_%", "regression"]
+    print_table(rows, columns)
+    bad = [r for r in rows if r.get("regression")]
+    if bad:
+        print(f"[bench] {len(bad)} 个场景超出基线容差（延迟 / 吞吐 ±{args.tolerance:.0%}，内存 +{args.mem_tolerance:.0%}）")
+    return rows
+
+
+# ---------------------------
+# 基准：热力图叠加 + 编码（旧的 float64 全尺寸混合 vs uint8 定点 / 限制分辨率 / 只返回 CAM 网格）
+# ---------------------------
+def _legacy_overlay(cam: np.ndarray, base: np.ndarray, alpha: float) -> np.ndarray:
+    """重构前 chex_model._render_heatmap。"""
+    import cv2
+    orig_h, orig_w = base.shape[:2]
+    cam_resized = cv2.resize(cam, (orig_w, orig_h))
+    cam_u8 = (cam_resized * 255).astype(np.uint8)
+    if base.ndim == 2:
+        base = cv2.cvtColor(base, cv2.COLOR_GRAY2RGB)
+    color = cv2.applyColorMap(cam_u8, cv2.COLORMAP_JET)
+    color = cv2.cvtColor(color, cv2.COLOR_BGR2RGB)
+    return (alpha * color + (1 - alpha) * base).astype(np.uint8)
+
+
+def bench_overlay(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from chex_overlay import cam_grid_payload, render_overlay
+    from chex_persist import encode_heatmap
+
+    base = (synthetic_xray_array(args.width, args.height) * 255).astype(np.uint8)
+    rng = np.random.default_rng(0)
+    cam = rng.random((7, 7)).astype(np.float32)
+    fmt = args.format
+
+    def _encode(arr: np.ndarray) -> int:
+        return len(encode_heatmap(Image.fromarray(arr), fmt)) if args.encode else 0
+
+    variants = {
+        "legacy float64": lambda: _encode(_legacy_overlay(cam, base, 0.45)),
+        "uint8 full": lambda: _encode(render_overlay(cam, base, 0.45)),
+        f"uint8 max_side={args.max_side}": lambda: _encode(render_overlay(cam, base, 0.45, args.max_side)),
+        "cam grid (json)": lambda: len(json.dumps(cam_grid_payload(cam, 0.45, (args.width, args.height)))),
+    }
+    ref = _legacy_overlay(cam, base, 0.45).astype(np.int16)
+    diff = int(np.abs(render_overlay(cam, base, 0.45).astype(np.int16) - ref).max())
+
+    rows = []
+    for name, fn in variants.items():
+        nbytes, peak = _peak_mem(fn)
+        rows.append({"variant": name, "ms": _time_it(fn, args.repeat), "peak_mb": peak,
+                     "output_kb": nbytes / 1024.0})
+    print_table(rows, ["variant", "ms", "peak_mb", "output_kb"])
+    print(f"[bench] {args.width}x{args.height}，编码={fmt if args.encode else '-'}；uint8 与旧实现逐像素最大差 {diff}")
+    return rows
+
+
+# ---------------------------
+# 命令行
+# ---------------------------
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="CheXpert 推理基准测试")
+    parser.add_argument("--model", type=str, default=None, help="权重路径；缺省时生成随机权重")
+    parser.add_argument("--json", type=str, default=None, help="结果另存为 JSON")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("batching", help="微批调度 vs 单张推理：p50/p99 延迟与吞吐")
+    p.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    p.add_argument("--requests", type=int, default=16, help="每个客户端的请求数")
+    p.add_argument("--size", type=int, default=1024, help="合成图片边长")
+    p.add_argument("--heatmap", action="store_true", help="同时生成热力图")
+    p.add_argument("--max-batch-size", type=int, default=16)
+    p.add_argument("--max-wait-ms", type=float, default=10.0)
+    p.set_defaults(func=bench_batching)
+
+    p = sub.add_parser("stress", help="并发压测：校验每个热力图都属于自己的图片")
+    p.add_argument("--images", type=int, default=16, help="不同图片的数量")
+    p.add_argument("--requests", type=int, default=256, help="总请求数")
+    p.add_argument("--clients", type=int, default=32)
+    p.add_argument("--workers", type=int, default=4, help="BatchingEngine 推理线程数")
+    p.add_argument("--size", type=int, default=512)
+    p.add_argument("--tolerance", type=int, default=2, help="允许的逐像素最大差值（批量前向有浮点误差）")
+    p.add_argument("--max-batch-size", type=int, default=8)
+    p.add_argument("--max-wait-ms", type=float, default=5.0)
+    p.set_defaults(func=bench_stress)
+
+    p = sub.add_parser("cam", help="CAM 微基准：逐类循环 vs 批量 einsum")
+    p.add_argument("--positives", type=int, nargs="+", default=[1, 5, 14])
+    p.add_argument("--batch", type=int, nargs="+", default=[1, 8])
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_cam)
+
+    p = sub.add_parser("preprocess", help="前处理：大尺寸 PNG/JPEG/DICOM 解码 + 缩放 + 归一化")
+    p.add_argument("--width", type=int, default=2500)
+    p.add_argument("--height", type=int, default=3000)
+    p.add_argument("--repeat", type=int, default=10)
+    p.set_defaults(func=bench_preprocess)
+
+    p = sub.add_parser("dicom", help="DICOM：流式读取 + 窗宽窗位 vs 旧实现（延迟与峰值内存）")
+    p.add_argument("--width", type=int, default=2500)
+    p.add_argument("--height", type=int, default=3000)
+    p.add_argument("--max-side", type=int, nargs="+", default=[0, 2048, 448], help="0 表示不降采样")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_dicom)
+
+    p = sub.add_parser("history", help="历史记录：JSONL 全量扫描 vs SQLite 索引分页")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--page-size", type=int, default=10)
+    p.add_argument("--repeat", type=int, default=50)
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser("history-stats", help="历史统计：增量聚合表 vs 全量扫描聚合，以及写入开销")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_history_stats)
+
+    p = sub.add_parser("persist", help="落盘阶段：同步 PNG 重编码 vs 后台写入（请求侧延迟）")
+    p.add_argument("--width", type=int, default=2500)
+    p.add_argument("--height", type=int, default=3000)
+    p.add_argument("--requests", type=int, default=20)
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--max-pending", type=int, default=64)
+    p.add_argument("--formats", nargs="+", default=["png", "jpeg", "webp"])
+    p.add_argument("--heatmap-max-side", type=int, default=0)
+    p.set_defaults(func=bench_persist)
+
+    p = sub.add_parser("analyze-batch", help="接口吞吐：N 次 /analyze vs 一次 /analyze_batch")
+    p.add_argument("--images", type=int, default=16)
+    p.add_argument("--batch-size", type=int, default=8)
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--heatmap", action="store_true", help="同时生成热力图")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_analyze_batch)
+
+    p = sub.add_parser("backends", help="推理后端：延迟 / 吞吐，以及与 eager 的概率与 CAM 一致性")
+    p.add_argument("--backends", nargs="+", default=["eager", "torchscript", "compile", "onnx"])
+    p.add_argument("--no-optimizations", dest="optimizations", action="store_false",
+                   help="不测 BN 折叠 / channels_last 组合")
+    p.add_argument("--batch", type=int, nargs="+", default=[1, 8])
+    p.add_argument("--threads", type=int, default=0, help="ONNX Runtime intra-op 线程数；0 与 torch 相同")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_backends)
+
+    p = sub.add_parser("quant", help="低精度：fp32 / bf16 / INT8 的概率漂移（或 AUROC）、延迟与内存")
+    p.add_argument("--precisions", nargs="+", default=["fp32", "bf16", "int8"])
+    p.add_argument("--calib", type=str, default=None, help="校准图片目录或 CSV；默认生成合成图片")
+    p.add_argument("--eval", type=str, default=None, help="评估集目录或 CSV（含类别列时计算 AUROC）；默认合成图片")
+    p.add_argument("--calib-images", type=int, default=64)
+    p.add_argument("--eval-images", type=int, default=64)
+    p.add_argument("--size", type=int, default=512, help="合成图片边长")
+    p.add_argument("--batch", type=int, default=8)
+    p.add_argument("--repeat", type=int, default=10)
+    p.set_defaults(func=bench_quant)
+
+    p = sub.add_parser("startup", help="冷启动：导入 / 加载 / 首个请求耗时（无缓存 vs 缓存产物，± 预热）")
+    p.add_argument("--backend", type=str, default="eager")
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--repeat", type=int, default=3, help="每个场景的进程数（取中位数；cache miss 场景只跑一次）")
+    p.add_argument("--app", action="store_true", help="额外测量完整 app 进程（import app + 首个 /analyze）")
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("serve", help="多 worker 部署：每 worker RSS / PSS 与总吞吐")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    p.add_argument("--clients", type=int, default=16)
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--heatmap", action="store_true", help="请求时生成热力图")
+    p.add_argument("--port", type=int, default=18400, help="起始端口（每个配置 +1）")
+    p.add_argument("--startup-timeout", type=float, default=180.0)
+    p.set_defaults(func=bench_serve)
+
+    p = sub.add_parser("metrics", help="指标采集开销：CHEX_METRICS 开 / 关的端到端延迟对比")
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--heatmap", action="store_true", help="生成热力图（多出 cam / overlay 两个阶段）")
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser("overlay", help="热力图叠加 + 编码：float64 全尺寸 vs uint8 定点 / 限制分辨率 / CAM 网格")
+    p.add_argument("--width", type=int, default=2500)
+    p.add_argument("--height", type=int, default=3000)
+    p.add_argument("--max-side", type=int, default=1024)
+    p.add_argument("--format", type=str, default="png", help="png / jpeg / webp")
+    p.add_argument("--no-encode", dest="encode", action="store_false", help="只计叠加，不计编码")
+    p.add_argument("--repeat", type=int, default=10)
+    p.set_defaults(func=bench_overlay)
+
+    p = sub.add_parser("slow-upload", help="大量慢速上传时 /healthz 与普通 analyze 的延迟，以及超限 / 错误类型的提前拒绝")
+    p.add_argument("--clients", type=int, default=64)
+    p.add_argument("--file-mb", type=float, default=20.0)
+    p.add_argument("--chunk-kb", type=int, default=256)
+    p.add_argument("--delay-ms", type=float, default=50.0, help="每块之间的间隔（模拟慢速网络）")
+    p.add_argument("--limit-mb", type=int, default=64, help="服务端 CHEX_MAX_UPLOAD_MB")
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--port", type=int, default=18600)
+    p.add_argument("--startup-timeout", type=float, default=180.0)
+    p.set_defaults(func=bench_slow_upload)
+
+    p = sub.add_parser("ensemble", help="TTA / 集成：视图堆叠前向 vs 顺序前向，每多一个视图 / 模型的成本")
+    p.add_argument("--models", type=int, nargs="+", default=[1, 2, 3])
+    p.add_argument("--batch", type=int, nargs="+", default=[1, 8])
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_ensemble)
+
+    p = sub.add_parser("triage", help="分诊模式：阴性 / 阳性混合下的吞吐，以及按需补算热力图的成本")
+    p.add_argument("--images", type=int, default=64)
+    p.add_argument("--positive-rates", type=float, nargs="+", default=[0.1, 0.3, 0.6])
+    p.add_argument("--size", type=int, default=2048, help="合成图宽度（高为 1.2 倍），JPEG 编码")
+    p.add_argument("--batch", type=int, default=8)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--lazy-samples", type=int, default=4, help="测补算耗时的暂缓图片数")
+    p.set_defaults(func=bench_triage)
+
+    p = sub.add_parser("artifacts", help="产物查找：目录扫描 vs 清单索引，以及保留策略清理耗时")
+    p.add_argument("--counts", type=int, nargs="+", default=[10000, 100000, 1000000])
+    p.add_argument("--lookups", type=int, default=2000)
+    p.add_argument("--scan-max", type=int, default=100000, help="超过该数量时不创建文件测目录扫描")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_artifacts)
+
+    p = sub.add_parser("admission", help="过载（开环 N 倍容量）下各优先级通道的 p99 与 429/503，准入控制开 / 关")
+    p.add_argument("--modes", nargs="+", default=["none", "admission"], choices=["none", "admission"])
+    p.add_argument("--overload", type=float, default=3.0, help="到达率 = 容量的倍数")
+    p.add_argument("--duration", type=float, default=30.0, help="开环压测秒数")
+    p.add_argument("--mix", nargs="+", default=["stat=0.1", "routine=0.6", "bulk=0.3"])
+    p.add_argument("--inflight", type=int, default=4, help="服务端 CHEX_ANALYZE_WORKERS / 准入执行名额")
+    p.add_argument("--max-queue", type=int, default=16)
+    p.add_argument("--calib-requests", type=int, default=8, help="测容量时每个客户端的请求数")
+    p.add_argument("--max-clients", type=int, default=512, help="压测端并发连接上限")
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--port", type=int, default=18700)
+    p.add_argument("--startup-timeout", type=float, default=180.0)
+    p.set_defaults(func=bench_admission)
+
+    p = sub.add_parser("similar", help="相似病例检索：fp16 / IVF / PQ 索引的查询延迟、召回与内存")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    p.add_argument("--dim", type=int, default=1024)
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--nlist", type=int, default=0, help="IVF 划分数；0 表示取接近 sqrt(n) 的 2 的幂")
+    p.add_argument("--nprobe", type=int, nargs="+", default=[8, 32])
+    p.add_argument("--pq-m", type=int, default=64)
+    p.set_defaults(func=bench_similar)
+
+    p = sub.add_parser("suite", help="回归基准：analyze / 历史分页的延迟、吞吐与峰值内存，可对比基线")
+    p.add_argument("--transports", nargs="+", default=["inproc"], choices=["inproc", "http"])
+    p.add_argument("--scenarios", nargs="+", default=None, help="只跑指定场景（缺省全部）")
+    p.add_argument("--clients", type=int, nargs="+", default=[1, 8])
+    p.add_argument("--requests", type=int, default=64, help="每个（场景, 并发）的请求总数")
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--history-rows", type=int, default=100000)
+    p.add_argument("--workers", type=int, default=1, help="http 模式的 uvicorn worker 数")
+    p.add_argument("--port", type=int, default=18500)
+    p.add_argument("--startup-timeout", type=float, default=180.0)
+    p.add_argument("--baseline", type=str, default=None, help="对比的基线 JSON（suite 的 --json / --save-baseline 输出）")
+    p.add_argument("--save-baseline", type=str, default=None, help="把本次结果保存为基线")
+    p.add_argument("--tolerance", type=float, default=0.10, help="延迟 / 吞吐允许的相对退化")
+    p.add_argument("--mem-tolerance", type=float, default=0.10, help="峰值内存允许的相对增长")
+    p.set_defaults(func=bench_suite)
+
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="chex_bench_") as workdir:
+        rows = args.func(args, workdir)
+    _dump(rows, args.json)
+    if any(r.get("regression") for r in rows):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
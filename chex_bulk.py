@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+chex_bulk.py — 离线批量推理（夜间重新打分 / 验证集评估）
+
+用法：
+    python chex_bulk.py --model final_global_model.pth --input /data/CheXpert-v1.0-small/valid.csv --output valid_probs.csv
+    python chex_bulk.py --model final_global_model.pth --input /data/xrays --output probs.parquet --workers 8 --heatmap-dir cams
+    python chex_bulk.py ... --resume          # 从上次的检查点继续
+
+要点：
+- 输入为目录（递归查找 jpg/jpeg/png/dcm，按路径排序）或 CSV 清单（默认取 Path 列，兼容 CheXpert train/valid.csv）；
+  路径以生成器流式产生，不在内存中展开整个列表；
+- 解码在 torch DataLoader 子进程中完成（IterableDataset，按 batch 大小的连续块轮流分给各 worker），
+  主进程只组 batch 张量、前向、写结果，DataLoader 的 prefetch 保证在途数据有上限；
+- 结果按 batch 增量写入 CSV / Parquet / NPY，并在结果落盘、且该 batch 的热力图也都写完后写检查点
+  （已完成的条数 + 输出文件位置；热力图后台写入，检查点最多落后几个 batch），
+  --resume 时截断到检查点位置再跳过已完成的条目，内存占用与数据集大小无关；
+- 可选生成热力图（经 chex_persist.ArtifactWriter 后台编码写盘，队列有上限）。
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from collections import deque
+from itertools import islice
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+import chex_model
+from chex_persist import ArtifactWriter, heatmap_extension, write_atomic
+from chex_preprocess import Decoded, Preprocessor
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".dcm")
+
+# DICOM 降采样：与 app.py 的 DICOM_MAX_SIDE / DICOM_MODEL_SIDE 一致
+DICOM_MAX_SIDE = 2048
+DICOM_MODEL_SIDE = 448
+
+
+# ---------------------------
+# 输入：目录 / CSV 清单
+# ---------------------------
+def iter_directory(root: str) -> Iterator[Tuple[str, str]]:
+    """递归遍历目录，按路径排序产出 (相对路径, 绝对路径)；目录内排序保证多次运行顺序一致。"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(IMAGE_EXTS):
+                full = os.path.join(dirpath, name)
+                yield os.path.relpath(full, root).replace(os.sep, "/"), full
+
+
+def iter_manifest(csv_path: str, path_column: str = "Path", root: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+    """
+    逐行读取 CSV 清单，产出 (清单中的路径, 实际路径)。
+    未给 root 时先相对 CSV 所在目录解析，不存在再相对其上一级
+    （CheXpert 的 valid.csv 中路径以 CheXpert-v1.0-small/ 开头）。
+    """
+    base = os.path.dirname(os.path.abspath(csv_path))
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            rel = (row.get(path_column) or "").strip()
+            if not rel:
+                continue
+            if root is not None or os.path.isabs(rel):
+                yield rel, os.path.join(root or "", rel)
+                continue
+            full = os.path.join(base, rel)
+            yield rel, full if os.path.exists(full) else os.path.join(os.path.dirname(base), rel)
+
+
+def iter_source(src: str, path_column: str = "Path", root: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+    if os.path.isdir(src):
+        return iter_directory(src)
+    if src.lower().endswith(".csv"):
+        return iter_manifest(src, path_column, root)
+    raise ValueError(f"输入既不是目录也不是 CSV 清单: {src}")
+
+
+# ---------------------------
+# 解码（DataLoader 子进程）
+# ---------------------------
+class Item(NamedTuple):
+    index: int                    # 在输入流中的序号（含 --resume 跳过的部分）
+    path: str                     # 输出中使用的路径（清单原文 / 相对目录的路径）
+    decoded: Optional[Decoded]    # 解码失败时为 None
+    error: Optional[str]
+
+
+class ImageStream(IterableDataset):
+    """
+    按连续块把输入流分给各 worker：第 c 块（batch_size 条）由 c % num_workers 号 worker 解码。
+    DataLoader 按 worker 轮流取结果，因此产出顺序与输入顺序一致，检查点只需记录已完成条数。
+    """
+
+    def __init__(
+        self,
+        src: str,
+        batch_size: int = 32,
+        start: int = 0,
+        size: int = 224,
+        keep_full: bool = False,
+        path_column: str = "Path",
+        root: Optional[str] = None,
+    ):
+        self.src = src
+        self.batch_size = max(1, int(batch_size))
+        self.start = int(start)
+        self.size = int(size)
+        self.keep_full = bool(keep_full)
+        self.path_column = path_column
+        self.root = root
+
+    def __iter__(self) -> Iterator[List[Item]]:
+        info = get_worker_info()
+        wid, nw = (info.id, info.num_workers) if info is not None else (0, 1)
+        # 归一化在主进程 to_batch 时完成，这里只用到解码与缩放
+        pre = Preprocessor(self.size)
+        chunk: List[Item] = []
+        stream = islice(iter_source(self.src, self.path_column, self.root), self.start, None)
+        for k, (rel, path) in enumerate(stream):
+            if (k // self.batch_size) % nw != wid:
+                continue
+            chunk.append(self._decode(pre, self.start + k, rel, path))
+            if len(chunk) == self.batch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _decode(self, pre: Preprocessor, index: int, rel: str, path: str) -> Item:
+        try:
+            if path.lower().endswith(".dcm"):
+                from chex_dicom import read_dicom  # noqa
+                image: Any = read_dicom(path, max_side=DICOM_MAX_SIDE if self.keep_full else DICOM_MODEL_SIDE)
+            else:
+                image = path
+            return Item(index, rel, pre.decode(image, keep_full=self.keep_full), None)
+        except Exception as e:
+            return Item(index, rel, None, f"{type(e).__name__}: {e}")
+
+
+def _identity(batch: Any) -> Any:
+    return batch
+
+
+# ---------------------------
+# 输出：CSV / Parquet / NPY（增量写入，可断点续写）
+# ---------------------------
+class CsvSink:
+    """一行一张图：Path, 各类别概率, error。每个 batch 写完即 flush，检查点记录文件偏移。"""
+
+    def __init__(self, path: str, classes: List[str], state: Optional[Dict[str, Any]] = None):
+        self.path = path
+        if state:
+            with open(path, "r+b") as f:
+                f.truncate(int(state["offset"]))
+            self._f = open(path, "a", encoding="utf-8", newline="")
+            self._w = csv.writer(self._f)
+        else:
+            self._f = open(path, "w", encoding="utf-8", newline="")
+            self._w = csv.writer(self._f)
+            self._w.writerow(["Path"] + list(classes) + ["error"])
+
+    def write(self, paths: List[str], probs: np.ndarray, errors: List[Optional[str]]) -> None:
+        for p, row, err in zip(paths, probs, errors):
+            self._w.writerow([p] + ([f"{v:.6f}" for v in row] if err is None else [""] * len(row)) + [err or ""])
+
+    def commit(self) -> Optional[Dict[str, Any]]:
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        return {"offset": self._f.tell()}
+
+    def close(self) -> None:
+        self._f.close()
+
+
+class NpySink:
+    """
+    概率先追加写入原始 float32 文件（<output>.part），路径写入 <stem>.paths.txt（与行一一对应），
+    结束时分块拷贝成标准 .npy（open_memmap，内存占用与行数无关）。解码失败的行为 NaN。
+    """
+
+    def __init__(self, path: str, classes: List[str], state: Optional[Dict[str, Any]] = None):
+        self.path = path
+        self.num_classes = len(classes)
+        self.paths_path = os.path.splitext(path)[0] + ".paths.txt"
+        self._raw_path = path + ".part"
+        mode = "r+b" if state else "wb"
+        self._raw = open(self._raw_path, mode)
+        self._txt = open(self.paths_path, mode)
+        if state:
+            self._raw.truncate(int(state["raw_offset"]))
+            self._txt.truncate(int(state["paths_offset"]))
+            self._raw.seek(0, os.SEEK_END)
+            self._txt.seek(0, os.SEEK_END)
+
+    def write(self, paths: List[str], probs: np.ndarray, errors: List[Optional[str]]) -> None:
+        probs = np.array(probs, dtype="<f4", copy=True).reshape(len(paths), self.num_classes)
+        probs[[i for i, e in enumerate(errors) if e is not None]] = np.nan
+        self._raw.write(probs.tobytes())
+        self._txt.write("".join(p + "\n" for p in paths).encode("utf-8"))
+
+    def commit(self) -> Optional[Dict[str, Any]]:
+        for f in (self._raw, self._txt):
+            f.flush()
+            os.fsync(f.fileno())
+        return {"raw_offset": self._raw.tell(), "paths_offset": self._txt.tell()}
+
+    def close(self, chunk_rows: int = 65536) -> None:
+        self._raw.close()
+        self._txt.close()
+        row_bytes = 4 * self.num_classes
+        n = os.path.getsize(self._raw_path) // row_bytes
+        out = np.lib.format.open_memmap(self.path, mode="w+", dtype="<f4", shape=(n, self.num_classes))
+        with open(self._raw_path, "rb") as f:
+            for i in range(0, n, chunk_rows):
+                rows = min(chunk_rows, n - i)
+                out[i:i + rows] = np.frombuffer(f.read(rows * row_bytes), dtype="<f4").reshape(rows, -1)
+        out.flush()
+        del out
+        os.remove(self._raw_path)
+
+
+class ParquetSink:
+    """
+    Parquet 文件的 footer 只在关闭时写出，因此按 rows_per_part 行切分为若干 part 文件（<output>.partNNNNN），
+    每关闭一个 part 才算落盘（commit 返回检查点状态，否则返回 None）；结束时按 row group 合并为 <output>。
+    """
+
+    def __init__(self, path: str, classes: List[str], state: Optional[Dict[str, Any]] = None, rows_per_part: int = 8192):
+        import pyarrow as pa
+
+        self.path = path
+        self.classes = list(classes)
+        self.rows_per_part = int(rows_per_part)
+        self.schema = pa.schema(
+            [("Path", pa.string())] + [(c, pa.float32()) for c in self.classes] + [("error", pa.string())]
+        )
+        self.parts: List[str] = list(state["parts"]) if state else []
+        for stale in self._stale_parts():
+            os.remove(stale)
+        self._writer = None
+        self._rows = 0
+
+    def _part_name(self, i: int) -> str:
+        return f"{self.path}.part{i:05d}"
+
+    def _stale_parts(self) -> List[str]:
+        # 上次中断时尚未关闭的 part（不在检查点中）
+        d = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + ".part"
+        keep = {os.path.basename(p) for p in self.parts}
+        return [os.path.join(d, n) for n in os.listdir(d) if n.startswith(prefix) and n not in keep]
+
+    def write(self, paths: List[str], probs: np.ndarray, errors: List[Optional[str]]) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._part_name(len(self.parts)), self.schema)
+        probs = np.asarray(probs, dtype=np.float32)
+        cols = [pa.array(paths, pa.string())]
+        mask = np.array([e is not None for e in errors])
+        cols += [pa.array(probs[:, k], pa.float32(), mask=mask) for k in range(len(self.classes))]
+        cols.append(pa.array(errors, pa.string()))
+        self._writer.write_table(pa.Table.from_arrays(cols, schema=self.schema))
+        self._rows += len(paths)
+
+    def _close_part(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self.parts.append(self._part_name(len(self.parts)))
+            self._writer = None
+            self._rows = 0
+
+    def commit(self) -> Optional[Dict[str, Any]]:
+        if self._rows < self.rows_per_part:
+            return None
+        self._close_part()
+        return {"parts": list(self.parts)}
+
+    def close(self) -> None:
+        import pyarrow.parquet as pq
+
+        self._close_part()
+        with pq.ParquetWriter(self.path, self.schema) as out:
+            for part in self.parts:
+                pf = pq.ParquetFile(part)
+                for i in range(pf.num_row_groups):
+                    out.write_table(pf.read_row_group(i))
+        for part in self.parts:
+            os.remove(part)
+
+
+SINKS = {"csv": CsvSink, "npy": NpySink, "parquet": ParquetSink}
+
+
+def _sink_format(path: str, fmt: Optional[str]) -> str:
+    fmt = (fmt or os.path.splitext(path)[1].lstrip(".")).lower()
+    if fmt not in SINKS:
+        raise ValueError(f"不支持的输出格式: {fmt}（可选 {', '.join(SINKS)}）")
+    return fmt
+
+
+# ---------------------------
+# 检查点
+# ---------------------------
+def _ckpt_path(output: str) -> str:
+    return output + ".ckpt.json"
+
+
+def load_checkpoint(output: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_ckpt_path(output), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(output: str, state: Dict[str, Any]) -> None:
+    write_atomic(_ckpt_path(output), json.dumps(state, ensure_ascii=False).encode("utf-8"))
+
+
+def _heatmap_path(heatmap_dir: str, rel: str, ext: str) -> str:
+    # 清单中可能是绝对路径或含 ..，只保留普通路径分量，保证写在 heatmap_dir 之内
+    parts = [p for p in os.path.splitdrive(rel)[1].replace("\\", "/").split("/") if p not in ("", ".", "..")]
+    return os.path.join(heatmap_dir, *parts[:-1], os.path.splitext(parts[-1])[0] + f"_cam.{ext}")
+
+
+# ---------------------------
+# 主流程
+# ---------------------------
+def run(
+    src: str,
+    output: str,
+    fmt: Optional[str] = None,
+    batch_size: int = 32,
+    workers: int = 4,
+    prefetch: int = 2,
+    threshold: float = 0.5,
+    heatmap_dir: Optional[str] = None,
+    heatmap_format: str = "png",
+    alpha: float = 0.45,
+    resume: bool = False,
+    path_column: str = "Path",
+    root: Optional[str] = None,
+    log_every_s: float = 10.0,
+) -> Dict[str, Any]:
+    """
+    对 src（目录或 CSV 清单）中的全部图片做推理，结果写入 output。需先调用 chex_model.init_model。
+    返回 {'images', 'errors', 'seconds', 'images_per_s'}（只统计本次运行处理的部分）。
+    """
+    chex_model._check_ready()
+    fmt = _sink_format(output, fmt)
+    classes = list(chex_model._CLASS_NAMES)
+    version = chex_model.model_version()
+
+    ckpt = load_checkpoint(output) if resume else None
+    if ckpt is not None:
+        if ckpt.get("model_version") != version or ckpt.get("format") != fmt:
+            raise ValueError("检查点与当前模型 / 输出格式不一致，请去掉 --resume 重新运行")
+        print(f"[bulk] 从检查点继续：已完成 {ckpt['done']} 条")
+    done = int(ckpt["done"]) if ckpt else 0
+    sink = SINKS[fmt](output, classes, ckpt["sink"] if ckpt else None)
+
+    generate_heatmap = heatmap_dir is not None
+    writer = ArtifactWriter(max_workers=2, max_pending=4 * batch_size) if generate_heatmap else None
+    hm_ext = heatmap_extension(heatmap_format)
+
+    stream = ImageStream(src, batch_size, start=done, size=chex_model._PREPROCESSOR.size,
+                         keep_full=generate_heatmap, path_column=path_column, root=root)
+    # batch_size=None：数据集自己产出 batch；在途 batch 数上限为 workers * prefetch
+    loader_kw: Dict[str, Any] = {"prefetch_factor": max(1, int(prefetch))} if workers > 0 else {}
+    loader = DataLoader(stream, batch_size=None, num_workers=max(0, int(workers)), collate_fn=_identity, **loader_kw)
+
+    # (该 batch 的热力图写入 futures, 检查点)：热力图全部写完才保存对应检查点，
+    # 否则崩溃后 --resume 会跳过热力图还在队列里没写出的条目
+    pending: "deque[Tuple[List[Any], Dict[str, Any]]]" = deque()
+    carry: List[Any] = []   # sink 尚未落盘的 batch 的热力图，归到下一个检查点
+    n = errors = 0
+    t0 = last_log = time.perf_counter()
+    for batch in loader:
+        ok = [it for it in batch if it.decoded is not None]
+        outs = chex_model.infer_decoded(
+            [it.decoded for it in ok], generate_heatmap=generate_heatmap, threshold=threshold, alpha=alpha,
+        ) if ok else []
+        by_index = {it.index: out for it, out in zip(ok, outs)}
+
+        probs = np.zeros((len(batch), len(classes)), dtype=np.float32)
+        futures = carry
+        for row, it in enumerate(batch):
+            out = by_index.get(it.index)
+            if out is None:
+                continue
+            probs[row] = [out["probs"][c] for c in classes]
+            if writer is not None and out.get("heatmap") is not None:
+                futures.append(writer.write_heatmap(_heatmap_path(heatmap_dir, it.path, hm_ext), out["heatmap"], heatmap_format))
+        sink.write([it.path for it in batch], probs, [it.error for it in batch])
+
+        n += len(batch)
+        errors += len(batch) - len(ok)
+        done = batch[-1].index + 1
+        state = sink.commit()
+        if state is not None:
+            pending.append((futures, {"done": done, "format": fmt, "model_version": version, "sink": state}))
+            carry = []
+        ready = None
+        while pending and all(f.done() for f in pending[0][0]):
+            ready = pending.popleft()[1]
+        if ready is not None:
+            save_checkpoint(output, ready)
+
+        now = time.perf_counter()
+        if now - last_log >= log_every_s:
+            print(f"[bulk] {done} 条（本次 {n}），{n / (now - t0):.1f} images/s，失败 {errors}")
+            last_log = now
+
+    if writer is not None:
+        writer.shutdown(wait=True)
+    sink.close()
+    if os.path.exists(_ckpt_path(output)):
+        os.remove(_ckpt_path(output))
+
+    seconds = time.perf_counter() - t0
+    stats = {"images": n, "errors": errors, "seconds": seconds, "images_per_s": n / seconds if seconds > 0 else 0.0}
+    print(f"[bulk] 完成：{n} 张，失败 {errors}，{seconds:.1f}s，{stats['images_per_s']:.1f} images/s -> {output}")
+    return stats
+
+
+# ---------------------------
+# 命令行
+# ---------------------------
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="CheXpert DenseNet121 离线批量推理")
+    parser.add_argument("--model", type=str, default="final_global_model.pth", help="模型权重路径")
+    parser.add_argument("--input", type=str, required=True, help="图片目录或 CSV 清单")
+    parser.add_argument("--output", type=str, required=True, help="结果文件 .csv / .parquet / .npy")
+    parser.add_argument("--format", type=str, default=None, choices=sorted(SINKS), help="默认按扩展名推断")
+    parser.add_argument("--path-column", type=str, default="Path", help="CSV 清单中的路径列")
+    parser.add_argument("--root", type=str, default=None, help="CSV 中相对路径的根目录")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4, help="解码子进程数；0 表示在主进程解码")
+    parser.add_argument("--prefetch", type=int, default=2, help="每个 worker 预取的 batch 数")
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--heatmap-dir", type=str, default=None, help="给定时生成热力图到该目录")
+    parser.add_argument("--heatmap-format", type=str, default="png")
+    parser.add_argument("--alpha", type=float, default=0.45)
+    parser.add_argument("--resume", action="store_true", help="从 <output>.ckpt.json 继续")
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--threads", type=int, default=0, help="主进程 torch 线程数；0 表示默认")
+    parser.add_argument("--imagenet-norm", action="store_true", help="使用 ImageNet 归一化")
+    args = parser.parse_args(argv)
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    chex_model.init_model(args.model, class_names=None, device=args.device, use_imagenet_norm=args.imagenet_norm)
+    run(
+        args.input, args.output, args.format,
+        batch_size=args.batch_size, workers=args.workers, prefetch=args.prefetch,
+        threshold=args.threshold, heatmap_dir=args.heatmap_dir, heatmap_format=args.heatmap_format,
+        alpha=args.alpha, resume=args.resume, path_column=args.path_column, root=args.root,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+chex_cache.py — 按上传内容哈希缓存推理结果
+
+键 = sha256(上传字节) + 模型版本（chex_model.model_version()）。
+值只存与阈值无关的部分：
+    {
+      "probs": [float, ...],                  # 与 class_names 同序
+      "original_url": str, "original_path": str,
+      "heatmaps": {variant: {"url", "path"}}, # variant 由 alpha + 叠加类别决定
+      "embedding": str,                       # 可选：相似病例检索用的嵌入（float16 的 base64，见 pack_embedding）
+    }
+阈值 / return_top_k / 是否要热力图都在命中后由 chex_model.classify 从概率重新计算，
+只有当新阈值对应的叠加类别组合没有现成热力图时，才需要重新跑模型。
+
+两级：
+- 内存 LRU，按条目序列化后的字节数淘汰；
+- 可选磁盘层（disk_dir），每个键一个 JSON 文件，按键前两位分目录；内存未命中时回读并提升。
+
+FeatureCache：分诊模式下暂缓热力图的请求按 request_id 缓存 CAM 特征图（只在内存，按字节数 LRU 淘汰）。
+"""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, BinaryIO, Dict, Iterable, Optional
+
+import numpy as np
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(fp: BinaryIO, chunk_size: int = 1 << 20) -> str:
+    """分块计算文件对象的 sha256，完成后把读指针复位到开头。"""
+    h = hashlib.sha256()
+    fp.seek(0)
+    for chunk in iter(lambda: fp.read(chunk_size), b""):
+        h.update(chunk)
+    fp.seek(0)
+    return h.hexdigest()
+
+
+def heatmap_variant(alpha: float, labels: Iterable[str], fmt: str = "png") -> str:
+    """热力图变体键：同一图片、同一 alpha、同一组叠加类别的热力图完全相同。"""
+    return f"{fmt}|{float(alpha):.4f}|" + ",".join(sorted(labels))
+
+
+def pack_embedding(vec: np.ndarray) -> str:
+    """嵌入 -> float16 的 base64（1024 维约 2.7 KB，缓存条目是 JSON）。"""
+    return base64.b64encode(np.asarray(vec, dtype=np.float16).tobytes()).decode("ascii")
+
+
+def unpack_embedding(s: Optional[str]) -> Optional[np.ndarray]:
+    if not s:
+        return None
+    return np.frombuffer(base64.b64decode(s), dtype=np.float16).astype(np.float32)
+
+
+class ResultCache:
+    """
+    - max_bytes: 内存层容量（条目 JSON 字节数之和）
+    - disk_dir: 磁盘层目录；None 表示不启用
+    """
+
+    def __init__(self, max_bytes: int = 64 << 20, disk_dir: Optional[str] = None):
+        self.max_bytes = int(max_bytes)
+        self.disk_dir = disk_dir
+        self._mem: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(digest: str, model_version: Optional[str]) -> str:
+        return hashlib.sha256(f"{model_version}|{digest}".encode("utf-8")).hexdigest()
+
+    # ---------------------------
+    # 内存层
+    # ---------------------------
+    def _mem_put(self, key: str, entry: Dict[str, Any], size: int) -> None:
+        with self._lock:
+            if key in self._mem:
+                self._bytes -= self._sizes.pop(key)
+                del self._mem[key]
+            if size > self.max_bytes:
+                return
+            self._mem[key] = entry
+            self._sizes[key] = size
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._mem:
+                old, _ = self._mem.popitem(last=False)
+                self._bytes -= self._sizes.pop(old)
+
+    # ---------------------------
+    # 磁盘层
+    # ---------------------------
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _disk_get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key: str, payload: str) -> None:
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+
+    # ---------------------------
+    # 对外接口
+    # ---------------------------
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查询并计数命中 / 未命中；返回条目的副本。"""
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                self._mem.move_to_end(key)
+        if entry is None:
+            entry = self._disk_get(key)
+            if entry is not None:
+                self._mem_put(key, entry, len(json.dumps(entry, ensure_ascii=False)))
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(json.dumps(entry))
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        payload = json.dumps(entry, ensure_ascii=False)
+        self._mem_put(key, json.loads(payload), len(payload))
+        self._disk_put(key, payload)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._mem),
+                "bytes": self._bytes,
+            }
+
+
+class FeatureCache:
+    """
+    分诊模式（triage）下暂缓生成热力图的请求：request_id -> 条目（CAM 特征图、概率、原图位置等），
+    供后续按需生成热力图时复用，无需再跑一次前向。
+    - max_bytes: 容量（条目 nbytes 之和），超出按 LRU 淘汰；条目只在内存中
+    """
+
+    def __init__(self, max_bytes: int = 64 << 20):
+        self.max_bytes = int(max_bytes)
+        self._mem: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, key: str, entry: Dict[str, Any], nbytes: int) -> bool:
+        """写入（同键覆盖）；单条超过容量时不缓存，返回 False。"""
+        with self._lock:
+            if key in self._mem:
+                self._bytes -= self._sizes.pop(key)
+                del self._mem[key]
+            if nbytes > self.max_bytes:
+                return False
+            self._mem[key] = entry
+            self._sizes[key] = int(nbytes)
+            self._bytes += int(nbytes)
+            while self._bytes > self.max_bytes and self._mem:
+                old, _ = self._mem.popitem(last=False)
+                self._bytes -= self._sizes.pop(old)
+                self.evictions += 1
+        return True
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """返回条目本身（不复制，调用方不要修改特征张量）。"""
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._mem.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._mem),
+                "bytes": self._bytes,
+            }
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+chex_dicom.py — .dcm 上传的流式读取与窗宽窗位处理
+
+与旧实现（f.file.read() 全量读入 → pixel_array.astype(float32) → 多次整图 min-max）相比：
+- 直接从（已落盘的）上传文件对象读取，不再把整个文件读成 bytes；
+- 未压缩的单帧灰度图通过 np.memmap 映射像素区，不复制 PixelData；
+- 先在原始整数域用 INTER_AREA 降采样，再做强度变换；
+- 强度变换（RescaleSlope/Intercept、WindowCenter/Width、MONOCHROME1 反相）预先算成
+  uint8 查找表，一次索引得到结果，不产生任何整图 float 临时数组。
+"""
+
+import os
+from collections.abc import Sequence
+from typing import Any, BinaryIO, Optional, Union
+
+import cv2
+import numpy as np
+
+# 像素数据标签 (7FE0,0010)
+_PIXEL_DATA = 0x7FE00010
+
+# 小于该大小的元素立即读取；像素数据延迟，由 _pixel_view 决定如何取
+_DEFER_SIZE = "64 KB"
+
+
+def _first(v: Any) -> Optional[float]:
+    """DICOM 多值（MultiValue）取第一个；缺失或无法解析时返回 None。"""
+    if isinstance(v, Sequence) and not isinstance(v, (str, bytes)):
+        v = v[0] if len(v) else None
+    try:
+        return None if v is None or v == "" else float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _pixel_view(ds: Any, fp: Any) -> Optional[np.ndarray]:
+    """
+    未压缩、小端、单帧、单通道时，直接 memmap 文件中的像素区；否则返回 None。
+    """
+    try:
+        if ds.file_meta.TransferSyntaxUID.is_compressed:
+            return None
+        if not ds.file_meta.TransferSyntaxUID.is_little_endian:
+            return None
+        if int(getattr(ds, "SamplesPerPixel", 1)) != 1 or int(getattr(ds, "NumberOfFrames", 1) or 1) != 1:
+            return None
+        bits = int(ds.BitsAllocated)
+        if bits not in (8, 16):
+            return None
+        raw = ds.get_item(_PIXEL_DATA)
+        tell = getattr(raw, "value_tell", None)
+        if tell is None or raw.length in (None, 0xFFFFFFFF):
+            return None
+        rows, cols = int(ds.Rows), int(ds.Columns)
+        signed = int(getattr(ds, "PixelRepresentation", 0)) == 1
+        dtype = np.dtype(("i" if signed else "u") + str(bits // 8)).newbyteorder("<")
+        if raw.length < rows * cols * dtype.itemsize:
+            return None
+        fp.fileno()  # 内存中的文件对象（BytesIO 等）无法映射
+        return np.memmap(fp, dtype=dtype, mode="r", offset=int(tell), shape=(rows, cols))
+    except Exception:
+        return None
+
+
+def _downsample(arr: np.ndarray, max_side: Optional[int]) -> np.ndarray:
+    h, w = arr.shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return arr
+    scale = max_side / float(max(h, w))
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    if arr.dtype not in (np.uint8, np.uint16, np.int16, np.float32):
+        arr = arr.astype(np.float32)
+    return cv2.resize(arr, size, interpolation=cv2.INTER_AREA)
+
+
+def _intensity_lut(ds: Any, arr: np.ndarray) -> np.ndarray:
+    """
+    为 8/16 位整数像素构建 uint8 查找表（按无符号位模式索引，有符号像素同样适用）。
+    顺序与 DICOM 显示管线一致：Modality LUT（Rescale）→ VOI（窗宽窗位，缺省为 min-max）→ 反相。
+    """
+    sdtype = np.dtype(f"{arr.dtype.kind}{arr.dtype.itemsize}")
+    udtype = np.dtype(f"u{arr.dtype.itemsize}")
+    values = np.arange(1 << (8 * udtype.itemsize), dtype=np.uint32).astype(udtype).view(sdtype).astype(np.float32)
+
+    slope = _first(getattr(ds, "RescaleSlope", None))
+    intercept = _first(getattr(ds, "RescaleIntercept", None))
+    if slope is not None:
+        values *= slope
+    if intercept is not None:
+        values += intercept
+
+    center = _first(getattr(ds, "WindowCenter", None))
+    width = _first(getattr(ds, "WindowWidth", None))
+    if center is not None and width is not None and width >= 1:
+        # PS3.3 C.11.2.1.2.1：线性窗
+        values -= center - 0.5
+        values /= max(width - 1.0, 1.0)
+        values += 0.5
+    else:
+        # 无窗信息：按实际出现的像素范围拉伸（只扫一遍取 min/max，不分配整图）
+        ends = np.array([arr.min(), arr.max()], dtype=sdtype).view(udtype)
+        lo, hi = sorted(float(values[i]) for i in ends)
+        values -= lo
+        values /= (hi - lo) + 1e-6
+    np.clip(values, 0.0, 1.0, out=values)
+
+    if str(getattr(ds, "PhotometricInterpretation", "")).upper() == "MONOCHROME1":
+        np.subtract(1.0, values, out=values)
+    values *= 255.0
+    values += 0.5
+    return values.astype(np.uint8)
+
+
+def _to_uint8_float(ds: Any, arr: np.ndarray) -> np.ndarray:
+    """非 8/16 位整数（或彩色）像素的回退路径：在降采样后的数组上原地计算。"""
+    out = arr.astype(np.float32, copy=True)
+    slope = _first(getattr(ds, "RescaleSlope", None))
+    intercept = _first(getattr(ds, "RescaleIntercept", None))
+    if slope is not None:
+        out *= slope
+    if intercept is not None:
+        out += intercept
+    center = _first(getattr(ds, "WindowCenter", None))
+    width = _first(getattr(ds, "WindowWidth", None))
+    if out.ndim == 2 and center is not None and width is not None and width >= 1:
+        out -= center - 0.5
+        out /= max(width - 1.0, 1.0)
+        out += 0.5
+    else:
+        out -= out.min()
+        out /= out.max() + 1e-6
+    np.clip(out, 0.0, 1.0, out=out)
+    if out.ndim == 2 and str(getattr(ds, "PhotometricInterpretation", "")).upper() == "MONOCHROME1":
+        np.subtract(1.0, out, out=out)
+    out *= 255.0
+    out += 0.5
+    return out.astype(np.uint8)
+
+
+def read_dicom(src: Union[str, BinaryIO], max_side: Optional[int] = None) -> np.ndarray:
+    """
+    读取 DICOM 并输出 uint8 灰度数组（彩色图转灰度），可直接交给 chex_model.infer。
+    - src: 路径或已打开的二进制文件对象（如 UploadFile.file，Starlette 会把大文件落盘）
+    - max_side: 若给定，先把长边降到不超过该值再做强度变换
+    """
+    import pydicom
+
+    if isinstance(src, str) and not os.path.exists(src):
+        raise FileNotFoundError(f"DICOM 不存在: {src}")
+    fp = open(src, "rb") if isinstance(src, str) else src
+    try:
+        ds = pydicom.dcmread(fp, defer_size=_DEFER_SIZE)
+        arr = _pixel_view(ds, fp)
+        if arr is None:
+            arr = ds.pixel_array
+            if arr.ndim == 3 and int(getattr(ds, "SamplesPerPixel", 1)) == 1:
+                arr = arr[0]            # 多帧只取第一帧
+            elif arr.ndim == 4:
+                arr = arr[0]
+        arr = _downsample(arr, max_side)
+
+        if arr.ndim == 2 and arr.dtype.kind in "iu" and arr.dtype.itemsize <= 2:
+            return _intensity_lut(ds, arr)[arr.view(f"u{arr.dtype.itemsize}")]
+        out = _to_uint8_float(ds, arr)
+        return cv2.cvtColor(np.ascontiguousarray(out[..., :3]), cv2.COLOR_RGB2GRAY) if out.ndim == 3 else out
+    finally:
+        if isinstance(src, str):
+            fp.close()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+chex_ensemble.py — 测试时增强（TTA）与多模型集成
+
+- ModelRegistry: 主模型（init_model 已加载）+ 若干同结构、同类别的附加权重（如联邦训练各轮 / 各客户端的
+  final_global_model.pth 兄弟文件，支持通配符）；
+- EnsembleRunner: 与 chex_backends 相同的 runner 约定 runner(batch) -> (feats, outputs)，可直接替换
+  chex_model._RUNNER，infer / infer_batch / 微批调度 / 结果结构都不变。
+
+每个模型只做一次前向：所有 TTA 视图在 batch 维上堆叠为 [V*B,3,S,S]。
+- flip:  水平翻转；特征图翻转回原方向后与原视图对齐
+- crops: 四角 + 中心 5 个 crop（边长 crop_scale*S），各自缩放回 S；只参与概率平均
+概率：各视图、各模型的 Sigmoid 输出直接平均。
+CAM：einsum 是线性的，mean_m(W_m · f_m) == [W_1 .. W_M] · [f_1 .. f_M] / M，因此把各模型（对齐视图平均后的）
+特征按通道拼接并除以 M，CAM 权重取各模型分类头权重按通道拼接（cam_weight）—— compute_cams 原样复用，
+一次 einsum 得到集成后的 CAM（ReLU 与归一化在平均之后做）。
+"""
+
+import glob
+import hashlib
+import os
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import chex_model
+from chex_backends import Runner
+
+TTA_VIEWS = ("flip", "crops")
+
+
+class Member(NamedTuple):
+    name: str
+    model: nn.Module
+    runner: Runner
+    cam_weight: torch.Tensor     # [K,C]
+    weights_hash: str
+
+
+def resolve_paths(patterns: Iterable[str], exclude: Optional[str] = None) -> List[str]:
+    """展开通配符并去重（保持顺序），排除主模型本身。"""
+    seen = {os.path.abspath(exclude)} if exclude else set()
+    out = []
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if not pattern:
+            continue
+        matches = sorted(glob.glob(pattern)) if any(ch in pattern for ch in "*?[") else [pattern]
+        for path in matches:
+            key = os.path.abspath(path)
+            if key not in seen:
+                seen.add(key)
+                out.append(path)
+    return out
+
+
+class ModelRegistry:
+    """同一组类别的多个 DenseNet121；成员顺序即集成顺序。"""
+
+    def __init__(self, class_names: List[str], device: torch.device):
+        self.class_names = list(class_names)
+        self.device = device
+        self.members: List[Member] = []
+
+    def add(self, name: str, model: nn.Module, runner: Runner, weights_hash: str) -> Member:
+        linear = chex_model._find_linear(model.classifier)
+        if linear is None:
+            raise ValueError(f"{name}: 分类头中没有线性层，无法计算 CAM")
+        if linear.weight.shape[0] != len(self.class_names):
+            raise ValueError(f"{name}: 类别数 {linear.weight.shape[0]} 与主模型 {len(self.class_names)} 不一致")
+        member = Member(name, model, runner, linear.weight.detach(), weights_hash)
+        self.members.append(member)
+        return member
+
+    def load(self, path: str, fold_bn: bool = False, channels_last: bool = False) -> Member:
+        """加载附加权重：eager 前向（可选 BN 折叠 / channels_last）。"""
+        from chex_backends import build_runner, fold_batchnorm
+
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"集成权重未找到: {path}")
+        model, _ = chex_model._load_checkpoint(path, self.class_names)
+        model.eval().to(self.device)
+        if fold_bn:
+            fold_batchnorm(model)
+        runner = build_runner(model, "eager", channels_last)
+        print(f"[ensemble] 已加载成员 {os.path.basename(path)}")
+        return self.add(os.path.basename(path), model, runner, chex_model.file_sha256(path)[:16])
+
+    def digest(self) -> str:
+        return hashlib.sha256("|".join(m.weights_hash for m in self.members).encode()).hexdigest()[:8]
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+
+class EnsembleRunner:
+    """
+    - views: TTA 视图（flip / crops 的子集；原图始终包含在内）
+    - crop_scale: crops 的边长比例
+    """
+
+    def __init__(self, registry: ModelRegistry, views: Sequence[str] = (), crop_scale: float = 0.875):
+        if not len(registry):
+            raise ValueError("集成至少需要一个模型")
+        unknown = set(views) - set(TTA_VIEWS)
+        if unknown:
+            raise ValueError(f"未知 TTA 视图: {', '.join(sorted(unknown))}（可选 {', '.join(TTA_VIEWS)}）")
+        self.registry = registry
+        self.views = tuple(v for v in TTA_VIEWS if v in views)
+        self.crop_scale = float(crop_scale)
+        # [K, C*M]：与 __call__ 返回的拼接特征对应
+        self.cam_weight = torch.cat([m.cam_weight.float() for m in registry.members], dim=1)
+
+    @property
+    def tag(self) -> str:
+        return f"ens{len(self.registry)}.{self.registry.digest()}" + "".join(f"-{v}" for v in self.views)
+
+    def num_views(self) -> int:
+        return 1 + ("flip" in self.views) + 5 * ("crops" in self.views)
+
+    def expand(self, x: torch.Tensor) -> Tuple[torch.Tensor, int]:
+        """[B,3,S,S] -> ([V*B,3,S,S], 与原图空间对齐的视图数)；对齐视图排在前面。"""
+        views = [x]
+        if "flip" in self.views:
+            views.append(torch.flip(x, dims=[3]))
+        aligned = len(views)
+        if "crops" in self.views:
+            s = x.shape[-1]
+            c = max(1, int(round(s * self.crop_scale)))
+            d = s - c
+            crops = [x[:, :, i:i + c, j:j + c] for i, j in ((0, 0), (0, d), (d, 0), (d, d), (d // 2, d // 2))]
+            views.append(F.interpolate(torch.cat(crops), size=(s, s), mode="bilinear", align_corners=False))
+        return torch.cat(views), aligned
+
+    def __call__(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        b = x.shape[0]
+        stacked, aligned = self.expand(x)
+        v = stacked.shape[0] // b
+        feats_all, probs = [], None
+        for m in self.registry.members:
+            feats, outputs = m.runner(stacked)
+            p = outputs.float().view(v, b, -1).mean(0)
+            probs = p if probs is None else probs + p
+            f = feats.float()[:aligned * b].view(aligned, b, *feats.shape[1:])
+            f = (f[0] + torch.flip(f[1], dims=[3])) / 2 if aligned == 2 else f[0]
+            feats_all.append(f)
+        n = float(len(self.registry))
+        return torch.cat(feats_all, dim=1) / n, probs / n
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+chex_history.py — 分析历史存储（SQLite WAL，替代每次全量扫描 analysis_history.jsonl）
+
+- 追加写：单条 INSERT，WAL 模式下读写互不阻塞；
+- 最新优先分页：按自增 id 倒序走主键索引，LIMIT page_size；
+  传 before_id（上一页最后一条的 id）时为游标分页，任何页都是 O(page_size)；
+- 过滤：日期区间、诊断、置信度区间，均有索引；
+- 总数由触发器维护在 meta 表中，无过滤时不做 COUNT(*) 全表扫描；
+- 首次打开时若存在旧的 JSONL 文件，自动按原顺序导入（单个 BEGIN IMMEDIATE 事务，meta 中记标志，
+  多个 worker 同时启动也只导入一次、中途崩溃不留半截），并把原文件改名为 *.migrated。
+- 统计（stats）：daily_stats 表按 (日期, 诊断, 状态) 保存计数、置信度和与 10 档置信度直方图，
+  由触发器随每次插入 / 删除增量更新；查询只读该表，代价为 O(天数 x 类别)，与历史总量无关。
+  统计表缺失或版本不符时（旧库、升级）从 history 一次性重建。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# 与 app._append_history 的记录结构一致；其余字段存入 extra（JSON）
+_FIELDS = ("date", "file_name", "diagnosis", "confidence", "status")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    date        TEXT NOT NULL,
+    file_name   TEXT,
+    diagnosis   TEXT,
+    confidence  REAL,
+    status      TEXT,
+    extra       TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_date ON history(date, id);
+CREATE INDEX IF NOT EXISTS idx_history_diagnosis ON history(diagnosis, id);
+CREATE INDEX IF NOT EXISTS idx_history_confidence ON history(confidence);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta(key, value) VALUES ('total', 0);
+CREATE TRIGGER IF NOT EXISTS trg_history_insert AFTER INSERT ON history
+BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'total';
+END;
+CREATE TRIGGER IF NOT EXISTS trg_history_delete AFTER DELETE ON history
+BEGIN
+    UPDATE meta SET value = value - 1 WHERE key = 'total';
+END;
+"""
+
+
+# 置信度直方图：[0,0.1) ... [0.9,1.0]，越界的截到两端
+STATS_BINS = 10
+STATS_VERSION = 1
+_BIN_EXPR = "MIN({n} - 1, MAX(0, CAST({conf} * {n} AS INTEGER)))"
+_HIST_COLS = [f"h{i}" for i in range(STATS_BINS)]
+
+
+def _stats_schema() -> str:
+    hist_cols = ", ".join(f"{c} INTEGER NOT NULL DEFAULT 0" for c in _HIST_COLS)
+
+    def _delta(sign: str, row: str) -> str:
+        b = _BIN_EXPR.format(n=STATS_BINS, conf=f"{row}.confidence")
+        sets = [f"n = n {sign} 1",
+                f"conf_n = conf_n {sign} ({row}.confidence IS NOT NULL)",
+                f"conf_sum = conf_sum {sign} COALESCE({row}.confidence, 0)"]
+        sets += [f"{c} = {c} {sign} ({row}.confidence IS NOT NULL AND {b} = {i})" for i, c in enumerate(_HIST_COLS)]
+        key = (f"date = {row}.date AND diagnosis = COALESCE({row}.diagnosis, '') "
+               f"AND status = COALESCE({row}.status, '')")
+        return f"UPDATE daily_stats SET {', '.join(sets)} WHERE {key};"
+
+    return f"""
+CREATE TABLE IF NOT EXISTS daily_stats (
+    date        TEXT NOT NULL,
+    diagnosis   TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    n           INTEGER NOT NULL DEFAULT 0,
+    conf_n      INTEGER NOT NULL DEFAULT 0,
+    conf_sum    REAL NOT NULL DEFAULT 0,
+    {hist_cols},
+    PRIMARY KEY (date, diagnosis, status)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS trg_stats_insert AFTER INSERT ON history
+BEGIN
+    INSERT OR IGNORE INTO daily_stats(date, diagnosis, status)
+        VALUES (NEW.date, COALESCE(NEW.diagnosis, ''), COALESCE(NEW.status, ''));
+    {_delta("+", "NEW")}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_stats_delete AFTER DELETE ON history
+BEGIN
+    {_delta("-", "OLD")}
+END;
+"""
+
+
+def _to_row(item: Dict[str, Any]) -> Tuple[Any, ...]:
+    extra = {k: v for k, v in item.items() if k not in _FIELDS and k != "id"}
+    return (
+        str(item.get("date") or ""),
+        item.get("file_name"),
+        item.get("diagnosis"),
+        float(item["confidence"]) if item.get("confidence") is not None else None,
+        item.get("status"),
+        json.dumps(extra, ensure_ascii=False) if extra else None,
+    )
+
+
+def _from_row(row: sqlite3.Row) -> Dict[str, Any]:
+    item = {"id": row["id"]}
+    item.update({k: row[k] for k in _FIELDS})
+    if row["extra"]:
+        try:
+            item.update(json.loads(row["extra"]))
+        except ValueError:
+            pass
+    return item
+
+
+class HistoryStore:
+    """
+    - db_path: SQLite 文件路径
+    - legacy_jsonl: 旧的 JSONL 历史文件；存在时首次打开自动迁移
+    连接按线程缓存（sqlite3 连接不能跨线程共享）。
+    """
+
+    def __init__(self, db_path: str, legacy_jsonl: Optional[str] = None):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        conn.executescript(_stats_schema())
+        self._ensure_stats()
+        if legacy_jsonl and os.path.exists(legacy_jsonl):
+            self.migrate_jsonl(legacy_jsonl)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ---------------------------
+    # 写入
+    # ---------------------------
+    def append(self, item: Dict[str, Any]) -> int:
+        """追加一条记录，返回其 id。"""
+        with self._write_lock:
+            cur = self._conn().execute(
+                "INSERT INTO history(date, file_name, diagnosis, confidence, status, extra) VALUES (?,?,?,?,?,?)",
+                _to_row(item),
+            )
+        return int(cur.lastrowid)
+
+    def extend(self, items: Iterable[Dict[str, Any]], chunk: int = 10000) -> int:
+        """批量追加（单事务，按 chunk 条分块 executemany 以限制内存），返回写入条数。"""
+        conn = self._conn()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                n = self._insert_many(conn, items, chunk)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return n
+
+    @staticmethod
+    def _insert_many(conn: sqlite3.Connection, items: Iterable[Dict[str, Any]], chunk: int) -> int:
+        """在调用方已开启的事务中分块插入。"""
+        n = 0
+        batch: List[Tuple[Any, ...]] = []
+        for item in items:
+            batch.append(_to_row(item))
+            if len(batch) >= chunk:
+                conn.executemany(
+                    "INSERT INTO history(date, file_name, diagnosis, confidence, status, extra) VALUES (?,?,?,?,?,?)",
+                    batch,
+                )
+                n += len(batch)
+                batch = []
+        if batch:
+            conn.executemany(
+                "INSERT INTO history(date, file_name, diagnosis, confidence, status, extra) VALUES (?,?,?,?,?,?)",
+                batch,
+            )
+            n += len(batch)
+        return n
+
+    def migrate_jsonl(self, path: str, chunk: int = 10000) -> int:
+        """
+        按文件顺序导入旧 JSONL（坏行跳过），完成后改名为 *.migrated；返回导入条数。
+        导入与 meta 标志 legacy_migrated 在同一个 BEGIN IMMEDIATE 事务中：多个进程同时打开时只有一个导入，
+        其余等锁后看到标志直接跳过；中途崩溃整体回滚，下次重新导入。源文件已不存在（被其他进程改名）视为已迁移。
+        """
+        def _lines():
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except Exception:
+                        continue
+
+        conn = self._conn()
+        n = 0
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'legacy_migrated'").fetchone()
+                if (row is None or not row[0]) and os.path.exists(path):
+                    n = self._insert_many(conn, _lines(), chunk)
+                    conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('legacy_migrated', 1)")
+                    migrated = True
+                else:
+                    migrated = False
+                conn.execute("COMMIT")
+            except FileNotFoundError:
+                conn.execute("ROLLBACK")   # 检查之后才被其他进程改名：已迁移
+                return 0
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        # 提交之后才改名；改名前崩溃时下次启动看到标志只补做改名
+        try:
+            os.replace(path, path + ".migrated")
+        except FileNotFoundError:
+            pass
+        if migrated:
+            print(f"[history] 已从 {path} 迁移 {n} 条记录")
+        return n
+
+    # ---------------------------
+    # 查询
+    # ---------------------------
+    @staticmethod
+    def _where(
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        diagnosis: Optional[str] = None,
+        min_confidence: Optional[float] = None,
+        max_confidence: Optional[float] = None,
+    ) -> Tuple[List[str], List[Any]]:
+        conds: List[str] = []
+        params: List[Any] = []
+        if date_from:
+            conds.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            conds.append("date <= ?")
+            params.append(date_to)
+        if diagnosis:
+            conds.append("diagnosis = ?")
+            params.append(diagnosis)
+        if min_confidence is not None:
+            conds.append("confidence >= ?")
+            params.append(float(min_confidence))
+        if max_confidence is not None:
+            conds.append("confidence <= ?")
+            params.append(float(max_confidence))
+        return conds, params
+
+    def count(self, **filters: Any) -> int:
+        conds, params = self._where(**filters)
+        if not conds:
+            return int(self._conn().execute("SELECT value FROM meta WHERE key = 'total'").fetchone()[0])
+        sql = "SELECT COUNT(*) FROM history WHERE " + " AND ".join(conds)
+        return int(self._conn().execute(sql, params).fetchone()[0])
+
+    def page(
+        self,
+        page: int = 1,
+        page_size: int = 10,
+        before_id: Optional[int] = None,
+        **filters: Any,
+    ) -> List[Dict[str, Any]]:
+        """
+        最新优先的一页记录。
+        - before_id: 游标分页，返回 id < before_id 的记录（此时忽略 page）
+        - filters: date_from / date_to（YYYY-MM-DD，含端点）、diagnosis、min_confidence / max_confidence
+        """
+        conds, params = self._where(**filters)
+        offset = 0
+        if before_id is not None:
+            conds.append("id < ?")
+            params.append(int(before_id))
+        else:
+            offset = max(0, (int(page) - 1) * int(page_size))
+        sql = "SELECT * FROM history"
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        sql += " ORDER BY id DESC LIMIT ? OFFSET ?"
+        rows = self._conn().execute(sql, params + [max(0, int(page_size)), offset]).fetchall()
+        return [_from_row(r) for r in rows]
+
+    def get(self, ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """按 id 批量取记录：{id: item}；不存在的 id 不在结果中。"""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return {}
+        rows = self._conn().execute(
+            f"SELECT * FROM history WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall()
+        return {int(r["id"]): _from_row(r) for r in rows}
+
+    # ---------------------------
+    # 统计
+    # ---------------------------
+    def _ensure_stats(self) -> None:
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'stats_version'").fetchone()
+        if row is None or int(row[0]) != STATS_VERSION:
+            self.rebuild_stats()
+
+    def rebuild_stats(self) -> int:
+        """从 history 全量重建 daily_stats（单事务，期间写入阻塞），返回分组数。"""
+        b = _BIN_EXPR.format(n=STATS_BINS, conf="confidence")
+        hist = ", ".join(f"SUM(confidence IS NOT NULL AND {b} = {i})" for i in range(STATS_BINS))
+        conn = self._conn()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM daily_stats")
+                conn.execute(
+                    f"INSERT INTO daily_stats(date, diagnosis, status, n, conf_n, conf_sum, {', '.join(_HIST_COLS)}) "
+                    f"SELECT date, COALESCE(diagnosis, ''), COALESCE(status, ''), COUNT(*), COUNT(confidence), "
+                    f"COALESCE(SUM(confidence), 0), {hist} FROM history "
+                    f"GROUP BY date, COALESCE(diagnosis, ''), COALESCE(status, '')"
+                )
+                conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('stats_version', ?)", (STATS_VERSION,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        n = int(conn.execute("SELECT COUNT(*) FROM daily_stats").fetchone()[0])
+        if n:
+            print(f"[history] 已从历史记录重建统计（{n} 组）")
+        return n
+
+    def stats(
+        self,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        diagnosis: Optional[str] = None,
+        status: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        汇总统计（只读 daily_stats）：
+        {
+          "total", "mean_confidence", "histogram": [STATS_BINS 个计数], "bins": [各档下界...],
+          "days":   [{"date", "count", "mean_confidence"}, ...],                 # 按日期升序
+          "labels": [{"diagnosis", "count", "mean_confidence", "histogram"}, ...],  # 按数量降序
+          "series": [{"date", "diagnosis", "count", "mean_confidence"}, ...],    # 每天每个诊断
+          "statuses": {status: count}
+        }
+        """
+        conds: List[str] = []
+        params: List[Any] = []
+        for col, op, v in (("date", ">=", date_from), ("date", "<=", date_to),
+                           ("diagnosis", "=", diagnosis), ("status", "=", status)):
+            if v:
+                conds.append(f"{col} {op} ?")
+                params.append(v)
+        sql = f"SELECT date, diagnosis, status, n, conf_n, conf_sum, {', '.join(_HIST_COLS)} FROM daily_stats"
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        sql += " ORDER BY date"
+
+        def _acc() -> List[float]:
+            return [0, 0, 0.0] + [0] * STATS_BINS   # n, conf_n, conf_sum, hist...
+
+        def _add(acc: List[float], row: sqlite3.Row) -> None:
+            acc[0] += row["n"]
+            acc[1] += row["conf_n"]
+            acc[2] += row["conf_sum"]
+            for i, c in enumerate(_HIST_COLS):
+                acc[3 + i] += row[c]
+
+        def _mean(acc: List[float]) -> Optional[float]:
+            return acc[2] / acc[1] if acc[1] else None
+
+        total, days, labels, series, statuses = _acc(), {}, {}, {}, {}
+        for row in self._conn().execute(sql, params):
+            if row["n"] <= 0:
+                continue
+            _add(total, row)
+            _add(days.setdefault(row["date"], _acc()), row)
+            _add(labels.setdefault(row["diagnosis"], _acc()), row)
+            _add(series.setdefault((row["date"], row["diagnosis"]), _acc()), row)
+            statuses[row["status"]] = statuses.get(row["status"], 0) + int(row["n"])
+        return {
+            "total": int(total[0]),
+            "mean_confidence": _mean(total),
+            "histogram": [int(v) for v in total[3:]],
+            "bins": [i / float(STATS_BINS) for i in range(STATS_BINS)],
+            "days": [{"date": d, "count": int(a[0]), "mean_confidence": _mean(a)} for d, a in days.items()],
+            "labels": sorted(
+                ({"diagnosis": k, "count": int(a[0]), "mean_confidence": _mean(a), "histogram": [int(v) for v in a[3:]]}
+                 for k, a in labels.items()),
+                key=lambda x: -x["count"],
+            ),
+            "series": [{"date": d, "diagnosis": k, "count": int(a[0]), "mean_confidence": _mean(a)}
+                       for (d, k), a in series.items()],
+            "statuses": statuses,
+        }
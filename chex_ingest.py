@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+chex_ingest.py — analyze / analyze_batch 的异步上传接收（流式 multipart 解析）
+
+FastAPI 的 UploadFile 要等整个请求体接收完才进入处理函数，且没有大小上限；慢客户端上传大 DICOM 时，
+同步处理函数还会占住线程池线程。这里直接消费 request.stream()，边接收边：
+- 累计大小：Content-Length 超限直接拒绝；流式接收中超过 max_bytes 立即 413，不再读取剩余数据；
+- 增量 sha256（与 chex_cache.hash_file 结果一致，结果缓存无需再读一遍文件）；
+- 文件头到达即按魔数识别类型（PNG / JPEG / DICOM / …），不支持的类型立即拒绝；
+- 内容写入 SpooledTemporaryFile：小文件在内存，超过 spool_bytes 溢出到临时文件，不在内存中持有整个大文件。
+事件循环里只做上述 I/O；解码与推理由调用方交给专用线程池（见 app.analyze）。
+Upload 归调用方所有、用完自行 close()，不受请求结束时 FastAPI 关闭表单文件的影响。
+"""
+
+import hashlib
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:   # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# 识别类型时最多看的文件头长度（DICOM 魔数在 128 字节前导之后）
+SNIFF_BYTES = 132
+# 表单字段（非文件）的大小上限
+MAX_FIELD_BYTES = 64 * 1024
+
+IMAGE_KINDS = ("png", "jpeg", "dicom", "bmp", "tiff", "webp", "gif")
+
+
+class UploadError(ValueError):
+    """上传无法接收；error_code / status_code 直接用于 HTTP 错误响应。"""
+
+    error_code = "BAD_REQUEST"
+    status_code = 400
+
+
+class UploadTooLarge(UploadError):
+    error_code = "FILE_TOO_LARGE"
+    status_code = 413
+
+
+class TooManyFiles(UploadError):
+    error_code = "TOO_MANY_FILES"
+    status_code = 413
+
+
+class BadFileType(UploadError):
+    error_code = "BAD_FILE_TYPE"
+    status_code = 400
+
+
+def sniff(head: bytes, filename: str = "") -> Optional[str]:
+    """按文件头魔数识别类型；无前导的 DICOM（扩展名 .dcm、以 0008 组开头）也接受。"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head[128:132] == b"DICM":
+        return "dicom"
+    if filename.lower().endswith(".dcm") and head[:2] in (b"\x08\x00", b"\x02\x00"):
+        return "dicom"
+    if head.startswith(b"BM"):
+        return "bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:4] == b"GIF8":
+        return "gif"
+    if head[:4] == b"PK\x03\x04":
+        return "zip"
+    return None
+
+
+class Upload:
+    """一次 multipart 请求中的上传文件与普通表单字段。"""
+
+    def __init__(self, spool_bytes: int):
+        self.fields: Dict[str, str] = {}
+        self.filename: str = ""
+        self.content_type: str = ""
+        self.kind: Optional[str] = None
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        self._sha = hashlib.sha256()
+        self.sha256: str = ""
+        self.received = False
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class _Receiver:
+    """python-multipart 回调：解析各 part 的头，每个文件 part 写入一个新的 Upload。"""
+
+    def __init__(self, file_field: str, max_bytes: int, spool_bytes: int, kinds: Optional[Tuple[str, ...]],
+                 max_files: int = 1):
+        self.file_field = file_field
+        self.max_bytes = int(max_bytes)     # 所有文件合计
+        self.spool_bytes = int(spool_bytes)
+        self.kinds = kinds                  # None 时不按类型拒绝，只记录 Upload.kind
+        self.max_files = int(max_files)
+        self.fields: Dict[str, str] = {}
+        self.uploads: List[Upload] = []
+        self.upload: Optional[Upload] = None
+        self.total = 0
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: Dict[bytes, bytes] = {}
+        self._name = ""
+        self._is_file = False
+        self._field = bytearray()
+        self._head = bytearray()
+        self._sniffed = False
+
+    def close(self) -> None:
+        for up in self.uploads:
+            up.close()
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self) -> None:
+        self._headers = {}
+        self._field = bytearray()
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field, self._header_value = b"", b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._name = options.get(b"name", b"").decode("utf-8", "replace")
+        self._is_file = self._name == self.file_field and b"filename" in options
+        if self._is_file:
+            if len(self.uploads) >= self.max_files:
+                if self.max_files == 1:
+                    raise UploadError(f"只能上传一个 {self.file_field}")
+                raise TooManyFiles(f"At most {self.max_files} files per batch.")
+            up = self.upload = Upload(self.spool_bytes)
+            self.uploads.append(up)
+            up.fields = self.fields
+            up.received = True
+            up.filename = options[b"filename"].decode("utf-8", "replace")
+            up.content_type = self._headers.get(b"content-type", b"").decode("latin-1")
+            self._head = bytearray()
+            self._sniffed = False
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        chunk = data[start:end]
+        if not self._is_file:
+            self._field += chunk
+            if len(self._field) > MAX_FIELD_BYTES:
+                raise UploadError(f"表单字段过大: {self._name}")
+            return
+        up = self.upload
+        up.size += len(chunk)
+        self.total += len(chunk)
+        if self.total > self.max_bytes:
+            raise UploadTooLarge(f"{'文件' if self.max_files == 1 else '上传合计'}超过上限 {self.max_bytes / (1 << 20):g} MB")
+        up._sha.update(chunk)
+        up.file.write(chunk)
+        if not self._sniffed:
+            self._head += chunk[:SNIFF_BYTES]
+            if len(self._head) >= SNIFF_BYTES:
+                self._sniff()
+
+    def on_part_end(self) -> None:
+        if self._is_file:
+            if not self._sniffed:
+                self._sniff()
+        elif self._name:
+            self.fields[self._name] = self._field.decode("utf-8", "replace")
+
+    def _sniff(self) -> None:
+        self._sniffed = True
+        kind = sniff(bytes(self._head[:SNIFF_BYTES]), self.upload.filename)
+        if self.kinds is not None and (kind is None or kind not in self.kinds):
+            raise BadFileType("Only jpg/png/dcm supported.")
+        self.upload.kind = kind
+
+
+async def _receive(request, receiver: _Receiver) -> List[Upload]:
+    ctype, params = parse_options_header(request.headers.get("content-type", ""))
+    if ctype != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("需要 multipart/form-data")
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > receiver.max_bytes + MAX_FIELD_BYTES:
+        raise UploadTooLarge(f"请求超过上限 {receiver.max_bytes / (1 << 20):g} MB")
+
+    parser = MultipartParser(params[b"boundary"], receiver.callbacks())
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                parser.write(chunk)
+        parser.finalize()
+        if not receiver.uploads:
+            raise UploadError(f"缺少文件字段 {receiver.file_field}")
+    except UploadError:
+        receiver.close()
+        raise
+    except Exception as e:   # 截断 / 格式错误的 multipart
+        receiver.close()
+        raise UploadError(f"无法解析上传内容: {e}")
+    for up in receiver.uploads:
+        up.sha256 = up._sha.hexdigest()
+        up.file.seek(0)
+    return receiver.uploads
+
+
+async def receive_upload(
+    request,
+    file_field: str = "file",
+    max_bytes: int = 100 << 20,
+    spool_bytes: int = 8 << 20,
+    kinds: Tuple[str, ...] = IMAGE_KINDS,
+) -> Upload:
+    """
+    流式接收 multipart/form-data 请求：返回 Upload（file 已复位到开头，sha256 已算好）。
+    出错时抛出 UploadError 的子类，已接收的数据随之释放；调用方用完 Upload 后须 close()。
+    """
+    return (await _receive(request, _Receiver(file_field, max_bytes, spool_bytes, kinds)))[0]
+
+
+async def receive_uploads(
+    request,
+    file_field: str = "files",
+    max_bytes: int = 1 << 30,
+    spool_bytes: int = 8 << 20,
+    kinds: Optional[Tuple[str, ...]] = None,
+    max_files: int = 512,
+) -> List[Upload]:
+    """
+    同 receive_upload，但接收同名字段下的多个文件（analyze_batch）：max_bytes 为所有文件合计的上限，
+    表单字段共享在每个 Upload.fields 中。kinds=None 时不按类型拒绝整个请求，由调用方逐个文件处理。
+    调用方用完后须逐个 close()。
+    """
+    return await _receive(request, _Receiver(file_field, max_bytes, spool_bytes, kinds, max_files))
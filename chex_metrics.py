@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+chex_metrics.py — 进程内指标（Prometheus 文本格式，无第三方依赖）
+
+- Histogram / Counter / Gauge 三种指标，支持标签；Gauge 可以是采集时回调（队列深度、缓存命中率、模型内存等）；
+- timed(stage, timings) 记录分阶段耗时到 chex_stage_seconds{stage=...}，同时可累加到调用方的 timings 字典
+  （毫秒），用于在响应 meta 中返回单次请求的分阶段耗时；
+- 每次观测只有一次 perf_counter 差值、一次二分查找与一把锁，开销在微秒级；
+  CHEX_METRICS=0 时 timed 只做 timings 累加，不写直方图。
+
+GET /metrics 返回 REGISTRY.render()。指标为进程内状态：chex_serve 多 worker 部署时每次抓取只对应其中一个 worker。
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+ENABLED = os.environ.get("CHEX_METRICS", "1") == "1"
+
+# 秒；覆盖 1ms（解码小图）到 10s（大图 + CAM + 排队）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, buckets: Sequence[float] = LATENCY_BUCKETS, labelnames: Sequence[str] = ()):
+        self.name, self.doc = name, doc
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}   # labels -> [各桶计数..., +Inf 计数, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+            s[i] += 1
+            s[-1] += value
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Tuple[List[float], float]]:
+        with self._lock:
+            return {k: (list(v[:-1]), v[-1]) for k, v in self._series.items()}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.snapshot().items()):
+            acc = 0.0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                le_label = 'le="%s"' % _fmt_value(le)
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, le_label)} {_fmt_value(acc)}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {_fmt_value(total)}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {_fmt_value(acc)}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        self.name, self.doc = name, doc
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in items]
+        return lines
+
+
+class Gauge:
+    """fn 给定时在采集时调用，返回 {标签元组: 值} 或单个值。"""
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = (), fn: Optional[Callable[[], object]] = None):
+        self.name, self.doc = name, doc
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = float(value)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge"]
+        if self.fn is not None:
+            try:
+                v = self.fn()
+            except Exception:
+                return lines
+            items = sorted(v.items()) if isinstance(v, dict) else [((), v)]
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        lines += [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in items if v is not None]
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name: str, doc: str, buckets: Sequence[float] = LATENCY_BUCKETS, labelnames: Sequence[str] = ()) -> Histogram:
+        return self._add(Histogram(name, doc, buckets, labelnames))
+
+    def counter(self, name: str, doc: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, doc, labelnames))
+
+    def gauge(self, name: str, doc: str, labelnames: Sequence[str] = (), fn: Optional[Callable[[], object]] = None) -> Gauge:
+        """同名 gauge 重复注册时更新回调（例如 app 重新加载）。"""
+        g = self._add(Gauge(name, doc, labelnames, fn))
+        if fn is not None:
+            g.fn = fn
+        return g
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for m in metrics:
+            lines += m.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("chex_stage_seconds", "Per-stage latency in seconds", labelnames=("stage",))
+BATCH_SIZE = REGISTRY.histogram("chex_batch_size", "Images per model forward pass", buckets=BATCH_BUCKETS)
+REQUESTS = REGISTRY.counter("chex_requests_total", "Handled API requests", labelnames=("endpoint", "status"))
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    if ENABLED:
+        STAGE_SECONDS.observe(seconds, stage)
+
+
+@contextmanager
+def timed(stage: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+    """记录 with 块耗时；timings 给定时按阶段累加毫秒数。"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        if ENABLED:
+            STAGE_SECONDS.observe(dt, stage)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + dt * 1000.0
+
+
+def process_rss_bytes() -> Optional[float]:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return float(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+REGISTRY.gauge("chex_process_resident_bytes", "Resident set size of this process", fn=process_rss_bytes)
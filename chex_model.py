@@ -5,24 +5,35 @@ test.py — 推理侧重构（仅单文件修改，不新增目录）
 1) 提供可被后端直接调用的两个函数：
    - init_model(model_path, class_names=None, device=None, use_imagenet_norm=False)
    - infer(pil_image or str(path), generate_heatmap=True, threshold=0.5, alpha=0.45, return_top_k=None)
+   - infer_batch([...], ...)：多张图合并为一次前向（供 chex_batching 微批调度使用）
+   - infer_decoded([...], ...)：同上，输入为已解码的 Decoded（供 chex_bulk 离线批量推理使用）
+   - compute_cams(feats, weight, select)：批量 CAM（einsum，一次算完所有类别）
+   - infer_features(features, probs, ...)：分诊模式下暂缓的热力图，由缓存的特征图补算（不再前向）
+   - embeddings(feats)：池化后的特征向量，供相似病例检索（chex_similar）
 2) 保持原单脚本可运行（__main__），但不强依赖交互；支持命令行快速测试。
 
 注意：
 - 不在此文件内实现 Web 服务，仅作为“模型层”被调用。
 - 归一化默认关闭（与原先未做归一化保持一致）；如训练期用了 ImageNet Normalize，可将 use_imagenet_norm=True。
+- init_model 之后推理路径不再写任何模块级状态（CAM 特征随前向一起返回），infer / infer_batch 可多线程并发调用。
 """
 
+import copy
+import hashlib
 import os
-from typing import Any, Dict, List, Optional, Tuple, Union
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
-import cv2
 import numpy as np
 from PIL import Image
 
 import torch
 import torch.nn as nn
-import torchvision.transforms as T
-from torchvision import models
+import torch.nn.functional as F
+
+import chex_metrics
+from chex_metrics import timed
+from chex_preprocess import Decoded, ImageInput, Preprocessor
 
 # ---------------------------
 # 全局缓存（进程内只加载一次）
@@ -30,8 +41,15 @@ from torchvision import models
 _MODEL: Optional[nn.Module] = None
 _CLASS_NAMES: Optional[List[str]] = None
 _DEVICE: Optional[torch.device] = None
-_TRANSFORM: Optional[T.Compose] = None
-_LAST_FEATS: Optional[torch.Tensor] = None  # 用于 CAM
+_PREPROCESSOR: Optional[Preprocessor] = None
+_MODEL_VERSION: Optional[str] = None  # 权重内容哈希 + 预处理配置，供结果缓存等做键
+_RUNNER: Optional[Callable[[torch.Tensor], Tuple[torch.Tensor, torch.Tensor]]] = None  # 见 chex_backends
+_BACKEND: str = "eager"
+_EMBEDDING_SPACE: Optional[str] = None  # 嵌入所在的特征空间（权重哈希 + 归一化 + 集成），与推理后端无关
+_CAM_WEIGHT: Optional[torch.Tensor] = None  # [K,C]，CAM 用的分类头权重（集成时为各成员按通道拼接，见 chex_ensemble）
+
+# 分诊时不计入“阳性”的类别
+TRIAGE_IGNORE = ("No Finding",)
 
 def _get_device(explicit: Optional[str] = None) -> torch.device:
     if explicit:
@@ -43,6 +61,8 @@ def _get_device(explicit: Optional[str] = None) -> torch.device:
 # 模型构建与加载
 # ---------------------------
 def _build_densenet121(num_classes: int) -> nn.Module:
+    from torchvision import models  # 只有需要构建模型时才导入（较慢）
+
     model = models.densenet121(weights=None)
     in_features = model.classifier.in_features
     model.classifier = nn.Sequential(
@@ -52,27 +72,8 @@ def _build_densenet121(num_classes: int) -> nn.Module:
     return model
 
 
-def init_model(
-    model_path: str,
-    class_names: Optional[List[str]] = None,
-    device: Optional[str] = None,
-    use_imagenet_norm: bool = False,
-) -> Tuple[nn.Module, List[str]]:
-    """
-    加载模型与类别名，并注册 CAM 钩子。
-    - model_path: 训练得到的权重 .pth / .pt
-    - class_names: 类别名列表；如果为空，会从权重推断 num_classes 并使用占位名 C0..Cn-1
-    - device: 'cuda' / 'cpu'；默认自动
-    - use_imagenet_norm: 若训练期用过 ImageNet 归一化，则置 True
-    """
-    global _MODEL, _CLASS_NAMES, _DEVICE, _TRANSFORM, _LAST_FEATS
-
-    _DEVICE = _get_device(device)
-
-    # 读取权重
-    if not os.path.exists(model_path):
-        raise FileNotFoundError(f"模型权重未找到: {model_path}")
-
+def _load_checkpoint(model_path: str, class_names: Optional[List[str]]) -> Tuple[nn.Module, List[str]]:
+    """读取训练保存的 .pth，构建 densenet121 并拷贝权重。"""
     state = torch.load(model_path, map_location="cpu")
     # 兼容保存的是 {'model_state_dict':..., 'class_names':...}
     if isinstance(state, dict) and "state_dict" in state:
@@ -110,145 +111,200 @@ def init_model(
         # 打印提示但不中断
         print(f"[test.py] load_state_dict 提示 missing={missing} unexpected={unexpected}")
 
-    model.eval().to(_DEVICE)
+    return model, class_names
+
 
-    # 注册特征图钩子（DenseNet 的 features 输出）
-    def _hook(module, inp, out):
-        global _LAST_FEATS  # ← 这里把 nonlocal 改为 global
-        _LAST_FEATS = out.detach()  # [B, C, H, W]
+def init_model(
+    model_path: str,
+    class_names: Optional[List[str]] = None,
+    device: Optional[str] = None,
+    use_imagenet_norm: bool = False,
+    backend: str = "eager",
+    fold_bn: bool = False,
+    channels_last: bool = False,
+    onnx_path: Optional[str] = None,
+    precision: str = "fp32",
+    calib_dir: Optional[str] = None,
+    calib_images: int = 256,
+    verify: bool = True,
+    cache_dir: Optional[str] = None,
+    warmup: bool = False,
+    ensemble: Optional[Sequence[str]] = None,
+    tta: Sequence[str] = (),
+) -> Tuple[nn.Module, List[str]]:
+    """
+    加载模型与类别名。
+    - model_path: 训练得到的权重 .pth / .pt
+    - class_names: 类别名列表；如果为空，会从权重推断 num_classes 并使用占位名 C0..Cn-1
+    - device: 'cuda' / 'cpu'；默认自动
+    - use_imagenet_norm: 若训练期用过 ImageNet 归一化，则置 True
+    - backend: eager / torchscript / compile / onnx（见 chex_backends）
+    - fold_bn / channels_last: BN 折叠、NHWC 内存布局
+    - onnx_path: onnx 后端的模型文件；默认 <model_path>.<权重哈希>.onnx，不存在时自动导出
+    - precision: fp32 / bf16（autocast）/ int8（静态量化，需 calib_dir 目录或 CSV 清单，取前 calib_images 张校准）
+    - verify: 启用任何优化时，先与 eager 模型比较概率与 CAM，超出容差则退回 eager
+    - cache_dir: 缓存产物目录（见 chex_artifact）；按权重哈希命中时 mmap 加载，TorchScript 后端的图也一并缓存
+    - warmup: 加载后跑一次完整推理（含 CAM 与叠加），避免首个请求承担延迟初始化的开销
+    - ensemble: 附加的同结构权重路径（可含通配符），与主模型做概率 / CAM 平均（见 chex_ensemble）
+    - tta: 测试时增强视图，flip / crops 的子集
+    """
+    global _MODEL, _CLASS_NAMES, _DEVICE, _PREPROCESSOR, _MODEL_VERSION, _RUNNER, _BACKEND, _CAM_WEIGHT, _EMBEDDING_SPACE
 
-    model.features.register_forward_hook(_hook)
+    _DEVICE = _get_device(device)
 
-    # 预处理
-    tfms = [
-        T.Resize((224, 224)),
-        T.ToTensor(),
-    ]
-    if use_imagenet_norm:
-        tfms.append(T.Normalize(mean=[0.485, 0.456, 0.406],
-                                std=[0.229, 0.224, 0.225]))
-    _TRANSFORM = T.Compose(tfms)
+    # 读取权重
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"模型权重未找到: {model_path}")
+    weights_hash = file_sha256(model_path)[:16]
+
+    # 优先使用按权重哈希缓存的产物（mmap 加载，跳过随机初始化与 BN 折叠）
+    artifact = None
+    cached = None
+    if cache_dir:
+        import chex_artifact  # noqa
+        artifact = chex_artifact.artifact_path(cache_dir, weights_hash, fold_bn)
+        cached = chex_artifact.load_or_none(artifact, _build_densenet121)
+    if cached is not None:
+        model, cached_names, folded = cached
+        if class_names is None:
+            class_names = cached_names
+        else:
+            assert len(class_names) == len(cached_names), "class_names 长度与权重类别数不一致"
+        print(f"[test.py] 从缓存产物加载: {artifact}")
+    else:
+        model, class_names = _load_checkpoint(model_path, class_names)
+        folded = False
+
+    model.eval().to(_DEVICE)
+
+    # 预处理（与 Resize(224) + ToTensor [+ Normalize] 数值一致）；INT8 校准也要用到
+    _PREPROCESSOR = Preprocessor(224, use_imagenet_norm=use_imagenet_norm)
+
+    # 推理后端 / 精度（eager fp32 以外的形态由 chex_backends / chex_quant 构建）
+    precision = (precision or "fp32").lower()
+    if precision not in ("fp32", "bf16", "int8"):
+        raise ValueError(f"未知精度: {precision}（可选 fp32 / bf16 / int8）")
+    runner, tag = _eager_runner(model), "eager"
+    if backend != "eager" or fold_bn or channels_last or precision != "fp32":
+        import chex_backends  # noqa
+        # 一致性自检的参照（来自缓存产物时已是折叠后的模型，折叠本身在生成产物时已校验过）
+        changed = backend != "eager" or channels_last or precision != "fp32" or (fold_bn and not folded)
+        reference, ref_folded = (copy.deepcopy(model), folded) if verify and changed else (None, folded)
+        if fold_bn and not folded:
+            print(f"[test.py] BN 折叠: {chex_backends.fold_batchnorm(model)} 处")
+            folded = True
+        example = torch.rand(2, 3, 224, 224, generator=torch.Generator().manual_seed(0)).to(_DEVICE)
+        tag = "-".join([backend if precision == "fp32" else precision]
+                       + (["fold"] if fold_bn else []) + (["cl"] if channels_last else []))
+        atol = (1e-3, 1e-2)
+        try:
+            if precision == "fp32":
+                if backend == "onnx" and onnx_path is None:
+                    onnx_path = f"{model_path}.{weights_hash}{'.folded' if fold_bn else ''}.onnx"
+                ts_cache = os.path.join(cache_dir, f"densenet121-{weights_hash}-{tag}.ts") if cache_dir else None
+                runner = chex_backends.build_runner(model, backend, channels_last, example, onnx_path, cache_path=ts_cache)
+            else:
+                import chex_quant  # noqa
+                if backend != "eager":
+                    print(f"[test.py] precision={precision} 时不使用 backend={backend}")
+                atol = chex_quant.TOLERANCES[precision]
+                runner = chex_quant.build_runner(model, precision, channels_last, calib_dir, calib_images)
+        except Exception as e:
+            # 缺少 onnxruntime / 不支持 torch.compile / CPU 不支持 bf16 / 无校准数据等：不影响服务，按 eager 继续
+            print(f"[test.py] 后端 {tag} 构建失败，退回 eager：{e}")
+            if reference is not None:
+                model, tag, folded = reference, "eager", ref_folded
+            else:
+                tag = "eager-fold" if fold_bn else "eager"
+            runner, reference = _eager_runner(model), None
+        if reference is not None:
+            linear = _find_linear(reference.classifier)
+            parity = chex_backends.check_parity(_eager_runner(reference), runner, linear.weight, example, *atol)
+            print(f"[test.py] 后端 {tag} 一致性: prob {parity['max_prob_diff']:.2e} cam {parity['max_cam_diff']:.2e}")
+            if not parity["ok"]:
+                print(f"[test.py] 后端 {tag} 超出容差，退回 eager")
+                model, runner, tag, folded = reference, _eager_runner(reference), "eager", ref_folded
+
+    # 首次加载：生成缓存产物（只在折叠状态与配置一致时保存，自检失败退回的不缓存）
+    if artifact is not None and cached is None and folded == bool(fold_bn):
+        try:
+            chex_artifact.save_model(artifact, model, class_names, folded)
+            print(f"[test.py] 已写入缓存产物: {artifact}")
+        except OSError as e:
+            print(f"[test.py] 缓存产物写入失败：{e}")
+
+    linear = _find_linear(model.classifier)
+    cam_weight = linear.weight if linear is not None else None
+
+    # TTA / 多模型集成：包在已构建的 runner 之外，主模型之外的成员用 eager
+    if ensemble or tta:
+        import chex_ensemble  # noqa
+        registry = chex_ensemble.ModelRegistry(class_names, _DEVICE)
+        registry.add(os.path.basename(model_path), model, runner, weights_hash)
+        for path in chex_ensemble.resolve_paths(ensemble or (), exclude=model_path):
+            registry.load(path, fold_bn=fold_bn, channels_last=channels_last)
+        ens = chex_ensemble.EnsembleRunner(registry, tta)
+        runner, cam_weight = ens, ens.cam_weight
+        tag = ens.tag if tag == "eager" else f"{tag}-{ens.tag}"
 
     _MODEL = model
+    _RUNNER = runner
+    _BACKEND = tag
+    _CAM_WEIGHT = cam_weight
     _CLASS_NAMES = class_names
-
-    print(f"[test.py] 模型已加载: classes={len(class_names)} device={_DEVICE}")
+    _MODEL_VERSION = f"densenet121-{weights_hash}-{'imagenet' if use_imagenet_norm else 'raw'}"
+    _EMBEDDING_SPACE = _MODEL_VERSION + (f"-{ens.tag}" if ensemble or tta else "")
+    if tag != "eager":
+        _MODEL_VERSION += f"-{tag}"
+
+    print(f"[test.py] 模型已加载: classes={len(class_names)} device={_DEVICE} backend={tag}")
+    if warmup:
+        _warmup()
     return _MODEL, _CLASS_NAMES
 
 
-# ---------------------------
-# 工具：图片输入
-# ---------------------------
-def _to_pil(img: Union[str, Image.Image, np.ndarray]) -> Image.Image:
-    if isinstance(img, Image.Image):
-        return img.convert("RGB")
-    if isinstance(img, str):
-        if not os.path.exists(img):
-            raise FileNotFoundError(f"图片不存在: {img}")
-        return Image.open(img).convert("RGB")
-    if isinstance(img, np.ndarray):
-        # BGR -> RGB
-        if img.ndim == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-        else:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        return Image.fromarray(img)
-    raise TypeError(f"不支持的输入类型: {type(img)}")
+def _warmup() -> None:
+    """一次带热力图的完整推理：触发算子 / 内存池初始化与 cv2 的延迟导入。"""
+    t0 = time.perf_counter()
+    size = _PREPROCESSOR.size
+    infer(np.zeros((size, size), dtype=np.uint8), generate_heatmap=True)
+    print(f"[test.py] 预热完成: {(time.perf_counter() - t0) * 1000:.0f} ms")
 
 
-def _make_cam(
-    feats: torch.Tensor,  # [1,C,H,W]
-    classifier: nn.Module,
-    probs: np.ndarray,      # [K]
-    pos_indices: List[int], # 需要可视化的类别索引
-    target_size: Tuple[int, int]
-) -> np.ndarray:
-    """
-    简易 CAM：使用分类器第一层线性权重与 features 做加权求和。
-    多标签场景，我们将多个 positive 类的 CAM 做归一化后求和。
-    """
-    # 取线性层
-    if isinstance(classifier, nn.Sequential):
-        linear = None
-        for m in classifier.modules():
-            if isinstance(m, nn.Linear):
-                linear = m
-                break
-    elif isinstance(classifier, nn.Linear):
-        linear = classifier
-    else:
-        linear = None
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
-    if linear is None:
-        return None
 
-    with torch.no_grad():
-        w = linear.weight.detach().cpu().numpy()  # [K, C]
-        f = feats.detach().cpu().numpy()[0]       # [C, H, W]
-
-    cams = []
-    for idx in pos_indices:
-        if idx < 0 or idx >= w.shape[0]:
-            continue
-        cam = (w[idx][:, None, None] * f).sum(axis=0)  # [H, W]
-        cam = np.maximum(cam, 0)
-        cam -= cam.min()
-        if cam.max() > 0:
-            cam /= cam.max()
-        cams.append(cam)
-
-    if not cams:
-        # 如果没有 positive，就取最大概率那个类
-        top_idx = int(np.argmax(probs))
-        cam = (w[top_idx][:, None, None] * f).sum(axis=0)
-        cam = np.maximum(cam, 0)
-        cam -= cam.min()
-        if cam.max() > 0:
-            cam /= cam.max()
-        cams = [cam]
-
-    cam_sum = np.clip(np.sum(cams, axis=0), 0, 1)  # 聚合
-    cam_resized = cv2.resize(cam_sum, (target_size[0], target_size[1]))  # (W,H)
-    heatmap = (cam_resized * 255).astype(np.uint8)
-    return heatmap  # 0~255
+def model_version() -> Optional[str]:
+    """当前已加载模型的版本标识（权重哈希 + 归一化方式 + 非 eager 时的后端）；未初始化时为 None。"""
+    return _MODEL_VERSION
 
 
-def infer(
-    image: Union[str, Image.Image, np.ndarray],
-    generate_heatmap: bool = True,
-    threshold: float = 0.5,
-    alpha: float = 0.45,
-    return_top_k: Optional[int] = None
-) -> Dict[str, Any]:
-    """
-    对单张图片做推理。返回结构便于上层服务装配 JSON。
-    - image: 路径 / PIL / ndarray
-    - threshold: 0~1；用于将概率二值化
-    - return_top_k: 若给定，仅返回前 k 个类别到 positive_findings
-    返回：
-    {
-      'probs': {label: float, ...},
-      'preds': {label: 0|1, ...},
-      'positive_findings': [{'label','confidence'}, ...],
-      'heatmap': PIL.Image or None
-    }
-    """
-    global _MODEL, _CLASS_NAMES, _DEVICE, _TRANSFORM, _LAST_FEATS
+def embedding_space() -> Optional[str]:
+    """嵌入的特征空间标识：不同权重 / 归一化 / 集成的嵌入不可互相比较；BN 折叠等后端优化不改变它。"""
+    return _EMBEDDING_SPACE
 
-    if _MODEL is None or _CLASS_NAMES is None or _TRANSFORM is None:
-        raise RuntimeError("模型未初始化。请先调用 init_model(model_path, ...)")
 
-    pil = _to_pil(image)
-    orig_w, orig_h = pil.size
+def embedding_dim() -> Optional[int]:
+    """嵌入维度（DenseNet121 为 1024；集成时为各成员按通道拼接）。"""
+    return int(_CAM_WEIGHT.shape[1]) if _CAM_WEIGHT is not None else None
 
-    # 预处理
-    tensor = _TRANSFORM(pil).unsqueeze(0).to(_DEVICE)
 
-    with torch.no_grad():
-        _LAST_FEATS = None
-        outputs = _MODEL(tensor)             # [1, K]，已 Sigmoid
-        probs = outputs.squeeze(0).detach().cpu().numpy()  # [K]
+def backend_name() -> str:
+    """实际生效的推理后端（自检失败退回时为 eager）。"""
+    return _BACKEND
+
 
+def classify(probs: np.ndarray, threshold: float = 0.5, return_top_k: Optional[int] = None) -> Dict[str, Any]:
+    """
+    由概率 [K] 计算二值化结果与阳性项（不跑模型），
+    返回 infer 结果中的 'probs' / 'preds' / 'positive_findings' 三项。
+    """
+    probs = np.asarray(probs, dtype=np.float32)
     preds = (probs > float(threshold)).astype(np.int32)     # [K]
 
     # 组织结果
@@ -264,25 +320,408 @@ def infer(
     if return_top_k is not None:
         findings = findings[: int(return_top_k)]
 
+    return {"probs": probs_dict, "preds": preds_dict, "positive_findings": findings}
+
+
+def triage_scores(probs: np.ndarray) -> np.ndarray:
+    """
+    分诊分数：各图除 TRIAGE_IGNORE 之外各类别的最大概率（[K] -> 标量，[B,K] -> [B]）。
+    分数低于 heatmap_min_prob 的图视为阴性，暂缓生成热力图。
+    """
+    probs = np.asarray(probs, dtype=np.float32)
+    keep = np.array([c not in TRIAGE_IGNORE for c in _CLASS_NAMES], dtype=bool)
+    if not keep.any():
+        keep[:] = True
+    return probs[..., keep].max(axis=-1)
+
+
+def heatmap_classes(probs: np.ndarray, threshold: float = 0.5) -> List[str]:
+    """给定阈值时热力图会叠加哪些类别（positive，或无 positive 时的 top-1）。"""
+    probs = np.asarray(probs, dtype=np.float32)[None]
+    select = _cam_select(probs, (probs > float(threshold)).astype(np.int32))[0]
+    return [_CLASS_NAMES[i] for i in np.flatnonzero(select)]
+
+
+# ---------------------------
+# 工具：CAM 与热力图
+# ---------------------------
+def _find_linear(classifier: nn.Module) -> Optional[nn.Linear]:
+    """取分类头中的（第一个）线性层，CAM 使用其权重。"""
+    if isinstance(classifier, nn.Linear):
+        return classifier
+    if isinstance(classifier, nn.Sequential):
+        for m in classifier.modules():
+            if isinstance(m, nn.Linear):
+                return m
+    return None
+
+
+def compute_cams(
+    feats: torch.Tensor,     # [B,C,H,W]
+    weight: torch.Tensor,    # [K,C]
+    select: torch.Tensor,    # [B,K] bool，需要可视化的类别
+    per_class: bool = False,
+) -> np.ndarray:
+    """
+    批量 CAM：一次 einsum 得到 batch 内所有类别的激活图，在模型所在设备上
+    完成 ReLU 与逐类 min-max 归一化，只把最终的小尺寸图拷回主机。
+    - per_class=False: 返回 [B,H,W]，各选中类归一化后求和并截断到 0~1
+    - per_class=True:  返回 [B,K,H,W]，未选中的类为 0
+    """
+    with torch.no_grad():
+        w = weight.to(device=feats.device, dtype=feats.dtype)
+        cams = torch.einsum("kc,bchw->bkhw", w, feats).clamp_(min=0)   # [B,K,H,W]
+        flat = cams.flatten(2)                                           # [B,K,HW]
+        flat = flat - flat.amin(dim=2, keepdim=True)
+        peak = flat.amax(dim=2, keepdim=True)
+        flat = flat / torch.where(peak > 0, peak, torch.ones_like(peak))
+        flat = flat * select.to(device=flat.device, dtype=flat.dtype).unsqueeze(2)
+        cams = flat.view_as(cams)
+        if not per_class:
+            cams = cams.sum(dim=1).clamp_(0, 1)                          # 聚合
+    return cams.cpu().numpy()
+
+
+def _cam_select(probs: np.ndarray, preds: np.ndarray) -> np.ndarray:
+    """
+    需要可视化的类别掩码 [B,K]：取 positive 类；
+    某张图没有 positive 时退回最大概率那个类。
+    """
+    select = preds.astype(bool)
+    empty = ~select.any(axis=1)
+    select[empty, np.argmax(probs[empty], axis=1)] = True
+    return select
+
+
+def _render_heatmap(cam: np.ndarray, base: np.ndarray, alpha: float, max_side: int = 0) -> Image.Image:
+    """低分辨率 CAM [h,w] (0~1) 放大到原图尺寸（或长边 max_side），伪彩后与原图叠加（uint8 定点，见 chex_overlay）。"""
+    from chex_overlay import render_overlay  # 延迟导入：只做分类的进程不需要 cv2
+
+    return Image.fromarray(render_overlay(cam, base, alpha, max_side))
+
+
+def forward_features(model: nn.Module, batch: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    可重入的 DenseNet 前向：同时返回 (feats [B,C,h,w], outputs [B,K])。
+    与 torchvision DenseNet.forward 等价，但把 features 输出直接交还调用方，
+    不经过钩子或模块级变量，因此可在多线程 / 批量场景下并发调用。
+    """
+    feats = model.features(batch)
+    pooled = F.adaptive_avg_pool2d(F.relu(feats), (1, 1)).flatten(1)
+    return feats, model.classifier(pooled)
+
+
+def embeddings(feats: torch.Tensor) -> np.ndarray:
+    """
+    特征图 [B,C,h,w] -> 相似病例检索用的嵌入 [B,C] float32：与分类头输入相同的 ReLU + 全局平均池化，
+    再做 L2 归一化（内积即余弦相似度，见 chex_similar）。
+    """
+    with torch.no_grad():
+        pooled = F.adaptive_avg_pool2d(F.relu(feats.float()), (1, 1)).flatten(1)
+        return F.normalize(pooled, dim=1).cpu().numpy()
+
+
+def _eager_runner(model: nn.Module) -> Callable[[torch.Tensor], Tuple[torch.Tensor, torch.Tensor]]:
+    def run(batch: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        with torch.no_grad():
+            return forward_features(model, batch)
+    return run
+
+
+def _forward(batch: torch.Tensor) -> Tuple[np.ndarray, torch.Tensor]:
+    """一次前向：batch [B,C,H,W] -> (probs [B,K], feats [B,C',h,w])。"""
+    feats, outputs = _RUNNER(batch.to(_DEVICE))     # outputs 已 Sigmoid
+    probs = outputs.detach().cpu().numpy()           # [B, K]
+    return probs, feats
+
+
+def _postprocess(
+    decoded: Decoded,
+    probs: np.ndarray,                 # [K]
+    cam: Optional[np.ndarray],         # [h,w] 或 [K,h,w]（per_class）
+    cam_classes: Optional[np.ndarray] = None,  # 参与 CAM 的类别索引
+    generate_heatmap: bool = True,
+    threshold: float = 0.5,
+    alpha: float = 0.45,
+    return_top_k: Optional[int] = None,
+    cam_per_class: bool = False,
+    heatmap_mode: str = "image",
+    heatmap_max_side: int = 0,
+    heatmap_min_prob: float = 0.0,
+    return_features: bool = False,
+    return_embedding: bool = False,
+    timings: Optional[Dict[str, float]] = None,
+) -> Dict[str, Any]:
+    """把单张图的概率与 CAM 装配为 infer 的返回结构。"""
+    out = classify(probs, threshold, return_top_k)
+    out["heatmap"] = None  # 由上层决定是否保存为文件
+
     # 生成热力图
-    heat_img = None
-    if generate_heatmap and _LAST_FEATS is not None:
-        pos_indices = [i for i, v in enumerate(preds) if v == 1]
-        cam_u8 = _make_cam(_LAST_FEATS, _MODEL.classifier, probs, pos_indices, (orig_w, orig_h))
-        if cam_u8 is not None:
-            # 叠加
-            base = np.array(pil.convert("RGB"))
-            color = cv2.applyColorMap(cam_u8, cv2.COLORMAP_JET)
-            color = cv2.cvtColor(color, cv2.COLOR_BGR2RGB)
-            overlay = (alpha * color + (1 - alpha) * base).astype(np.uint8)
-            heat_img = Image.fromarray(overlay)
-
-    return {
-        "probs": probs_dict,
-        "preds": preds_dict,
-        "positive_findings": findings,
-        "heatmap": heat_img,  # 由上层决定是否保存为文件
+    if generate_heatmap and cam is not None:
+        if cam_per_class:
+            out["cams"] = {_CLASS_NAMES[k]: cam[k] for k in cam_classes}
+            cam = np.clip(cam.sum(axis=0), 0, 1)
+        if heatmap_mode == "grid":
+            out["cam_grid"], out["image_size"] = cam, decoded.size
+        else:
+            with timed("overlay", timings):
+                out["heatmap"] = _render_heatmap(cam, decoded.base, alpha, heatmap_max_side)
+    if timings is not None:
+        out["timings"] = timings
+    return out
+
+
+def _check_ready() -> None:
+    if _MODEL is None or _CLASS_NAMES is None or _PREPROCESSOR is None or _RUNNER is None:
+        raise RuntimeError("模型未初始化。请先调用 init_model(model_path, ...)")
+
+
+def infer(
+    image: ImageInput,
+    generate_heatmap: bool = True,
+    threshold: float = 0.5,
+    alpha: float = 0.45,
+    return_top_k: Optional[int] = None,
+    cam_per_class: bool = False,
+    heatmap_mode: str = "image",
+    heatmap_max_side: int = 0,
+    heatmap_min_prob: float = 0.0,
+    return_features: bool = False,
+    return_embedding: bool = False,
+) -> Dict[str, Any]:
+    """
+    对单张图片做推理。返回结构便于上层服务装配 JSON。
+    - image: 路径 / 文件字节 / PIL / ndarray（BGR 或灰度）
+    - threshold: 0~1；用于将概率二值化
+    - return_top_k: 若给定，仅返回前 k 个类别到 positive_findings
+    - cam_per_class: 额外返回各可视化类别的低分辨率 CAM（'cams'）
+    - heatmap_mode: image = 渲染叠加图（'heatmap'）；grid = 不渲染，只返回低分辨率 CAM（'cam_grid'），
+      由前端叠加，此时解码不保留原分辨率图
+    - heatmap_max_side: >0 时叠加图长边不超过该值
+    - heatmap_min_prob: 分诊模式（>0 时生效）：分诊分数（triage_scores）低于该值的图不算 CAM、不叠加，
+      返回 'heatmap_deferred'，解码也不保留原分辨率图（阳性图在需要时重新解码）
+    - return_features: 暂缓的图额外返回 CAM 特征图（'features'），供 infer_features 按需补算热力图
+    - return_embedding: 额外返回相似病例检索用的嵌入（'embedding'，见 embeddings）
+    返回：
+    {
+      'probs': {label: float, ...},
+      'preds': {label: 0|1, ...},
+      'positive_findings': [{'label','confidence'}, ...],
+      'heatmap': PIL.Image or None,
+      'cams': {label: np.ndarray[h,w] (0~1)},  # 仅 cam_per_class=True
+      'cam_grid': np.ndarray[h,w] (0~1), 'image_size': (W, H),  # 仅 heatmap_mode='grid'
+      'heatmap_deferred': True, 'image_size': (W, H),  # 仅分诊暂缓的图
+      'features': torch.Tensor[C,h,w] float16 (CPU),  # 仅分诊暂缓且 return_features=True
+      'embedding': np.ndarray[C] float32,        # 仅 return_embedding=True，L2 归一化
+      'timings': {stage: ms}                     # 分阶段耗时（decode/preprocess/forward/cam/overlay）
     }
+    """
+    return infer_batch(
+        [image],
+        generate_heatmap=generate_heatmap,
+        threshold=threshold,
+        alpha=alpha,
+        return_top_k=return_top_k,
+        cam_per_class=cam_per_class,
+        heatmap_mode=heatmap_mode,
+        heatmap_max_side=heatmap_max_side,
+        heatmap_min_prob=heatmap_min_prob,
+        return_features=return_features,
+        return_embedding=return_embedding,
+    )[0]
+
+
+def infer_batch(
+    images: List[ImageInput],
+    generate_heatmap: bool = True,
+    threshold: float = 0.5,
+    alpha: float = 0.45,
+    return_top_k: Optional[int] = None,
+    cam_per_class: bool = False,
+    heatmap_mode: str = "image",
+    heatmap_max_side: int = 0,
+    heatmap_min_prob: float = 0.0,
+    return_features: bool = False,
+    return_embedding: bool = False,
+    options: Optional[List[Dict[str, Any]]] = None,
+    return_errors: bool = False,
+) -> List[Any]:
+    """
+    多张图片合并为一个 batch 做一次前向，逐张返回与 infer 相同的结构。
+    - options: 可选，与 images 等长的逐图参数覆盖（generate_heatmap/threshold/alpha/return_top_k/cam_per_class/
+      heatmap_mode/heatmap_max_side/heatmap_min_prob/return_features/return_embedding），
+      供批处理调度器合并来自不同请求、参数各异的图片
+    - return_errors: 解码失败的图不抛出，而是在对应位置返回该异常，其余图照常前向
+      （批处理调度器 / 批量接口用：一张坏图不连累同批的其他图）
+    """
+    _check_ready()
+    if not images:
+        return []
+    kws = _merge_options(len(images), options, generate_heatmap=generate_heatmap, threshold=threshold,
+                         alpha=alpha, return_top_k=return_top_k, cam_per_class=cam_per_class,
+                         heatmap_mode=heatmap_mode, heatmap_max_side=heatmap_max_side,
+                         heatmap_min_prob=heatmap_min_prob, return_features=return_features,
+                         return_embedding=return_embedding)
+
+    # 不需要热力图的图片无须保留原分辨率，JPEG 可直接缩放解码；
+    # 分诊模式下先按不需要处理，前向后判为阳性的图再从 images 重新解码原分辨率
+    timings: List[Dict[str, float]] = [{} for _ in images]
+    decoded = []
+    failed: Dict[int, Exception] = {}
+    for i, (img, kw, t) in enumerate(zip(images, kws, timings)):
+        try:
+            with timed("decode", t):
+                keep_full = (bool(kw["generate_heatmap"]) and kw["heatmap_mode"] != "grid"
+                             and not float(kw["heatmap_min_prob"] or 0) > 0)
+                decoded.append(_PREPROCESSOR.decode(img, keep_full=keep_full))
+        except Exception as e:
+            if not return_errors:
+                raise
+            failed[i] = e
+    if not failed:
+        return _infer_decoded(decoded, kws, timings, sources=images)
+    keep = [i for i in range(len(images)) if i not in failed]
+    outs = iter(_infer_decoded(decoded, [kws[i] for i in keep], [timings[i] for i in keep],
+                               sources=[images[i] for i in keep]) if keep else [])
+    return [failed[i] if i in failed else next(outs) for i in range(len(images))]
+
+
+def infer_decoded(
+    decoded: List[Decoded],
+    generate_heatmap: bool = True,
+    threshold: float = 0.5,
+    alpha: float = 0.45,
+    return_top_k: Optional[int] = None,
+    cam_per_class: bool = False,
+    heatmap_mode: str = "image",
+    heatmap_max_side: int = 0,
+    heatmap_min_prob: float = 0.0,
+    return_features: bool = False,
+    return_embedding: bool = False,
+    options: Optional[List[Dict[str, Any]]] = None
+) -> List[Dict[str, Any]]:
+    """
+    与 infer_batch 相同，但输入是已经由 Preprocessor.decode 解码好的图片
+    （例如在 DataLoader 子进程中解码，见 chex_bulk）。渲染叠加图（heatmap_mode='image'）的项必须带 base
+    （分诊模式下也一样：这里没有原始输入可供重新解码）。
+    """
+    _check_ready()
+    if not decoded:
+        return []
+    kws = _merge_options(len(decoded), options, generate_heatmap=generate_heatmap, threshold=threshold,
+                         alpha=alpha, return_top_k=return_top_k, cam_per_class=cam_per_class,
+                         heatmap_mode=heatmap_mode, heatmap_max_side=heatmap_max_side,
+                         heatmap_min_prob=heatmap_min_prob, return_features=return_features,
+                         return_embedding=return_embedding)
+    return _infer_decoded(decoded, kws)
+
+
+def _merge_options(n: int, options: Optional[List[Dict[str, Any]]], **defaults: Any) -> List[Dict[str, Any]]:
+    if options is not None and len(options) != n:
+        raise ValueError("options 长度与 images 不一致")
+    return [dict(defaults, **(options[i] if options is not None else {})) for i in range(n)]
+
+
+def _infer_decoded(
+    decoded: List[Decoded],
+    kws: List[Dict[str, Any]],
+    timings: Optional[List[Dict[str, float]]] = None,
+    sources: Optional[Sequence[ImageInput]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    timings: 与 decoded 等长的逐图耗时字典（毫秒）；batch 级阶段（preprocess/forward/cam）的耗时
+    记到同一 batch 的每张图上（即该图实际经历的延迟）。
+    sources: 原始输入；分诊判为阳性、需要叠加却没有 base 的图由此重新解码
+    """
+    if timings is None:
+        timings = [{} for _ in decoded]
+    shared: Dict[str, float] = {}
+    if chex_metrics.ENABLED:
+        chex_metrics.BATCH_SIZE.observe(len(decoded))
+    with timed("preprocess", shared):
+        batch = _PREPROCESSOR.to_batch([d.small for d in decoded])
+    with timed("forward", shared):
+        probs, feats = _forward(batch)
+    thresholds = np.array([[float(kw["threshold"])] for kw in kws], dtype=probs.dtype)
+    preds = (probs > thresholds).astype(np.int32)     # [B, K]
+
+    # 需要热力图的图片一起算 CAM；分诊模式下分数不够的图暂缓
+    cams: List[Optional[np.ndarray]] = [None] * len(decoded)
+    cam_classes: List[Optional[np.ndarray]] = [None] * len(decoded)
+    scores = triage_scores(probs)
+    wants = [i for i, kw in enumerate(kws) if kw["generate_heatmap"]]
+    need = [i for i in wants if scores[i] >= float(kws[i]["heatmap_min_prob"] or 0)]
+    deferred = sorted(set(wants) - set(need))
+    if need and _CAM_WEIGHT is not None:
+        with timed("cam", shared):
+            select = _cam_select(probs[need], preds[need])     # [len(need), K]
+            for per_class in (False, True):
+                group = [j for j, i in enumerate(need) if bool(kws[i]["cam_per_class"]) == per_class]
+                if not group:
+                    continue
+                rows = [need[j] for j in group]
+                maps = compute_cams(feats[rows], _CAM_WEIGHT, torch.from_numpy(select[group]), per_class=per_class)
+                for j, i, m in zip(group, rows, maps):
+                    cams[i] = m
+                    cam_classes[i] = np.flatnonzero(select[j])
+
+    for t in timings:
+        t.update(shared)
+    if sources is not None:
+        for i in need:
+            if decoded[i].base is None and kws[i]["heatmap_mode"] != "grid":
+                with timed("decode", timings[i]):
+                    decoded[i] = _PREPROCESSOR.decode(sources[i], keep_full=True)
+    outs = [
+        _postprocess(d, probs[i], cams[i], cam_classes[i], timings=timings[i], **kws[i])
+        for i, d in enumerate(decoded)
+    ]
+    for i in deferred:
+        outs[i]["heatmap_deferred"] = True
+        outs[i]["image_size"] = decoded[i].size
+        if kws[i]["return_features"]:
+            outs[i]["features"] = feats[i].detach().to("cpu", torch.float16, copy=True)
+    rows = [i for i, kw in enumerate(kws) if kw["return_embedding"]]
+    if rows:
+        for i, emb in zip(rows, embeddings(feats[rows])):
+            outs[i]["embedding"] = emb
+    return outs
+
+
+def infer_features(
+    features: torch.Tensor,            # [C,h,w]，infer(..., return_features=True) 返回的 'features'
+    probs: Sequence[float],            # [K]，与 class_names 同序
+    image: Optional[ImageInput] = None,
+    image_size: Optional[Tuple[int, int]] = None,
+    threshold: float = 0.5,
+    alpha: float = 0.45,
+    return_top_k: Optional[int] = None,
+    cam_per_class: bool = False,
+    heatmap_mode: str = "image",
+    heatmap_max_side: int = 0,
+) -> Dict[str, Any]:
+    """
+    由缓存的特征图补算分诊时暂缓的热力图：只做 CAM（一次 einsum）与叠加，不再前向。
+    - image: 叠加用的原图（heatmap_mode='image' 时必填，通常是已保存的原图路径）
+    - image_size: 原图 (W, H)，heatmap_mode='grid' 时随 CAM 网格返回
+    返回结构与 infer 相同（generate_heatmap=True）。
+    """
+    _check_ready()
+    timings: Dict[str, float] = {}
+    if heatmap_mode == "grid":
+        decoded = Decoded(None, None, tuple(image_size) if image_size else None)
+    else:
+        if image is None:
+            raise ValueError("heatmap_mode='image' 需要原图")
+        with timed("decode", timings):
+            decoded = _PREPROCESSOR.decode(image, keep_full=True)
+    probs = np.asarray(probs, dtype=np.float32)
+    with timed("cam", timings):
+        select = _cam_select(probs[None], (probs[None] > float(threshold)).astype(np.int32))
+        cam = compute_cams(features.float()[None], _CAM_WEIGHT, torch.from_numpy(select), per_class=cam_per_class)[0]
+    return _postprocess(decoded, probs, cam, np.flatnonzero(select[0]), generate_heatmap=True, threshold=threshold,
+                        alpha=alpha, return_top_k=return_top_k, cam_per_class=cam_per_class,
+                        heatmap_mode=heatmap_mode, heatmap_max_side=heatmap_max_side, timings=timings)
 
 
 # ---------------------------
@@ -296,9 +735,21 @@ if __name__ == "__main__":
     parser.add_argument("--heatmap", action="store_true", help="是否生成热力图并保存为 <image>_cam.png")
     parser.add_argument("--threshold", type=float, default=0.5, help="阈值 (0~1)")
     parser.add_argument("--imagenet-norm", action="store_true", help="使用 ImageNet 归一化")
+    parser.add_argument("--backend", type=str, default="eager", help="eager / torchscript / compile / onnx")
+    parser.add_argument("--fold-bn", action="store_true", help="BN 折叠")
+    parser.add_argument("--channels-last", action="store_true", help="NHWC 内存布局")
+    parser.add_argument("--precision", type=str, default="fp32", help="fp32 / bf16 / int8")
+    parser.add_argument("--calib-dir", type=str, default=None, help="INT8 校准图片目录或 CSV 清单")
+    parser.add_argument("--ensemble", type=str, nargs="*", default=None, help="附加集成权重（可含通配符）")
+    parser.add_argument("--tta", type=str, nargs="*", default=[], help="测试时增强：flip / crops")
     args = parser.parse_args()
 
-    model, classes = init_model(args.model, class_names=None, use_imagenet_norm=args.imagenet_norm)
+    model, classes = init_model(
+        args.model, class_names=None, use_imagenet_norm=args.imagenet_norm,
+        backend=args.backend, fold_bn=args.fold_bn, channels_last=args.channels_last,
+        precision=args.precision, calib_dir=args.calib_dir,
+        ensemble=args.ensemble, tta=args.tta,
+    )
     result = infer(args.image, generate_heatmap=args.heatmap, threshold=args.threshold)
 
     print("\n=== Positive Findings ===")
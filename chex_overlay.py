@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+chex_overlay.py — CAM 热力图叠加（uint8 定点，不产生全分辨率 float 中间结果）
+
+旧实现：CAM 先以 float32 放大到原图尺寸，再 applyColorMap，最后 alpha * color + (1 - alpha) * base
+在 float64 下混合 —— 3000x2500 的图要分配多个 ~180MB 的 float64 缓冲。现在：
+- CAM 在低分辨率（7x7）上量化为 uint8，再按输出尺寸双线性放大（uint8）；
+- 伪彩用 applyColorMap（查表），混合用 cv2.addWeighted（uint8 饱和运算，结果写回伪彩缓冲）；
+- max_side > 0 时先把底图缩到长边不超过 max_side，再在该尺寸上叠加（热力图本来就是低频信息）；
+- 也可以不渲染，只返回低分辨率 CAM 网格 + 伪彩查找表，由前端在画布上叠加（cam_grid_payload）。
+"""
+
+import base64
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+_JET_LUT: Optional[np.ndarray] = None
+
+
+def jet_lut() -> np.ndarray:
+    """COLORMAP_JET 的 RGB 查找表 [256,3] uint8（与 cv2.applyColorMap 一致）。"""
+    global _JET_LUT
+    if _JET_LUT is None:
+        import cv2
+
+        ramp = np.arange(256, dtype=np.uint8).reshape(1, 256)
+        _JET_LUT = cv2.cvtColor(cv2.applyColorMap(ramp, cv2.COLORMAP_JET), cv2.COLOR_BGR2RGB)[0].copy()
+    return _JET_LUT
+
+
+def cam_to_u8(cam: np.ndarray) -> np.ndarray:
+    """0~1 的 CAM -> uint8（四舍五入）。"""
+    return np.clip(cam * 255.0 + 0.5, 0, 255).astype(np.uint8)
+
+
+def output_size(width: int, height: int, max_side: int = 0) -> Tuple[int, int]:
+    if max_side and max(width, height) > max_side:
+        scale = max_side / float(max(width, height))
+        return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+    return width, height
+
+
+def render_overlay(cam: np.ndarray, base: np.ndarray, alpha: float = 0.45, max_side: int = 0) -> np.ndarray:
+    """
+    低分辨率 CAM [h,w] (0~1) 与底图（uint8 灰度 [H,W] 或 RGB [H,W,3]）叠加，返回 RGB uint8。
+    - max_side: >0 时输出长边不超过该值
+    """
+    import cv2
+
+    h, w = base.shape[:2]
+    out_w, out_h = output_size(w, h, max_side)
+    if (out_w, out_h) != (w, h):
+        base = cv2.resize(base, (out_w, out_h), interpolation=cv2.INTER_AREA)
+    cam_up = cv2.resize(cam_to_u8(cam), (out_w, out_h), interpolation=cv2.INTER_LINEAR)
+    color = cv2.applyColorMap(cam_up, cv2.COLORMAP_JET)
+    cv2.cvtColor(color, cv2.COLOR_BGR2RGB, dst=color)
+    if base.ndim == 2:
+        base = cv2.cvtColor(base, cv2.COLOR_GRAY2RGB)
+    cv2.addWeighted(color, float(alpha), base, 1.0 - float(alpha), 0.0, dst=color)
+    return color
+
+
+def cam_grid_payload(cam: np.ndarray, alpha: float = 0.45, size: Optional[Tuple[int, int]] = None) -> Dict[str, Any]:
+    """
+    供前端叠加的 JSON：低分辨率 CAM（uint8，行优先，base64）与 JET 查找表（256x3 RGB，base64）。
+    前端按原图尺寸放大网格后查表着色，再以 alpha 混合到原图上。
+    - size: 原图 (W, H)，便于前端在原图加载前确定画布尺寸
+    """
+    grid = cam_to_u8(cam)
+    payload = {
+        "width": int(grid.shape[1]),
+        "height": int(grid.shape[0]),
+        "data": base64.b64encode(np.ascontiguousarray(grid).tobytes()).decode("ascii"),
+        "colormap": "jet",
+        "lut": base64.b64encode(jet_lut().tobytes()).decode("ascii"),
+        "alpha": float(alpha),
+    }
+    if size is not None:
+        payload["image_width"], payload["image_height"] = int(size[0]), int(size[1])
+    return payload
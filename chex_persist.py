@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+chex_persist.py — 上传原图 / 热力图 / 历史记录的后台持久化
+
+analyze 在分类结果就绪后立即返回，编码与写盘交给有界线程池：
+- 原图按上传字节原样落盘（不再解码后重编码为 PNG）；
+- 热力图可配置编码格式（PNG / JPEG / WebP）、质量与最长边；
+- 待完成任务数有上限（max_pending），满了以后 submit 阻塞，形成背压；
+- 按目标路径登记未完成的写入，静态文件请求可先 wait(path) 再读取。
+写文件先写临时文件再 os.replace，读者不会看到半个文件。
+"""
+
+import io
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from PIL import Image
+
+from chex_metrics import timed
+
+# 格式 -> (PIL 格式名, 扩展名)
+HEATMAP_FORMATS = {
+    "png": ("PNG", "png"),
+    "jpeg": ("JPEG", "jpg"),
+    "jpg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+}
+
+
+def heatmap_extension(fmt: str) -> str:
+    return HEATMAP_FORMATS[fmt.lower()][1]
+
+
+def encode_heatmap(img: Image.Image, fmt: str = "png", quality: int = 85, max_side: int = 0) -> bytes:
+    """
+    编码热力图。
+    - fmt: png / jpeg / webp
+    - quality: JPEG / WebP 质量
+    - max_side: >0 时先把长边缩到不超过该值
+    """
+    pil_fmt, _ = HEATMAP_FORMATS[fmt.lower()]
+    if max_side and max(img.size) > max_side:
+        scale = max_side / float(max(img.size))
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.BILINEAR)
+    buf = io.BytesIO()
+    if pil_fmt == "PNG":
+        img.save(buf, format="PNG", compress_level=1)   # 速度优先
+    else:
+        img.save(buf, format=pil_fmt, quality=int(quality))
+    return buf.getvalue()
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ArtifactWriter:
+    """
+    - max_workers: 写盘 / 编码线程数
+    - max_pending: 允许排队 + 执行中的任务上限，超出后 submit 阻塞
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 64):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix="chex-persist")
+        self._slots = threading.BoundedSemaphore(max(1, int(max_pending)))
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.failed = 0
+
+    # ---------------------------
+    # 提交
+    # ---------------------------
+    def submit(self, fn: Callable[..., Any], *args: Any, path: Optional[str] = None, stage: str = "persist") -> Future:
+        """提交任意任务；给出 path 时登记为该路径的待完成写入。stage 为 chex_metrics 中记录耗时的阶段名。"""
+        self._slots.acquire()
+        try:
+            fut = self._pool.submit(self._run, fn, args, stage)
+        except Exception:
+            self._slots.release()
+            raise
+        if path is not None:
+            with self._lock:
+                self._pending[os.path.abspath(path)] = fut
+            fut.add_done_callback(lambda _f, p=os.path.abspath(path): self._done(p, _f))
+        return fut
+
+    def write_bytes(self, path: str, data: bytes) -> Future:
+        """原样写入字节（上传原图）。"""
+        return self.submit(write_atomic, path, data, path=path)
+
+    def write_heatmap(self, path: str, img: Image.Image, fmt: str = "png", quality: int = 85, max_side: int = 0) -> Future:
+        return self.submit(lambda: write_atomic(path, encode_heatmap(img, fmt, quality, max_side)), path=path)
+
+    def write_image(self, path: str, img: Image.Image) -> Future:
+        """按扩展名编码保存 PIL 图片（无法原样保存的输入，如 DICOM 渲染图）。"""
+        def _save():
+            buf = io.BytesIO()
+            img.save(buf, format=Image.registered_extensions().get(os.path.splitext(path)[1].lower(), "PNG"))
+            write_atomic(path, buf.getvalue())
+        return self.submit(_save, path=path)
+
+    # ---------------------------
+    # 查询 / 等待
+    # ---------------------------
+    def wait(self, path: str, timeout: Optional[float] = None) -> bool:
+        """若 path 有未完成写入则等待；返回写入是否已完成（无登记视为已完成）。"""
+        with self._lock:
+            fut = self._pending.get(os.path.abspath(path))
+        if fut is None:
+            return True
+        try:
+            fut.result(timeout)
+        except Exception:
+            return fut.done()
+        return True
+
+    def is_pending(self, path: str) -> bool:
+        with self._lock:
+            return os.path.abspath(path) in self._pending
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
+
+    # ---------------------------
+    # 内部
+    # ---------------------------
+    def _run(self, fn: Callable[..., Any], args: tuple, stage: str = "persist") -> Any:
+        try:
+            with timed(stage):
+                return fn(*args)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            print(f"[persist] 后台任务失败：{e}")
+            raise
+        finally:
+            self._slots.release()
+
+    def _done(self, path: str, fut: Future) -> None:
+        with self._lock:
+            if self._pending.get(path) is fut:
+                del self._pending[path]
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+chex_preprocess.py — 推理前处理引擎（替代逐请求的 PIL RGB 转换 + T.Resize + ToTensor）
+
+要点：
+- 解码：JPEG 在不需要原图分辨率时走 draft 模式（DCT 缩放），直接解出接近模型尺寸的图；
+- 灰度图（L / 16 位，或 RGB 但三通道相同）全程保持单通道 uint8，直到写入 batch 张量的最后一步才扩成 3 通道；
+  真正的彩色输入保持 3 通道，与原 convert("RGB") 管线的张量一致；
+- 缩放使用与 T.Resize(PIL) 相同的 PIL 双线性（含抗锯齿），数值与原 transform 一致；
+- ToTensor 与 Normalize 合并为一次 x * scale + bias，直接写入按线程复用的预分配 batch 张量。
+"""
+
+import io
+import os
+import threading
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+import torch
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# 这些模式先转单通道；其余非 L/RGB 模式转 RGB
+_GRAY_MODES = {"1", "I", "I;16", "I;16B", "I;16L", "I;16N", "F", "LA", "La"}
+
+ImageInput = Union[str, bytes, bytearray, memoryview, Image.Image, np.ndarray]
+
+
+def _channels_equal(arr: np.ndarray) -> bool:
+    return bool(np.array_equal(arr[..., 0], arr[..., 1]) and np.array_equal(arr[..., 1], arr[..., 2]))
+
+
+class Decoded(NamedTuple):
+    small: np.ndarray             # 模型输入尺寸的 uint8，[S,S]（灰度）或 [S,S,3]
+    base: Optional[np.ndarray]    # 原分辨率 uint8，用于叠加热力图；keep_full=False 时为 None
+    size: Tuple[int, int]         # 原图 (W, H)
+
+
+class Preprocessor:
+    """
+    - size: 模型输入边长
+    - use_imagenet_norm: 与 init_model 同名参数一致
+    - gray: True 时三通道相同的图按单通道处理（张量不变，只省内存与拷贝）；False 时一律保持 RGB
+    """
+
+    def __init__(self, size: int = 224, use_imagenet_norm: bool = False, gray: bool = True):
+        self.size = int(size)
+        self.gray = bool(gray)
+        mean = np.array(IMAGENET_MEAN if use_imagenet_norm else (0.0, 0.0, 0.0), dtype=np.float32)
+        std = np.array(IMAGENET_STD if use_imagenet_norm else (1.0, 1.0, 1.0), dtype=np.float32)
+        # (x / 255 - mean) / std == x * scale + bias
+        self._scale = torch.from_numpy(1.0 / (255.0 * std)).view(3, 1, 1)
+        self._bias = torch.from_numpy(-mean / std).view(1, 3, 1, 1)
+        self._local = threading.local()
+
+    # ---------------------------
+    # 解码
+    # ---------------------------
+    def _open(self, image: ImageInput) -> Tuple[Image.Image, bool]:
+        """返回 (PIL, 是否由本函数打开)；只有自己打开的图才允许 draft，避免改动调用方对象。"""
+        if isinstance(image, Image.Image):
+            return image, False
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            return Image.open(io.BytesIO(image)), True
+        if isinstance(image, str):
+            if not os.path.exists(image):
+                raise FileNotFoundError(f"图片不存在: {image}")
+            return Image.open(image), True
+        raise TypeError(f"不支持的输入类型: {type(image)}")
+
+    @staticmethod
+    def _from_array(arr: np.ndarray) -> Image.Image:
+        # 约定与 cv2 一致：3 通道为 BGR
+        if arr.ndim == 3:
+            import cv2  # 延迟导入：只有 ndarray 彩色输入才需要
+            arr = cv2.cvtColor(arr, cv2.COLOR_BGRA2RGB if arr.shape[2] == 4 else cv2.COLOR_BGR2RGB)
+        return Image.fromarray(arr)
+
+    def decode(self, image: ImageInput, keep_full: bool = True) -> Decoded:
+        """
+        解码并缩放到模型尺寸。
+        - keep_full: 是否保留原分辨率图（生成热力图时需要）；False 时 JPEG 可按 DCT 缩放解码
+        """
+        if isinstance(image, np.ndarray):
+            pil, owned = self._from_array(image), False
+        else:
+            pil, owned = self._open(image)
+        size = pil.size
+
+        if not keep_full and owned and pil.format == "JPEG":
+            # draft 选择不小于目标尺寸的最大 1/2^k 缩放，解码量随之下降；
+            # 只对单分量 JPEG 按 L 解码（彩色 JPEG 只取 Y 分量会与 RGB 管线不一致）
+            pil.draft("L" if self.gray and pil.mode == "L" else "RGB", (self.size, self.size))
+
+        if pil.mode not in ("L", "RGB"):
+            pil = pil.convert("L" if pil.mode in _GRAY_MODES else "RGB")
+
+        small = np.asarray(pil.resize((self.size, self.size), Image.BILINEAR))
+        if self.gray and small.ndim == 3 and _channels_equal(small):
+            # 存成 RGB 的灰度图：取一个通道，张量与 3 通道时完全相同
+            small = np.ascontiguousarray(small[..., 0])
+        base = np.asarray(pil) if keep_full else None
+        return Decoded(small, base, size)
+
+    # ---------------------------
+    # 组 batch
+    # ---------------------------
+    def to_batch(self, smalls: List[np.ndarray]) -> torch.Tensor:
+        """
+        把若干 [S,S] / [S,S,3] uint8 写入预分配的 [B,3,S,S] float32 张量并归一化。
+        张量按线程复用：返回值只在下一次同线程调用前有效。
+        """
+        n = len(smalls)
+        buf = getattr(self._local, "buf", None)
+        if buf is None or buf.shape[0] < n:
+            buf = torch.empty((n, 3, self.size, self.size), dtype=torch.float32)
+            self._local.buf = buf
+        out = buf[:n]
+        for i, arr in enumerate(smalls):
+            src = torch.from_numpy(np.ascontiguousarray(arr))
+            src = src.unsqueeze(0) if src.ndim == 2 else src.permute(2, 0, 1)
+            torch.mul(src, self._scale, out=out[i])    # 单通道按广播写满 3 通道
+        out.add_(self._bias)
+        return out
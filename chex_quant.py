@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+chex_quant.py — 低精度 CPU 推理：INT8 静态量化（校准）与 bf16 autocast
+
+- INT8：FX graph mode 训练后静态量化。torchvision 的 _DenseLayer.forward 里有 isinstance / checkpoint 分支，
+  无法被 FX 符号追踪，因此先用 DenseNetGraph 把 features 展开成显式的 BN-ReLU-Conv + torch.cat 数据流
+  （参数与原模型共享，数值等价），再 prepare_fx → 在样例图片上校准 → convert_fx。
+  conv→BN 由 prepare_fx 自动融合；输出（feats, probs）在图出口反量化为 float，CAM 不受影响。
+- bf16：torch.autocast(cpu, bfloat16) 包住前向，输出转回 float32；CPU 需支持 AVX512-BF16 / AMX，
+  否则 bf16 只是软件模拟，比 float32 更慢，bf16_supported() 用来判断。
+
+两种 runner 的调用约定与 chex_backends 相同：runner(batch) -> (feats, outputs)。
+"""
+
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision.models.densenet import _DenseBlock
+
+import chex_model
+from chex_backends import Runner
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+# init_model 自检的默认容差（概率最大绝对差, CAM 最大绝对差）；低精度本身就有漂移，比 fp32 后端宽松
+TOLERANCES = {
+    "bf16": (2e-2, 1e-1),
+    "int8": (5e-2, 2.5e-1),
+}
+
+
+# ---------------------------
+# bf16
+# ---------------------------
+def bf16_supported(device: Optional[torch.device] = None) -> bool:
+    if device is not None and device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    cpu = getattr(torch, "cpu", None)
+    for probe in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        fn = getattr(cpu, probe, None)
+        if fn is not None and fn():
+            return True
+    return False
+
+
+def bf16_runner(model: nn.Module, channels_last: bool = False) -> Runner:
+    device_type = next(model.parameters()).device.type
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+
+    def run(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        if channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad(), torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            feats, outputs = chex_model.forward_features(model, x)
+        return feats.float(), outputs.float()
+    return run
+
+
+# ---------------------------
+# INT8
+# ---------------------------
+class DenseNetGraph(nn.Module):
+    """
+    torchvision DenseNet 的可 FX 追踪版本：与 forward_features 输出相同的 (feats, outputs)。
+    只引用原模型的子模块，不复制参数。
+    """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.features = model.features
+        self.classifier = model.classifier
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        for stage in self.features.children():
+            if isinstance(stage, _DenseBlock):
+                feats = [x]
+                for layer in stage.values():
+                    h = layer.conv1(layer.relu1(layer.norm1(torch.cat(feats, 1))))
+                    feats.append(layer.conv2(layer.relu2(layer.norm2(h))))
+                x = torch.cat(feats, 1)
+            else:
+                x = stage(x)
+        pooled = F.adaptive_avg_pool2d(F.relu(x), (1, 1)).flatten(1)
+        return x, self.classifier(pooled)
+
+
+def _quant_engine() -> str:
+    engines = torch.backends.quantized.supported_engines
+    for name in ("x86", "fbgemm", "qnnpack"):
+        if name in engines:
+            return name
+    raise RuntimeError("当前 PyTorch 不支持量化推理")
+
+
+def quantize_int8(model: nn.Module, calib_batches: Iterable[torch.Tensor], engine: Optional[str] = None) -> nn.Module:
+    """
+    静态量化：calib_batches 为已归一化的 [B,3,S,S] float 张量（建议 100~500 张真实胸片）。
+    返回的 GraphModule 只能在 CPU 上运行；model 本身不被修改。
+    """
+    import copy
+
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    engine = engine or _quant_engine()
+    torch.backends.quantized.engine = engine
+    graph = DenseNetGraph(copy.deepcopy(model).cpu().eval())
+    example = (torch.zeros(1, 3, 224, 224),)
+    prepared = prepare_fx(graph, get_default_qconfig_mapping(engine), example)
+    n = 0
+    with torch.no_grad():
+        for batch in calib_batches:
+            prepared(batch.cpu())
+            n += batch.shape[0]
+    if n == 0:
+        raise ValueError("INT8 校准没有可用图片")
+    print(f"[quant] INT8 校准完成：{n} 张，engine={engine}")
+    return convert_fx(prepared)
+
+
+def int8_runner(qmodel: nn.Module) -> Runner:
+    def run(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        with torch.no_grad():
+            return qmodel(x.cpu())
+    return run
+
+
+def calibration_batches(src: str, limit: int = 256, batch_size: int = 16) -> Iterator[torch.Tensor]:
+    """从目录 / CSV 清单（同 chex_bulk 输入）读取至多 limit 张图片，按 chex_model 当前的预处理组 batch。"""
+    from chex_bulk import iter_source
+
+    pre = chex_model._PREPROCESSOR
+    smalls: List[np.ndarray] = []
+    for k, (_, path) in enumerate(iter_source(src)):
+        if k >= limit:
+            break
+        try:
+            if path.lower().endswith(".dcm"):
+                from chex_dicom import read_dicom  # noqa
+                image = read_dicom(path, max_side=448)
+            else:
+                image = path
+            smalls.append(pre.decode(image, keep_full=False).small)
+        except Exception as e:
+            print(f"[quant] 跳过无法读取的校准图片 {path}: {e}")
+            continue
+        if len(smalls) == batch_size:
+            yield pre.to_batch(smalls).clone()
+            smalls = []
+    if smalls:
+        yield pre.to_batch(smalls).clone()
+
+
+def build_runner(
+    model: nn.Module,
+    precision: str,
+    channels_last: bool = False,
+    calib_dir: Optional[str] = None,
+    calib_images: int = 256,
+) -> Runner:
+    """按 precision（bf16 / int8）构建 runner；不满足条件时抛出异常，由 init_model 退回 eager。"""
+    device = next(model.parameters()).device
+    if precision == "bf16":
+        if not bf16_supported(device):
+            raise RuntimeError("当前 CPU 不支持原生 bf16（AVX512-BF16 / AMX）")
+        return bf16_runner(model, channels_last)
+    if precision == "int8":
+        if device.type != "cpu":
+            raise RuntimeError("INT8 量化模型只能在 CPU 上运行")
+        if not calib_dir:
+            raise ValueError("INT8 需要 calib_dir（校准图片目录或 CSV 清单）")
+        return int8_runner(quantize_int8(model, calibration_batches(calib_dir, calib_images)))
+    raise ValueError(f"未知精度: {precision}")
+
+
+# ---------------------------
+# 精度回归
+# ---------------------------
+def auroc(scores: np.ndarray, labels: np.ndarray) -> float:
+    """二分类 AUROC（Mann-Whitney U，含并列名次）；只有一类样本时返回 nan。"""
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels).astype(bool)
+    n_pos, n_neg = int(labels.sum()), int((~labels).sum())
+    if n_pos == 0 or n_neg == 0:
+        return float("nan")
+    order = np.argsort(scores, kind="mergesort")
+    ranks = np.empty(len(scores), dtype=np.float64)
+    sorted_scores = scores[order]
+    i = 0
+    while i < len(scores):
+        j = i
+        while j + 1 < len(scores) and sorted_scores[j + 1] == sorted_scores[i]:
+            j += 1
+        ranks[order[i:j + 1]] = (i + j) / 2.0 + 1.0
+        i = j + 1
+    return float((ranks[labels].sum() - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_neg))
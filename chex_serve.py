@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+chex_serve.py — 多进程部署 app.py（uvicorn 多 worker，共享只读权重，线程数按核均分）
+
+用法：
+    python chex_serve.py --workers 4 --port 8000
+    CHEX_WORKERS=4 python chex_serve.py
+
+要点：
+- 启动 worker 之前，先在一个临时子进程中生成按权重哈希缓存的模型产物（见 chex_artifact），
+  主进程本身不导入 torch；
+- 每个 worker 通过 init_model(cache_dir=...) 以 mmap 方式加载同一个产物文件，权重页在页缓存中只有一份，
+  各 worker 的 RSS 中这部分为共享页（PSS 按 worker 数均摊）；
+  注意 channels_last / INT8 / torch.compile 等会生成进程私有的权重副本，共享只对 eager（含 BN 折叠）成立；
+- 每个 worker 的 torch intra-op 线程数 = 可用核数 // worker 数（可用 --threads 覆盖），inter-op 线程数为 1，
+  同时设置 OMP / MKL 线程数，避免 N 个 worker 各自开满线程池导致 CPU 超卖。
+- CHEX_AUTOTUNE=1/force 时，在启动 worker 之前按每个 worker 的核数预算调优一次（见 chex_autotune），
+  各 worker 直接复用保存的配置。
+- 原图 / 热力图由各 worker 后台写入，worker 的写入队列互不可见：设置 CHEX_WORKERS 后，app 在 /static
+  未命中时先短暂轮询（CHEX_STATIC_MISS_WAIT_MS）再 404，避免落到另一个 worker 上的请求抢在写完之前。
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+from typing import List, Optional
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:   # 非 Linux
+        return os.cpu_count() or 1
+
+
+def threads_per_worker(workers: int, cores: Optional[int] = None) -> int:
+    return max(1, (cores or available_cores()) // max(1, int(workers)))
+
+
+def _prepare(model_path: str, cache_dir: str, fold_bn: bool) -> None:
+    import chex_model
+    chex_model.init_model(model_path, cache_dir=cache_dir, fold_bn=fold_bn)
+
+
+def prepare_artifact(model_path: str, cache_dir: str, fold_bn: bool = False) -> None:
+    """在 spawn 子进程中加载一次模型以生成缓存产物；产物已存在时几乎不耗时。"""
+    proc = mp.get_context("spawn").Process(target=_prepare, args=(model_path, cache_dir, fold_bn))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        print(f"[serve] 模型产物生成失败（exit={proc.exitcode}），各 worker 将各自加载权重")
+
+
+def _autotune(model_path: str, cores: int, force: bool) -> None:
+    import chex_autotune
+    data_dir = os.environ.get("CHEX_DATA_DIR", os.path.join(ROOT, "data"))
+    chex_autotune.load_or_tune(
+        model_path, os.environ.get("CHEX_AUTOTUNE_FILE", os.path.join(data_dir, "autotune.json")),
+        cores=cores, force=force, slo_ms=float(os.environ.get("CHEX_AUTOTUNE_SLO_MS", "500")),
+        cache_dir=os.environ.get("CHEX_MODEL_CACHE_DIR") or None,
+    )
+
+
+def prepare_autotune(model_path: str, cores: int, force: bool = False) -> bool:
+    """在 spawn 子进程中按每个 worker 的核数预算调优一次并写入配置文件，各 worker 启动时直接复用。"""
+    proc = mp.get_context("spawn").Process(target=_autotune, args=(model_path, cores, force))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        print(f"[serve] 自动调优失败（exit={proc.exitcode}），各 worker 使用默认配置")
+        return False
+    return True
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="CheXpert 推理服务（多 worker）")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("CHEX_WORKERS", "1")))
+    parser.add_argument("--threads", type=int, default=0, help="每个 worker 的 torch 线程数；0 表示核数均分")
+    parser.add_argument("--log-level", type=str, default="info")
+    args = parser.parse_args(argv)
+
+    workers = max(1, args.workers)
+    threads = args.threads or threads_per_worker(workers)
+    model_path = os.environ.get("MODEL_PATH", "final_global_model.pth")
+    data_dir = os.environ.get("CHEX_DATA_DIR", os.path.join(ROOT, "data"))
+    cache_dir = os.environ.get("CHEX_MODEL_CACHE_DIR", os.path.join(data_dir, "model_cache"))
+
+    # worker 由 uvicorn 以 spawn 方式启动，继承这里的环境变量
+    os.environ.update({
+        "CHEX_TORCH_THREADS": str(threads),
+        "CHEX_INTEROP_THREADS": "1",
+        "OMP_NUM_THREADS": str(threads),
+        "MKL_NUM_THREADS": str(threads),
+        "CHEX_MODEL_CACHE_DIR": cache_dir,
+        "CHEX_WORKERS": str(workers),   # app 据此在 /static 未命中时等待其他 worker 的后台写入
+    })
+    if cache_dir and os.path.exists(model_path):
+        prepare_artifact(model_path, cache_dir, os.environ.get("CHEX_FOLD_BN", "0") == "1")
+    # 调优只在这里做一次（worker 之间互相干扰，测不准），worker 只复用保存的结果
+    autotune = os.environ.get("CHEX_AUTOTUNE", "0").lower()
+    if autotune in ("1", "force") and os.path.exists(model_path):
+        # 成功时 worker 只读取保存的配置；失败时不让 N 个 worker 各自再扫一遍
+        ok = prepare_autotune(model_path, threads, force=autotune == "force")
+        os.environ["CHEX_AUTOTUNE"] = "1" if ok else "0"
+
+    print(f"[serve] workers={workers} threads/worker={threads} cores={available_cores()} cache={cache_dir or '-'}")
+    import uvicorn
+    uvicorn.run("app:app", host=args.host, port=args.port, workers=workers, log_level=args.log_level)
+
+
+if __name__ == "__main__":
+    main()
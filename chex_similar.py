@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""
+chex_similar.py — 相似病例检索：按历史记录 id 保存的嵌入向量索引（内存映射，向量化矩阵检索）
+
+每张分析过的图在前向时顺带得到 DenseNet121 的特征图，池化 + L2 归一化后的 1024 维向量
+（chex_model.embeddings）按历史记录 id 追加到这里；查询时返回内积（余弦）最大的 top-k 条历史记录。
+
+目录布局（只追加，定长记录，np.memmap 读取；ids 最后写入，作为“已提交”的条数）：
+    meta.json                {"format", "dim", "space", "nlist", "pq_m", "trained"}
+    vectors.f16              [n, dim] float16，原始向量（精确检索 / 重排 / 重新训练的依据）
+    ids.i64                  [n] 历史记录 id
+    --- train() 之后 ---
+    centroids.f32            [nlist, dim]      IVF 粗划分的聚类中心（nlist>0）
+    lists.i32                [n]               每条向量所属的划分
+    codebook.f32             [pq_m, 256, dim/pq_m]  乘积量化码本（pq_m>0）
+    codes.u8                 [n, pq_m]         每条向量的 PQ 编码（每条 pq_m 字节）
+
+检索（search 一次处理一批查询）：
+- 未训练 / 未启用时：float16 向量分块转 float32 与查询矩阵相乘，逐块维护 top-k（argpartition）；
+- nlist>0：先与聚类中心比较，只在最近的 nprobe 个划分中检索；
+- pq_m>0：候选只读 PQ 编码，用查询与码本的内积查找表（ADC）近似打分，
+  再取前 k*rerank 条用 float16 原始向量精确重排（扫描的字节数从 2*dim 降为 pq_m）。
+向量条数首次达到 train_size 时自动训练（numpy k-means），之前的向量一次性补编码，之后追加时顺带编码。
+
+同一目录可被多个进程（uvicorn 多 worker）共享：追加 / 训练用文件锁串行化，查询前按 ids 文件大小
+和 meta.json 修改时间刷新映射。
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:   # 非 POSIX：只做进程内串行化
+    fcntl = None
+
+FORMAT_VERSION = 1
+PQ_KSUB = 256
+
+
+# ---------------------------
+# k-means / PQ（纯 numpy）
+# ---------------------------
+def _assign(x: np.ndarray, centroids: np.ndarray, spherical: bool, chunk: int = 16384) -> np.ndarray:
+    """每行最近的中心：spherical 按内积最大，否则按 L2 最小。"""
+    out = np.empty(len(x), dtype=np.int32)
+    norms = None if spherical else (centroids * centroids).sum(1)
+    for s in range(0, len(x), chunk):
+        sim = x[s:s + chunk] @ centroids.T
+        out[s:s + chunk] = np.argmax(sim, 1) if spherical else np.argmin(norms[None, :] - 2 * sim, 1)
+    return out
+
+
+def kmeans(x: np.ndarray, k: int, iters: int = 10, spherical: bool = False, seed: int = 0) -> np.ndarray:
+    """Lloyd k-means；spherical 时中心归一化（与归一化向量的内积检索配套）。空簇保留上一轮的中心。"""
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(iters):
+        a = _assign(x, centroids, spherical)
+        counts = np.bincount(a, minlength=k)
+        nz = counts > 0
+        order = np.argsort(a, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        centroids[nz] = np.add.reduceat(x[order], starts[nz], axis=0) / counts[nz, None]
+        if spherical:
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+def pq_train(x: np.ndarray, m: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """每个子空间各 256 个码字：[m, 256, dim/m]。"""
+    d = x.shape[1] // m
+    return np.stack([kmeans(x[:, j * d:(j + 1) * d], PQ_KSUB, iters, seed=seed + j) for j in range(m)])
+
+
+def pq_encode(x: np.ndarray, codebook: np.ndarray) -> np.ndarray:
+    m, _, d = codebook.shape
+    codes = np.empty((len(x), m), dtype=np.uint8)
+    for j in range(m):
+        codes[:, j] = _assign(np.ascontiguousarray(x[:, j * d:(j + 1) * d], dtype=np.float32), codebook[j], False)
+    return codes
+
+
+# ---------------------------
+# 索引
+# ---------------------------
+class _View(NamedTuple):
+    """某一时刻的映射快照；_refresh 整体替换，查询全程使用同一个快照。"""
+    meta: Dict[str, Any]
+    n: int
+    ids: np.ndarray                      # [n] int64
+    vectors: np.ndarray                  # [n, dim] float16
+    centroids: Optional[np.ndarray]      # [nlist, dim]
+    lists: Optional[np.ndarray]          # [n] int32
+    codebook: Optional[np.ndarray]       # [pq_m, 256, dim/pq_m]
+    codes: Optional[np.ndarray]          # [n, pq_m] uint8
+
+
+class EmbeddingIndex:
+    """
+    - root: 索引目录（通常为 <data>/embeddings/<chex_model.embedding_space()>，与历史库放在一起）
+    - dim: 向量维度（DenseNet121 为 1024）
+    - space: 特征空间标识；与已有索引不一致时拒绝打开（不同权重的向量不可比较）
+    - nlist: IVF 划分数（0 关闭）；nprobe: 查询时检索的划分数
+    - pq_m: PQ 子空间数（0 关闭；dim 须能被整除），每条向量编码为 pq_m 字节；rerank: 重排候选倍数
+      已有索引的 nlist / pq_m 与此不同时按新配置重新训练；都传 None 表示沿用已有配置
+    - train_size: 条数首次达到该值时自动训练（0 表示只在显式调用 train() 时训练）
+    """
+
+    def __init__(
+        self,
+        root: str,
+        dim: int = 1024,
+        space: str = "",
+        nlist: Optional[int] = 0,
+        nprobe: int = 8,
+        pq_m: Optional[int] = 0,
+        rerank: int = 8,
+        train_size: int = 65536,
+    ):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.nprobe = max(1, int(nprobe))
+        self.rerank = max(1, int(rerank))
+        self.train_size = int(train_size)
+        self._lock = threading.Lock()
+        self._map_lock = threading.Lock()
+        self._meta_mtime = None
+        self._view: Optional[_View] = None
+        with self._locked():
+            meta = self._read_meta()
+            if meta is None:
+                meta = {"format": FORMAT_VERSION, "dim": int(dim), "space": space,
+                        "nlist": int(nlist or 0), "pq_m": int(pq_m or 0), "trained": False}
+            elif space and meta["space"] and meta["space"] != space:
+                raise ValueError(f"索引 {root} 属于特征空间 {meta['space']}，与当前模型 {space} 不一致")
+            elif nlist is not None and pq_m is not None and (meta["nlist"], meta["pq_m"]) != (int(nlist), int(pq_m)):
+                # 配置变了：按新配置重新训练（原始向量还在）
+                print(f"[similar] 索引配置 nlist={meta['nlist']} pq_m={meta['pq_m']} -> nlist={nlist} pq_m={pq_m}")
+                meta.update(nlist=int(nlist), pq_m=int(pq_m), trained=False)
+            if meta["pq_m"] and meta["dim"] % meta["pq_m"]:
+                raise ValueError(f"dim={meta['dim']} 不能被 pq_m={meta['pq_m']} 整除")
+            if meta != self._read_meta():
+                self._write_meta(meta)
+        self._refresh(force=True)
+        if self._needs_training():
+            self.train()
+
+    # ---------------------------
+    # 文件
+    # ---------------------------
+    def _file(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def _read_meta(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._file("meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get("format") == FORMAT_VERSION else None
+
+    def _write_meta(self, meta: Dict[str, Any]) -> None:
+        tmp = self._file(f"meta.json.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._file("meta.json"))
+
+    def _replace(self, name: str, chunks: Sequence[bytes]) -> None:
+        tmp = self._file(f"{name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            for c in chunks:
+                f.write(c)
+        os.replace(tmp, self._file(name))
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """进程内锁 + 跨进程文件锁。"""
+        with self._lock, open(self._file("lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _map(self, name: str, dtype: Any, width: int, n: int) -> np.ndarray:
+        if n == 0 or not os.path.exists(self._file(name)):
+            return np.empty((0, width) if width else (0,), dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode="r", shape=(n, width) if width else (n,))
+
+    def _refresh(self, force: bool = False) -> _View:
+        """其他进程追加 / 训练后重新映射（按 ids 文件大小与 meta.json 修改时间判断）；返回当前快照。"""
+        with self._map_lock:
+            try:
+                mtime = os.path.getmtime(self._file("meta.json"))
+                n = os.path.getsize(self._file("ids.i64")) // 8 if os.path.exists(self._file("ids.i64")) else 0
+            except OSError:
+                return self._view
+            view = self._view
+            if not force and view is not None and n == view.n and mtime == self._meta_mtime:
+                return view
+            meta = self._read_meta()
+            dim = int(meta["dim"])
+            centroids = lists = codebook = codes = None
+            if meta["trained"] and meta["nlist"]:
+                centroids = np.fromfile(self._file("centroids.f32"), dtype=np.float32).reshape(meta["nlist"], dim)
+                lists = self._map("lists.i32", np.int32, 0, n)
+            if meta["trained"] and meta["pq_m"]:
+                m = meta["pq_m"]
+                codebook = np.fromfile(self._file("codebook.f32"), dtype=np.float32).reshape(m, PQ_KSUB, dim // m)
+                codes = self._map("codes.u8", np.uint8, m, n)
+            self._view = _View(meta, n, self._map("ids.i64", np.int64, 0, n), self._map("vectors.f16", np.float16, dim, n),
+                               centroids, lists, codebook, codes)
+            self._meta_mtime = mtime
+            return self._view
+
+    @property
+    def meta(self) -> Dict[str, Any]:
+        return self._view.meta
+
+    @property
+    def dim(self) -> int:
+        return int(self._view.meta["dim"])
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._view.vectors
+
+    def _committed(self) -> int:
+        """ids 为准；其他文件中多出的（写到一半崩溃）截掉。"""
+        n = os.path.getsize(self._file("ids.i64")) // 8 if os.path.exists(self._file("ids.i64")) else 0
+        for name, width in (("vectors.f16", self.dim * 2), ("lists.i32", 4), ("codes.u8", self.meta["pq_m"])):
+            path = self._file(name)
+            if os.path.exists(path) and os.path.getsize(path) > n * width:
+                os.truncate(path, n * width)
+        return n
+
+    def __len__(self) -> int:
+        return self._refresh().n
+
+    # ---------------------------
+    # 写入
+    # ---------------------------
+    def add(self, key: int, vector: np.ndarray) -> None:
+        self.add_many([key], np.asarray(vector)[None])
+
+    def add_many(self, keys: Sequence[int], vectors: np.ndarray) -> int:
+        """追加一批（已 L2 归一化的）向量；返回追加后的总条数。"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(keys), -1)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"向量维度 {vectors.shape[1]} 与索引 {self.dim} 不一致")
+        with self._locked():
+            v = self._refresh()
+            self._committed()
+            if v.centroids is not None:
+                with open(self._file("lists.i32"), "ab") as f:
+                    f.write(_assign(vectors, v.centroids, True).tobytes())
+            if v.codebook is not None:
+                with open(self._file("codes.u8"), "ab") as f:
+                    f.write(pq_encode(vectors, v.codebook).tobytes())
+            with open(self._file("vectors.f16"), "ab") as f:
+                f.write(vectors.astype(np.float16).tobytes())
+            with open(self._file("ids.i64"), "ab") as f:
+                f.write(np.asarray(keys, dtype=np.int64).tobytes())
+            n = self._committed()
+            self._refresh()
+        if self._needs_training():
+            self.train()
+        return n
+
+    def _needs_training(self) -> bool:
+        meta = self.meta
+        return (bool(self.train_size) and not meta["trained"] and bool(meta["nlist"] or meta["pq_m"])
+                and self._view.n >= self.train_size)
+
+    def train(self, sample: int = 65536, iters: int = 10, seed: int = 0, force: bool = False) -> None:
+        """在（至多 sample 条）已有向量上训练 IVF 中心与 PQ 码本，并为全部已有向量编码。"""
+        with self._locked():
+            self._refresh(force=True)
+            n = self._committed()
+            meta = dict(self.meta)
+            if n == 0 or not (meta["nlist"] or meta["pq_m"]) or (meta["trained"] and not force):
+                return   # 无需训练，或其他进程已训练过
+            rng = np.random.default_rng(seed)
+            rows = np.sort(rng.choice(n, min(n, sample), replace=False))
+            x = np.asarray(self.vectors[rows], dtype=np.float32)
+            chunk = 65536
+
+            def _encode(fn) -> List[bytes]:
+                return [fn(np.asarray(self.vectors[s:s + chunk], dtype=np.float32)).tobytes() for s in range(0, n, chunk)]
+
+            # 先写临时文件再改名：其他进程已映射的旧文件不会被截断
+            if meta["nlist"]:
+                centroids = kmeans(x, meta["nlist"], iters, spherical=True, seed=seed)
+                self._replace("centroids.f32", [centroids.tobytes()])
+                self._replace("lists.i32", _encode(lambda v: _assign(v, centroids, True)))
+            if meta["pq_m"]:
+                codebook = pq_train(x, meta["pq_m"], iters, seed)
+                self._replace("codebook.f32", [codebook.tobytes()])
+                self._replace("codes.u8", _encode(lambda v: pq_encode(v, codebook)))
+            meta["trained"] = True
+            self._write_meta(meta)
+            self._refresh(force=True)
+        print(f"[similar] 已训练索引：n={n} nlist={meta['nlist']} pq_m={meta['pq_m']}")
+
+    # ---------------------------
+    # 查询
+    # ---------------------------
+    def vector(self, key: int) -> Optional[np.ndarray]:
+        """按 key 取已保存的向量（同一 key 多次追加时取最后一条）。"""
+        v = self._refresh()
+        rows = np.flatnonzero(v.ids == int(key))
+        return np.asarray(v.vectors[rows[-1]], dtype=np.float32) if len(rows) else None
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 10,
+        nprobe: Optional[int] = None,
+        exclude: Optional[Sequence[int]] = None,
+        chunk: int = 16384,
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        queries: [b, dim]（或 [dim]）已归一化的查询向量；返回每个查询的 [(key, 内积), ...]，按相似度降序。
+        exclude: 不返回的 key（例如查询自身）
+        """
+        v = self._refresh()
+        q = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, v.vectors.shape[1])
+        if v.n == 0:
+            return [[] for _ in q]
+        # 多取几条，排除 / 重复 key 之后仍有 k 条
+        want = int(k) + (len(exclude) if exclude else 0)
+        fn = self._flat if v.codes is None else self._approx
+        if v.centroids is None:
+            return self._finish(v, *fn(v, q, np.arange(v.n), want, chunk), k, exclude)
+        results = []
+        sims = q @ v.centroids.T                                            # [b, nlist]
+        p = min(int(nprobe or self.nprobe), len(v.centroids))
+        for i in range(len(q)):
+            probe = np.argpartition(-sims[i], p - 1)[:p]
+            rows = np.flatnonzero(np.isin(v.lists, probe))
+            results += self._finish(v, *fn(v, q[i:i + 1], rows, want, chunk), k, exclude)
+        return results
+
+    @staticmethod
+    def _topk(scores: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """scores [b, r]，rows [r] 或 [b, r] -> 每行前 k 的 (行号 [b,k], 分数 [b,k])，未排序。"""
+        rows = np.broadcast_to(rows, scores.shape)
+        if scores.shape[1] > k:
+            part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            return np.take_along_axis(rows, part, 1), np.take_along_axis(scores, part, 1)
+        return rows.copy(), scores
+
+    def _flat(self, v: _View, q: np.ndarray, rows: np.ndarray, k: int, chunk: int) -> Tuple[np.ndarray, np.ndarray]:
+        """精确检索：float16 向量分块与查询矩阵相乘，逐块合并 top-k。"""
+        best_rows = np.empty((len(q), 0), dtype=np.int64)
+        best = np.empty((len(q), 0), dtype=np.float32)
+        contiguous = len(rows) == 0 or rows[-1] - rows[0] + 1 == len(rows)
+        for s in range(0, len(rows), chunk):
+            r = rows[s:s + chunk]
+            block = v.vectors[r[0]:r[-1] + 1] if contiguous else v.vectors[r]
+            scores = q @ np.asarray(block, dtype=np.float32).T               # [b, len(r)]
+            cr, cs = self._topk(scores, r, k)
+            best_rows, best = self._topk(np.concatenate([best, cs], 1),
+                                         np.concatenate([best_rows, cr], 1), k) if best.size else (cr, cs)
+        return best_rows, best
+
+    def _approx(self, v: _View, q: np.ndarray, rows: np.ndarray, k: int, chunk: int) -> Tuple[np.ndarray, np.ndarray]:
+        """PQ：查找表近似打分取前 k*rerank 条候选，再用原始向量精确重排。"""
+        m, _, d = v.codebook.shape
+        # [b, m, 256]：查询各子向量与各码字的内积
+        lut = np.einsum("bmd,mkd->bmk", q.reshape(len(q), m, d), v.codebook)
+        flat = lut.reshape(len(q), m * PQ_KSUB)
+        offsets = (np.arange(m, dtype=np.int32) * PQ_KSUB)[None, :]
+        shortlist = self.rerank * k
+        cand_rows = np.empty((len(q), 0), dtype=np.int64)
+        cand = np.empty((len(q), 0), dtype=np.float32)
+        for s in range(0, len(rows), chunk):
+            r = rows[s:s + chunk]
+            idx = np.asarray(v.codes[r], dtype=np.int32) + offsets            # [len(r), m]
+            scores = np.stack([fb[idx].sum(1) for fb in flat])                # [b, len(r)]
+            cr, cs = self._topk(scores, r, shortlist)
+            cand_rows, cand = self._topk(np.concatenate([cand, cs], 1),
+                                         np.concatenate([cand_rows, cr], 1), shortlist) if cand.size else (cr, cs)
+        out_rows, out = [], []
+        for i in range(len(q)):
+            r = np.sort(cand_rows[i])
+            exact = np.asarray(v.vectors[r], dtype=np.float32) @ q[i]
+            top = np.argsort(-exact)[:k]
+            out_rows.append(r[top])
+            out.append(exact[top])
+        return np.array(out_rows), np.array(out)
+
+    @staticmethod
+    def _finish(v: _View, rows: np.ndarray, scores: np.ndarray, k: int,
+                exclude: Optional[Sequence[int]]) -> List[List[Tuple[int, float]]]:
+        skip = set(int(e) for e in exclude or ())
+        results = []
+        for r, s in zip(rows, scores):
+            order = np.argsort(-s)
+            hits, seen = [], set()
+            for j in order:
+                key = int(v.ids[r[j]])
+                if key in skip or key in seen:
+                    continue
+                seen.add(key)
+                hits.append((key, float(s[j])))
+                if len(hits) == k:
+                    break
+            results.append(hits)
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        v = self._refresh()
+        files = ("vectors.f16", "ids.i64", "centroids.f32", "lists.i32", "codebook.f32", "codes.u8")
+        return {
+            "count": v.n,
+            "dim": int(v.meta["dim"]),
+            "space": v.meta["space"],
+            "nlist": v.meta["nlist"],
+            "pq_m": v.meta["pq_m"],
+            "trained": v.meta["trained"],
+            "bytes": {f: os.path.getsize(self._file(f)) for f in files if os.path.exists(self._file(f))},
+        }
+
+
+# ---------------------------
+# 命令行：查看 / 训练
+# ---------------------------
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="相似病例检索索引")
+    parser.add_argument("root", type=str, help="索引目录")
+    parser.add_argument("action", choices=("stats", "train"))
+    parser.add_argument("--sample", type=int, default=65536, help="训练样本条数")
+    parser.add_argument("--nlist", type=int, default=None, help="改用该 IVF 划分数（缺省沿用索引配置）")
+    parser.add_argument("--pq-m", type=int, default=None, help="改用该 PQ 子空间数（缺省沿用索引配置）")
+    args = parser.parse_args(argv)
+
+    index = EmbeddingIndex(args.root, nlist=args.nlist, pq_m=args.pq_m, train_size=0)
+    if args.action == "train":
+        index.train(sample=args.sample, force=True)
+    print(json.dumps(index.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
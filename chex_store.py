@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+chex_store.py — 原图 / 热力图产物的清单索引与保留策略
+
+app 把原图、热力图写到 static/uploads、static/heatmaps 下，过去既没有索引也没有上限：
+按请求找产物只能扫目录，目录随时间无限增长。这里：
+- 清单索引（SQLite WAL）：每个产物一行 (request_id, name, path, bytes, created)，request_id 上有索引，
+  按请求查产物是一次索引查找，与已存产物数量无关；
+- 目录布局：默认按天分目录（<subdir>/<day>/<stem>.<ext>，与原有 URL 一致）；shard=True 时按文件名哈希
+  前缀两级分目录（<subdir>/ab/cd/<stem>.<ext>），单个目录不会积累上百万个文件；
+- 保留策略：超过 max_age_days 的产物、以及总字节数超过 max_bytes 时最旧的产物，由后台线程按 created
+  顺序分块删除（文件与索引行一起删），删空的目录顺手移除；
+- 总字节数由触发器维护在 meta 表中，判断是否超限不做全表 SUM。
+产物在后台写盘完成后才登记（见 app._register），索引里的每一行都对应一个完整的文件。
+只在索引里登记过的文件受保留策略管理；启用前已有的文件可用 `python chex_store.py backfill` 一次性导入。
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id  TEXT NOT NULL,
+    name        TEXT NOT NULL,
+    path        TEXT NOT NULL,
+    bytes       INTEGER NOT NULL,
+    created     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_artifacts_request ON artifacts(request_id);
+CREATE INDEX IF NOT EXISTS idx_artifacts_created ON artifacts(created);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta(key, value) VALUES ('bytes', 0);
+INSERT OR IGNORE INTO meta(key, value) VALUES ('count', 0);
+CREATE TRIGGER IF NOT EXISTS trg_artifacts_insert AFTER INSERT ON artifacts
+BEGIN
+    UPDATE meta SET value = value + NEW.bytes WHERE key = 'bytes';
+    UPDATE meta SET value = value + 1 WHERE key = 'count';
+END;
+CREATE TRIGGER IF NOT EXISTS trg_artifacts_delete AFTER DELETE ON artifacts
+BEGIN
+    UPDATE meta SET value = value - OLD.bytes WHERE key = 'bytes';
+    UPDATE meta SET value = value - 1 WHERE key = 'count';
+END;
+"""
+
+# 一次 GC 事务删除的行数
+GC_CHUNK = 1000
+# backfill：子目录 -> 产物名（与 app 登记时一致）
+BACKFILL_NAMES = {"uploads": "original", "heatmaps": "heatmap"}
+
+
+def shard_prefix(stem: str, depth: int = 2) -> str:
+    """文件名哈希前缀目录，如 'ab/cd'（每级 256 个目录）。"""
+    h = hashlib.sha1(stem.encode("utf-8")).hexdigest()
+    return "/".join(h[2 * i:2 * i + 2] for i in range(depth))
+
+
+class ArtifactStore:
+    """
+    - root: 产物根目录（app 中为 STATIC_ROOT）；索引中的 path 相对于它
+    - db_path: 清单索引 SQLite 文件
+    - url_prefix: root 对外的 URL 前缀（app 中为 /static）
+    - shard: 按哈希前缀而不是按天分目录
+    - max_age_days / max_bytes: 保留策略，0 表示不限制
+    连接按线程缓存（sqlite3 连接不能跨线程共享）。
+    """
+
+    def __init__(
+        self,
+        root: str,
+        db_path: str,
+        url_prefix: str = "/static",
+        shard: bool = False,
+        max_age_days: float = 0,
+        max_bytes: int = 0,
+    ):
+        self.root = os.path.abspath(root)
+        self.db_path = db_path
+        self.url_prefix = url_prefix.rstrip("/")
+        self.shard = bool(shard)
+        self.max_age_days = float(max_age_days)
+        self.max_bytes = int(max_bytes)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._gc_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.deleted = 0
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ---------------------------
+    # 位置
+    # ---------------------------
+    def place(self, subdir: str, stem: str, ext: str, day: Optional[str] = None) -> str:
+        """新产物的相对路径（相对 root，'/' 分隔）。"""
+        if self.shard:
+            return f"{subdir}/{shard_prefix(stem)}/{stem}.{ext}"
+        return f"{subdir}/{day or time.strftime('%Y-%m-%d')}/{stem}.{ext}"
+
+    def path(self, rel: str) -> str:
+        return os.path.join(self.root, *rel.split("/"))
+
+    def url(self, rel: str) -> str:
+        return f"{self.url_prefix}/{rel}"
+
+    def rel(self, url: str) -> str:
+        """url 的逆运算；不在 url_prefix 下时抛 ValueError。"""
+        if not url.startswith(self.url_prefix + "/"):
+            raise ValueError(f"不是本存储的 URL: {url}")
+        return url[len(self.url_prefix) + 1:]
+
+    # ---------------------------
+    # 登记
+    # ---------------------------
+    def add(self, request_id: str, name: str, rel: str, nbytes: Optional[int] = None,
+            created: Optional[float] = None) -> None:
+        """登记一个已落盘的产物；nbytes 缺省取文件大小。"""
+        if nbytes is None:
+            nbytes = os.path.getsize(self.path(rel))
+        with self._write_lock:
+            self._conn().execute(
+                "INSERT INTO artifacts(request_id, name, path, bytes, created) VALUES (?,?,?,?,?)",
+                (request_id, name, rel, int(nbytes), time.time() if created is None else float(created)),
+            )
+
+    def add_many(self, rows: List[Tuple[str, str, str, int, float]]) -> int:
+        """批量登记 (request_id, name, rel, bytes, created)，单事务。"""
+        conn = self._conn()
+        with self._write_lock:
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    "INSERT INTO artifacts(request_id, name, path, bytes, created) VALUES (?,?,?,?,?)", rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    # ---------------------------
+    # 查询
+    # ---------------------------
+    def lookup(self, request_id: str) -> Dict[str, Dict[str, Any]]:
+        """某请求的全部产物：{name: {"url", "path", "bytes", "created"}}；同名多次登记时取最新的一个。"""
+        rows = self._conn().execute(
+            "SELECT name, path, bytes, created FROM artifacts WHERE request_id = ? ORDER BY id", (request_id,)
+        ).fetchall()
+        return {
+            r["name"]: {"url": self.url(r["path"]), "path": self.path(r["path"]),
+                        "bytes": int(r["bytes"]), "created": float(r["created"])}
+            for r in rows
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        meta = dict(self._conn().execute("SELECT key, value FROM meta").fetchall())
+        return {
+            "count": int(meta.get("count", 0)),
+            "bytes": int(meta.get("bytes", 0)),
+            "deleted": self.deleted,
+            "max_age_days": self.max_age_days,
+            "max_bytes": self.max_bytes,
+            "shard": self.shard,
+        }
+
+    # ---------------------------
+    # 保留策略
+    # ---------------------------
+    def _delete(self, rows: List[sqlite3.Row]) -> int:
+        dirs = set()
+        for r in rows:
+            path = self.path(r["path"])
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[store] 删除失败 {path}: {e}")
+            dirs.add(os.path.dirname(path))
+        conn = self._conn()
+        with self._write_lock:
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("DELETE FROM artifacts WHERE id = ?", [(r["id"],) for r in rows])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        for d in dirs:
+            # 删空的目录一并移除（非空时 rmdir 失败，忽略）
+            try:
+                os.rmdir(d)
+            except OSError:
+                pass
+        self.deleted += len(rows)
+        return len(rows)
+
+    def gc(self, now: Optional[float] = None) -> Dict[str, int]:
+        """执行一次保留策略，返回按原因统计的删除数。"""
+        now = time.time() if now is None else now
+        expired = oversize = 0
+        conn = self._conn()
+        with self._gc_lock:
+            if self.max_age_days > 0:
+                cutoff = now - self.max_age_days * 86400.0
+                while True:
+                    rows = conn.execute("SELECT id, path FROM artifacts WHERE created < ? ORDER BY created LIMIT ?",
+                                        (cutoff, GC_CHUNK)).fetchall()
+                    if not rows:
+                        break
+                    expired += self._delete(rows)
+            if self.max_bytes > 0:
+                while True:
+                    total = int(conn.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0])
+                    if total <= self.max_bytes:
+                        break
+                    rows = conn.execute("SELECT id, path, bytes FROM artifacts ORDER BY created LIMIT ?",
+                                        (GC_CHUNK,)).fetchall()
+                    if not rows:
+                        break
+                    # 只删到刚好不超限为止
+                    over, take = total - self.max_bytes, []
+                    for r in rows:
+                        take.append(r)
+                        over -= int(r["bytes"])
+                        if over <= 0:
+                            break
+                    oversize += self._delete(take)
+        if expired or oversize:
+            print(f"[store] GC 删除 {expired} 个过期、{oversize} 个超出容量的产物")
+        return {"expired": expired, "oversize": oversize}
+
+    def start_gc(self, interval_s: float = 600.0) -> "ArtifactStore":
+        """后台线程每 interval_s 秒执行一次 gc（未配置保留策略时不启动）。"""
+        if self._thread is not None or (self.max_age_days <= 0 and self.max_bytes <= 0):
+            return self
+
+        def _loop():
+            while not self._stop.is_set():
+                try:
+                    self.gc()
+                except Exception as e:
+                    print(f"[store] GC 失败：{e}")
+                self._stop.wait(interval_s)
+
+        self._thread = threading.Thread(target=_loop, name="chex-store-gc", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    # ---------------------------
+    # 旧文件导入
+    # ---------------------------
+    def _walk(self, subdir: str) -> Iterator[Tuple[str, str, str, int, float]]:
+        base = os.path.join(self.root, subdir)
+        for dirpath, _, files in os.walk(base):
+            for fname in files:
+                if fname.endswith(".tmp"):
+                    continue
+                full = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    continue
+                rel = os.path.relpath(full, self.root).replace(os.sep, "/")
+                yield (os.path.splitext(fname)[0], BACKFILL_NAMES.get(subdir, subdir), rel,
+                       int(st.st_size), float(st.st_mtime))
+
+    def backfill(self, subdirs: Tuple[str, ...] = ("uploads", "heatmaps"), chunk: int = 10000) -> int:
+        """把索引中没有的已有文件登记进来（request_id 取文件名，name 按子目录，created 取 mtime）。"""
+        known = {r[0] for r in self._conn().execute("SELECT path FROM artifacts")}
+        n, batch = 0, []
+        for subdir in subdirs:
+            for row in self._walk(subdir):
+                if row[2] in known:
+                    continue
+                batch.append(row)
+                if len(batch) >= chunk:
+                    n += self.add_many(batch)
+                    batch = []
+        if batch:
+            n += self.add_many(batch)
+        return n
+
+
+# ---------------------------
+# 命令行：统计 / 立即 GC / 导入旧文件
+# ---------------------------
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="CheXpert 产物存储维护")
+    parser.add_argument("command", choices=["stats", "gc", "backfill"])
+    parser.add_argument("--root", type=str, default=os.environ.get("CHEX_STATIC_ROOT", "static"))
+    parser.add_argument("--db", type=str, default=os.path.join(os.environ.get("CHEX_DATA_DIR", "data"), "artifacts.sqlite3"))
+    parser.add_argument("--max-age-days", type=float, default=0)
+    parser.add_argument("--max-gb", type=float, default=0)
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.root, args.db, max_age_days=args.max_age_days, max_bytes=int(args.max_gb * (1 << 30)))
+    if args.command == "backfill":
+        print(f"[store] 已导入 {store.backfill()} 个文件")
+    elif args.command == "gc":
+        print(json.dumps(store.gc()))
+    print(json.dumps(store.stats(), ensure_ascii=False))
@@ -1,8 +1,8 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-import uvicorn, os, uuid, shutil
+import uvicorn, os, uuid, hashlib
 from typing import List, Optional, Dict, Any
 
 # 引入你自己的函数：load_trained_model / predict_with_optional_heatmap
@@ -12,6 +12,7 @@ from test import load_trained_model, predict_with_optional_heatmap
 MODEL_PATH = os.environ.get("MODEL_PATH", "final_global_model.pth")
 HEATMAP_DIR = os.environ.get("HEATMAP_DIR", "heatmaps")
 UPLOAD_DIR  = os.environ.get("UPLOAD_DIR", "uploads")
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", "100")) * (1 << 20))
 
 os.makedirs(HEATMAP_DIR, exist_ok=True)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -41,6 +42,11 @@ def _load_model_once():
     model, class_names = load_trained_model(MODEL_PATH)  # 直接复用你的函数
     print("Model ready.")
 
+def _request_heatmap_dir(request_id: str) -> str:
+    """请求的热力图子目录（相对 HEATMAP_DIR）：<ab>/<cd>/<request_id>。"""
+    h = hashlib.sha1(request_id.encode("utf-8")).hexdigest()
+    return f"{h[:2]}/{h[2:4]}/{request_id}"
+
 class PredictResponse(BaseModel):
     filename: str
     probabilities: Dict[str, float]
@@ -57,17 +63,42 @@ async def predict_endpoint(
     suffix = os.path.splitext(file.filename)[1].lower() or ".jpg"
     temp_name = f"{uuid.uuid4().hex}{suffix}"
     temp_path = os.path.join(UPLOAD_DIR, temp_name)
-    with open(temp_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-
-    # 调用你自己的预测函数
-    result = predict_with_optional_heatmap(
-        model=model,
-        image_path=temp_path,
-        class_names=class_names,
-        generate_heatmap=generate_heatmap,
-        save_dir=HEATMAP_DIR
-    )
+    # 分块异步读取并写盘，超过上限立即中止（不阻塞事件循环、不整体读入内存）
+    size = 0
+    try:
+        with open(temp_path, "wb") as f:
+            while True:
+                chunk = await file.read(1 << 20)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                f.write(chunk)
+    except HTTPException:
+        os.remove(temp_path)
+        raise
+
+    # 每个请求的热力图写到自己的目录（按哈希前缀分两级，单个目录不会堆积海量文件），
+    # 返回时只列这个目录，不再扫描整个 HEATMAP_DIR、也不会返回其他请求的热力图
+    request_id = os.path.splitext(temp_name)[0]
+    request_dir = _request_heatmap_dir(request_id)
+    if generate_heatmap:
+        os.makedirs(os.path.join(HEATMAP_DIR, request_dir), exist_ok=True)
+    try:
+        result = predict_with_optional_heatmap(
+            model=model,
+            image_path=temp_path,
+            class_names=class_names,
+            generate_heatmap=generate_heatmap,
+            save_dir=os.path.join(HEATMAP_DIR, request_dir)
+        )
+    finally:
+        # 上传图片只是推理用的临时文件
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
 
     if result is None:
         # 返回一个简单错误（这里简化处理）
@@ -86,15 +117,14 @@ async def predict_endpoint(
     preds_dict = {cls: int(predictions[i]) for i, cls in enumerate(class_names)}
     positives = [cls for cls, v in preds_dict.items() if v == 1]
 
-    # 如果生成热力图，把目录里新生成的目标文件挑出来（最简单方案：按文件名前缀匹配）
+    # test.py 中热力图命名是："{base_name}_{class_name}_heatmap.jpg"，目录里只有本请求的文件
     heatmap_urls: List[str] = []
-    base = os.path.splitext(os.path.basename(temp_path))[0]
-    # 你的 test.py 中热力图命名是："{base_name}_{class_name}_heatmap.jpg"
-    # 但 base_name 用的是原始上传文件名，不是我们 uuid 名，这里我们简单放开匹配（也可以在 test.py 里改成 uuid）
-    for fname in os.listdir(HEATMAP_DIR):
-        if fname.endswith("_heatmap.jpg"):
-            # 返回可通过浏览器访问的 URL
-            heatmap_urls.append(f"/heatmaps/{fname}")
+    full_dir = os.path.join(HEATMAP_DIR, request_dir)
+    if generate_heatmap and os.path.isdir(full_dir):
+        for fname in sorted(os.listdir(full_dir)):
+            if fname.endswith("_heatmap.jpg"):
+                # 返回可通过浏览器访问的 URL
+                heatmap_urls.append(f"/heatmaps/{request_dir}/{fname}")
 
     return PredictResponse(
         filename=file.filename,
@@ -13,6 +13,10 @@ export const API_V1_PREFIX = '/api/v1';
 export const API_ENDPOINTS = {
   // 图像分析
   IMAGE_ANALYZE: `${API_BASE_URL}${API_V1_PREFIX}/image/analyze`,
+  // 分诊暂缓的热力图按需补算：POST `${IMAGE_HEATMAP}/${request_id}`
+  IMAGE_HEATMAP: `${API_BASE_URL}${API_V1_PREFIX}/image/heatmap`,
+  // 相似病例检索：GET ?history_id=&k= / POST 上传图片
+  IMAGE_SIMILAR: `${API_BASE_URL}${API_V1_PREFIX}/image/similar`,
 
   // 报告生成
   REPORT_GENERATE: `${API_BASE_URL}${API_V1_PREFIX}/report/generate`,
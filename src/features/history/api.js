@@ -15,6 +15,30 @@ export async function fetchAnalysisHistory({ page = 1, pageSize = 10 } = {}) {
       diagnosis: it.diagnosis,
       confidence: it.confidence, // 0~1
       status: it.status || 'completed',
+      id: it.id,
+      requestId: it.request_id || null,
+    })),
+  };
+}
+
+// 相似病例：与某条历史记录最相似的 k 条（需后端 CHEX_SIMILAR=1）
+export async function fetchSimilarCases(historyId, { k = 5 } = {}) {
+  const url = `${API_BASE_URL}/api/v1/image/similar?history_id=${encodeURIComponent(historyId)}&k=${k}`;
+  const res = await fetch(url);
+  const data = await res.json().catch(() => null);
+  if (!data?.success) return { items: [], error: data?.detail || null };
+  const toAbs = (u) => (u && u.startsWith('/') ? `${API_BASE_URL}${u}` : u || null);
+
+  return {
+    items: (data.items || []).map(it => ({
+      id: it.id,
+      date: it.date,
+      fileName: it.file_name,
+      diagnosis: it.diagnosis,
+      confidence: it.confidence,
+      similarity: it.similarity, // 余弦相似度
+      originalImageUrl: toAbs(it.original_image_url),
+      heatmapUrl: toAbs(it.heatmap_image_url),
     })),
   };
 }
@@ -38,7 +38,10 @@ export async function uploadAndAnalyzeImage(file, options = {}) {
     threshold = 0.5,
     alpha = 0.45,
     return_top_k = null,
-    request_id = undefined,
+    client_request_id = undefined,   // 仅作关联 id 回显；补算热力图用响应里服务端生成的 requestId
+    heatmap_mode = undefined,   // 'image'（默认，服务端渲染）或 'grid'（前端叠加）
+    triage = undefined,         // true：阴性图不当场生成热力图（heatmapDeferred），之后用 fetchDeferredHeatmap 补算
+    priority = undefined,       // 'stat' | 'routine'（默认）| 'bulk'：服务端准入控制的优先级通道
   } = options || {};
 
   if (!validateFileType(file)) {
@@ -53,8 +56,11 @@ export async function uploadAndAnalyzeImage(file, options = {}) {
   formData.append('generate_heatmap', String(generate_heatmap));
   formData.append('threshold', String(threshold));
   formData.append('alpha', String(alpha));
+  if (heatmap_mode) formData.append('heatmap_mode', heatmap_mode);
+  if (triage != null) formData.append('triage', String(triage));
+  if (priority) formData.append('priority', priority);
   if (return_top_k != null) formData.append('return_top_k', String(return_top_k));
-  if (request_id) formData.append('request_id', request_id);
+  if (client_request_id) formData.append('client_request_id', client_request_id);
 
   let resp;
   try {
@@ -87,8 +93,39 @@ export async function uploadAndAnalyzeImage(file, options = {}) {
       description: it.description || ''
     })),
     heatmapUrl: toAbs(resp.heatmap_image_url),
+    heatmapGrid: resp.heatmap_grid || null,   // heatmap_mode=grid 时由前端叠加
+    heatmapDeferred: !!resp.heatmap_deferred,
+    requestId: resp.request_id || null,
+    clientRequestId: resp.client_request_id || null,
     originalImageUrl: toAbs(resp.original_image_url),
     meta: resp.meta || {},
     rawResponse: resp
   };
 }
+
+// ========== 分诊暂缓的热力图：按需补算 ==========
+export async function fetchDeferredHeatmap(requestId, options = {}) {
+  const { alpha = undefined, threshold = undefined, heatmap_mode = undefined } = options || {};
+  const formData = new FormData();
+  if (alpha != null) formData.append('alpha', String(alpha));
+  if (threshold != null) formData.append('threshold', String(threshold));
+  if (heatmap_mode) formData.append('heatmap_mode', heatmap_mode);
+
+  const base = API_ENDPOINTS?.IMAGE_HEATMAP || '/api/v1/image/heatmap';
+  const url = `${base}/${encodeURIComponent(requestId)}`;
+  let resp;
+  try {
+    resp = typeof apiPostFormData === 'function'
+      ? await apiPostFormData(url, formData)
+      : await (await fetch(url, { method: 'POST', body: formData })).json();
+  } catch (e) {
+    return { success: false, error_code: 'NETWORK_ERROR', message: e?.message || 'Network error' };
+  }
+  if (!resp?.success) return resp;
+  return {
+    success: true,
+    heatmapUrl: toAbs(resp.heatmap_image_url),
+    heatmapGrid: resp.heatmap_grid || null,
+    meta: resp.meta || {},
+  };
+}
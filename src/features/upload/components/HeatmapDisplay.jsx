@@ -1,9 +1,29 @@
 // upload/components/HeatmapDisplay.jsx
-import React from 'react';
+import React, { useEffect, useRef } from 'react';
 import { Card, Typography, Progress, Tag, Space, Empty } from 'antd';
+import { drawCamOverlay } from '../../../utils/camOverlay';
 
 const { Title, Text, Paragraph } = Typography;
 
+// heatmap_mode=grid：在画布上把低分辨率 CAM 叠加到原图
+function CamCanvas({ imageUrl, grid }) {
+  const canvasRef = useRef(null);
+
+  useEffect(() => {
+    if (!imageUrl || !grid || !canvasRef.current) return undefined;
+    let cancelled = false;
+    const img = new Image();
+    img.crossOrigin = 'anonymous';
+    img.onload = () => {
+      if (!cancelled && canvasRef.current) drawCamOverlay(canvasRef.current, img, grid);
+    };
+    img.src = imageUrl;
+    return () => { cancelled = true; };
+  }, [imageUrl, grid]);
+
+  return <canvas ref={canvasRef} className="image" style={{ width: '100%', borderRadius: 8 }} />;
+}
+
 export default function HeatmapDisplay({ analysisResults, isAnalyzing }) {
   if (!analysisResults) return null;
 
@@ -13,6 +33,8 @@ export default function HeatmapDisplay({ analysisResults, isAnalyzing }) {
     explanation,
     recommendations = [],
     heatmapUrl,
+    heatmapGrid,
+    originalImageUrl,
     meta = {}
   } = analysisResults;
 
@@ -30,6 +52,11 @@ export default function HeatmapDisplay({ analysisResults, isAnalyzing }) {
               <Text type="secondary">热力图</Text>
               <img src={heatmapUrl} alt="heatmap" className="image" style={{ width: '100%', borderRadius: 8 }} />
             </div>
+          ) : heatmapGrid && originalImageUrl ? (
+            <div className="image-col" style={{ width: '100%' }}>
+              <Text type="secondary">热力图</Text>
+              <CamCanvas imageUrl={originalImageUrl} grid={heatmapGrid} />
+            </div>
           ) : (
             <Empty description="未生成热力图（可能阈值过高或未开启）" />
           )}
@@ -0,0 +1,59 @@
+/**
+ * CAM 网格前端叠加工具
+ * 后端 heatmap_mode=grid 时返回 heatmap_grid：
+ *   { width, height, data(base64 uint8 网格), lut(base64 256x3 RGB), alpha, image_width, image_height }
+ * 这里把网格按查找表着色成小图，再双线性放大、以 alpha 混合到原图上。
+ */
+
+const decodeBase64 = (b64) => {
+  const bin = atob(b64);
+  const out = new Uint8ClampedArray(bin.length);
+  for (let i = 0; i < bin.length; i += 1) out[i] = bin.charCodeAt(i);
+  return out;
+};
+
+/**
+ * 把 CAM 网格着色为 width x height 的小画布
+ * @param {object} grid - 后端返回的 heatmap_grid
+ * @returns {HTMLCanvasElement}
+ */
+export const renderCamGrid = (grid) => {
+  const values = decodeBase64(grid.data);
+  const lut = decodeBase64(grid.lut);
+  const canvas = document.createElement('canvas');
+  canvas.width = grid.width;
+  canvas.height = grid.height;
+  const ctx = canvas.getContext('2d');
+  const img = ctx.createImageData(grid.width, grid.height);
+  for (let i = 0; i < values.length; i += 1) {
+    const v = values[i] * 3;
+    img.data[i * 4] = lut[v];
+    img.data[i * 4 + 1] = lut[v + 1];
+    img.data[i * 4 + 2] = lut[v + 2];
+    img.data[i * 4 + 3] = 255;
+  }
+  ctx.putImageData(img, 0, 0);
+  return canvas;
+};
+
+/**
+ * 在目标画布上绘制原图并叠加 CAM
+ * @param {HTMLCanvasElement} canvas - 目标画布
+ * @param {HTMLImageElement} image - 已加载的原图
+ * @param {object} grid - 后端返回的 heatmap_grid
+ * @param {number} [alpha] - 叠加权重，缺省取 grid.alpha
+ */
+export const drawCamOverlay = (canvas, image, grid, alpha) => {
+  const w = image.naturalWidth || grid.image_width;
+  const h = image.naturalHeight || grid.image_height;
+  canvas.width = w;
+  canvas.height = h;
+  const ctx = canvas.getContext('2d');
+  ctx.globalAlpha = 1;
+  ctx.drawImage(image, 0, 0, w, h);
+  ctx.imageSmoothingEnabled = true;
+  ctx.imageSmoothingQuality = 'high';
+  ctx.globalAlpha = typeof alpha === 'number' ? alpha : (grid.alpha ?? 0.45);
+  ctx.drawImage(renderCamGrid(grid), 0, 0, w, h);
+  ctx.globalAlpha = 1;
+};
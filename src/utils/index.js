@@ -2,3 +2,4 @@
 export * from './formatUtils';
 export * from './validationUtils';
 export * from './storageUtils';
+export * from './camOverlay';
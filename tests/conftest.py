@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+测试公共设施：把仓库根目录加入 sys.path（chex_* 均为顶层模块），并提供随机初始化的小权重。
+
+运行：
+    pytest tests            # 在仓库根目录用 python -m pytest 时，根目录下的 py.py 会遮蔽 pytest 依赖的 py 包
+缺少 torch / torchvision / pydicom / onnxruntime 等依赖的用例自动跳过。
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+CHEX_CLASSES = [
+    "No Finding", "Enlarged Cardiomediastinum", "Cardiomegaly",
+    "Lung Lesion", "Lung Opacity", "Edema", "Consolidation",
+    "Pneumonia", "Atelectasis", "Pneumothorax", "Pleural Effusion",
+    "Pleural Other", "Fracture", "Support Devices"
+]
+
+
+@pytest.fixture(scope="session")
+def checkpoint(tmp_path_factory):
+    """随机初始化的 DenseNet121 权重（格式同训练产物），整个测试会话共用一份。"""
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("torchvision")
+    import chex_model
+
+    torch.manual_seed(0)
+    model = chex_model._build_densenet121(len(CHEX_CLASSES))
+    path = str(tmp_path_factory.mktemp("model") / "random_densenet121.pth")
+    torch.save({"model_state_dict": model.state_dict()}, path)
+    return path
+
+
+def synthetic_xray(size: int = 320, seed: int = 0, height=None):
+    """合成单通道“胸片”（PIL L）：暗背景 + 两个亮椭圆肺野 + 噪声。"""
+    import numpy as np
+    from PIL import Image
+
+    height = height or size
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:size].astype(np.float32)
+    yy /= height
+    xx /= size
+    img = 0.15 + 0.05 * rng.standard_normal((height, size)).astype(np.float32)
+    for cx in (0.32 + 0.05 * rng.random(), 0.68 - 0.05 * rng.random()):
+        lung = ((xx - cx) / 0.17) ** 2 + ((yy - 0.5) / 0.32) ** 2 < 1.0
+        img[lung] += 0.5 + 0.1 * rng.random()
+    return Image.fromarray((np.clip(img, 0, 1) * 255).astype(np.uint8), mode="L")
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""各推理后端 × BN 折叠 × channels_last 与 eager 的概率 / CAM 一致性（容差同 init_model 自检）。"""
+
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+
+import chex_backends  # noqa: E402
+import chex_model  # noqa: E402
+from chex_preprocess import Preprocessor  # noqa: E402
+from conftest import CHEX_CLASSES, synthetic_xray  # noqa: E402
+
+ATOL_PROBS = 1e-3
+ATOL_CAM = 1e-2
+
+
+@pytest.fixture(scope="module")
+def eager_model(checkpoint):
+    model, _ = chex_model._load_checkpoint(checkpoint, CHEX_CLASSES)
+    return model.cpu().eval()
+
+
+@pytest.fixture(scope="module")
+def example():
+    # 两张合成胸片 + 一张均匀噪声，batch 维 > 1 以覆盖动态 batch
+    import numpy as np
+
+    pre = Preprocessor(224)
+    smalls = [pre.decode(synthetic_xray(256, seed=s)).small for s in (0, 1)]
+    smalls.append(np.random.default_rng(0).integers(0, 256, size=(224, 224), dtype=np.uint8))
+    return pre.to_batch(smalls).clone()
+
+
+def _requires(backend: str) -> None:
+    if backend == "onnx":
+        pytest.importorskip("onnxruntime")
+        pytest.importorskip("onnx")
+    elif backend == "compile":
+        pytest.importorskip("torch._dynamo", reason="当前 PyTorch 不支持 torch.compile")
+
+
+@pytest.mark.parametrize("channels_last", [False, True], ids=["nchw", "nhwc"])
+@pytest.mark.parametrize("fold_bn", [False, True], ids=["bn", "fold"])
+@pytest.mark.parametrize("backend", chex_backends.BACKENDS)
+def test_backend_parity(eager_model, example, tmp_path, backend, fold_bn, channels_last):
+    _requires(backend)
+    reference = chex_backends.build_runner(eager_model, "eager")
+    model = copy.deepcopy(eager_model)
+    if fold_bn:
+        assert chex_backends.fold_batchnorm(model) > 0
+    runner = chex_backends.build_runner(model, backend, channels_last, example,
+                                        onnx_path=str(tmp_path / "model.onnx"))
+    weight = chex_model._find_linear(eager_model.classifier).weight
+    parity = chex_backends.check_parity(reference, runner, weight, example, ATOL_PROBS, ATOL_CAM)
+    assert parity["ok"], parity
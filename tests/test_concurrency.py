@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+并发推理正确性：多线程同时调用 chex_model.infer 与 BatchingEngine.infer，
+每个结果的概率与热力图都必须与同一张图串行推理的结果一致（不串图、不串 CAM）。
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("cv2")
+
+import chex_model  # noqa: E402
+from chex_batching import BatchingEngine  # noqa: E402
+from conftest import CHEX_CLASSES, synthetic_xray  # noqa: E402
+
+CLIENTS = 8
+REQUESTS = 48
+# 批量前向与单张前向的浮点误差：概率绝对差、热力图逐像素差
+PROB_ATOL = 1e-4
+PIXEL_TOL = 2
+
+
+@pytest.fixture(scope="module")
+def images():
+    # 尺寸各异：串图时连热力图形状都对不上
+    return [synthetic_xray(224 + 16 * (i % 5), seed=i) for i in range(6)]
+
+
+@pytest.fixture(scope="module")
+def references(checkpoint, images):
+    chex_model.init_model(checkpoint, class_names=CHEX_CLASSES, device="cpu")
+    return [_summary(chex_model.infer(img)) for img in images]
+
+
+def _summary(out):
+    probs = np.array([out["probs"][c] for c in CHEX_CLASSES], dtype=np.float64)
+    return probs, np.asarray(out["heatmap"], dtype=np.int16)
+
+
+def _assert_matches(idx, out, references):
+    probs, heatmap = _summary(out)
+    ref_probs, ref_heatmap = references[idx]
+    assert heatmap.shape == ref_heatmap.shape, f"image {idx}: heatmap shape {heatmap.shape} != {ref_heatmap.shape}"
+    assert np.abs(probs - ref_probs).max() <= PROB_ATOL, f"image {idx}: probs differ"
+    assert np.abs(heatmap - ref_heatmap).max() <= PIXEL_TOL, f"image {idx}: heatmap differs"
+    # 还要比其他任何一张同尺寸图片的参考都更接近自己
+    own = np.abs(heatmap - ref_heatmap).mean()
+    for j, (_, other) in enumerate(references):
+        if j != idx and other.shape == heatmap.shape:
+            assert np.abs(heatmap - other).mean() > own, f"image {idx}: heatmap closer to image {j}"
+
+
+def _order(n_images):
+    return [int(i) for i in np.random.default_rng(0).integers(0, n_images, size=REQUESTS)]
+
+
+def test_threaded_infer_matches_serial(images, references):
+    order = _order(len(images))
+    with ThreadPoolExecutor(CLIENTS) as pool:
+        outs = list(pool.map(lambda i: chex_model.infer(images[i]), order))
+    for idx, out in zip(order, outs):
+        _assert_matches(idx, out, references)
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_batching_engine_matches_serial(images, references, num_workers):
+    order = _order(len(images))
+    engine = BatchingEngine(max_batch_size=4, max_wait_ms=5.0, num_workers=num_workers).start()
+    try:
+        with ThreadPoolExecutor(CLIENTS) as pool:
+            outs = list(pool.map(lambda i: engine.infer(images[i]), order))
+    finally:
+        engine.stop()
+    for idx, out in zip(order, outs):
+        _assert_matches(idx, out, references)
+
+
+def test_batching_engine_isolates_bad_image(images, references):
+    """一张解码失败的图只让它自己的调用方失败，同一微批里的其他图照常返回。"""
+    engine = BatchingEngine(max_batch_size=8, max_wait_ms=50.0).start()
+    try:
+        futs = [engine.submit(images[0]), engine.submit(b"not an image"), engine.submit(images[1])]
+        with pytest.raises(Exception):
+            futs[1].result(timeout=60)
+        _assert_matches(0, futs[0].result(timeout=60), references)
+        _assert_matches(1, futs[2].result(timeout=60), references)
+    finally:
+        engine.stop()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""chex_dicom.read_dicom：合成 DICOM 覆盖 MONOCHROME1、Rescale、窗宽窗位 / min-max、8/16 位 memmap 与 pixel_array 回退、降采样。"""
+
+import io
+
+import numpy as np
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+cv2 = pytest.importorskip("cv2")
+
+import chex_dicom  # noqa: E402
+from chex_dicom import read_dicom  # noqa: E402
+
+
+def _dicom(arr: np.ndarray, **attrs) -> bytes:
+    """uint8 / uint16 数组 -> 最小可读的 DICOM 字节（Explicit VR Little Endian）。"""
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, SecondaryCaptureImageStorage, generate_uid
+
+    bits = arr.dtype.itemsize * 8
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = "CR"
+    ds.Rows, ds.Columns = arr.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = bits
+    ds.BitsStored = bits
+    ds.HighBit = bits - 1
+    ds.PixelRepresentation = 0
+    for k, v in attrs.items():
+        setattr(ds, k, v)
+    ds.PixelData = np.ascontiguousarray(arr).tobytes()
+    buf = io.BytesIO()
+    if int(pydicom.__version__.split(".")[0]) >= 3:
+        pydicom.dcmwrite(buf, ds, enforce_file_format=True)
+    else:
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        pydicom.dcmwrite(buf, ds, write_like_original=False)
+    return buf.getvalue()
+
+
+def _expected(arr, slope=None, intercept=None, center=None, width=None, mono1=False) -> np.ndarray:
+    """按 DICOM 显示管线逐像素用 float64 计算的参考结果。"""
+    v = arr.astype(np.float64)
+    if slope is not None:
+        v = v * slope
+    if intercept is not None:
+        v = v + intercept
+    if center is not None and width is not None:
+        v = (v - (center - 0.5)) / max(width - 1.0, 1.0) + 0.5
+    else:
+        v = (v - v.min()) / (v.max() - v.min() + 1e-6)
+    v = np.clip(v, 0.0, 1.0)
+    if mono1:
+        v = 1.0 - v
+    return (v * 255.0 + 0.5).astype(np.uint8)
+
+
+def _image(bits: int, shape=(96, 128), seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    hi = 255 if bits == 8 else 4095
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    ramp = (xx / shape[1] * 0.7 + yy / shape[0] * 0.3) * hi
+    arr = ramp + rng.normal(0, hi * 0.02, shape)
+    return np.clip(arr, 0, hi).astype(np.uint8 if bits == 8 else np.uint16)
+
+
+@pytest.fixture(params=["memmap", "pixel_array"])
+def reader(request, tmp_path):
+    """memmap：从磁盘文件读取（映射像素区）；pixel_array：BytesIO 无法映射，走 pydicom 解码回退。"""
+    def _read(data: bytes, **kw):
+        if request.param == "pixel_array":
+            return read_dicom(io.BytesIO(data), **kw)
+        path = tmp_path / "image.dcm"
+        path.write_bytes(data)
+        with open(path, "rb") as f:
+            return read_dicom(f, **kw)
+    _read.mode = request.param
+    return _read
+
+
+def _assert_close(got: np.ndarray, want: np.ndarray) -> None:
+    assert got.dtype == np.uint8 and got.shape == want.shape
+    # 查找表在 float32 中计算，与 float64 参考至多差 1 级
+    assert np.abs(got.astype(np.int16) - want.astype(np.int16)).max() <= 1
+
+
+@pytest.mark.parametrize("bits", [8, 16])
+def test_minmax(reader, bits):
+    arr = _image(bits)
+    _assert_close(reader(_dicom(arr)), _expected(arr))
+
+
+@pytest.mark.parametrize("bits", [8, 16])
+def test_window(reader, bits):
+    arr = _image(bits)
+    center, width = (128.0, 100.0) if bits == 8 else (2000.0, 1500.0)
+    got = reader(_dicom(arr, WindowCenter=center, WindowWidth=width))
+    _assert_close(got, _expected(arr, center=center, width=width))
+    # 显式窗与 min-max 拉伸的结果确实不同（窗外像素被截断）
+    assert not np.array_equal(got, reader(_dicom(arr)))
+    assert (got == 0).any() and (got == 255).any()
+
+
+@pytest.mark.parametrize("bits", [8, 16])
+def test_monochrome1_inverts(reader, bits):
+    arr = _image(bits)
+    got = reader(_dicom(arr, PhotometricInterpretation="MONOCHROME1"))
+    _assert_close(got, _expected(arr, mono1=True))
+    mono2 = reader(_dicom(arr))
+    assert np.abs(got.astype(np.int16) - (255 - mono2.astype(np.int16))).max() <= 1
+
+
+def test_rescale_then_window(reader):
+    arr = _image(16)
+    # CT 式 Rescale：窗宽窗位以 Rescale 之后的单位给出
+    attrs = dict(RescaleSlope=0.5, RescaleIntercept=-1024.0, WindowCenter=-200.0, WindowWidth=800.0)
+    got = reader(_dicom(arr, **attrs))
+    _assert_close(got, _expected(arr, slope=0.5, intercept=-1024.0, center=-200.0, width=800.0))
+
+
+def test_rescale_minmax_monochrome1(reader):
+    arr = _image(16)
+    got = reader(_dicom(arr, RescaleSlope=2.0, RescaleIntercept=100.0, PhotometricInterpretation="MONOCHROME1"))
+    _assert_close(got, _expected(arr, slope=2.0, intercept=100.0, mono1=True))
+
+
+@pytest.mark.parametrize("bits", [8, 16])
+def test_memmap_matches_pixel_array(tmp_path, bits):
+    arr = _image(bits, seed=3)
+    data = _dicom(arr, WindowCenter=float(arr.mean()), WindowWidth=float(arr.std() * 4),
+                  PhotometricInterpretation="MONOCHROME1")
+    path = tmp_path / "image.dcm"
+    path.write_bytes(data)
+    with open(path, "rb") as f:
+        ds = pydicom.dcmread(f, defer_size=chex_dicom._DEFER_SIZE)
+        view = chex_dicom._pixel_view(ds, f)
+        assert isinstance(view, np.memmap)
+        np.testing.assert_array_equal(np.asarray(view), arr)
+    assert chex_dicom._pixel_view(pydicom.dcmread(io.BytesIO(data), defer_size=chex_dicom._DEFER_SIZE),
+                                  io.BytesIO(data)) is None
+    with open(path, "rb") as f:
+        via_memmap = read_dicom(f)
+    np.testing.assert_array_equal(via_memmap, read_dicom(io.BytesIO(data)))
+
+
+@pytest.mark.parametrize("bits", [8, 16])
+def test_max_side_downsamples(reader, bits):
+    arr = _image(bits, shape=(400, 500))
+    got = reader(_dicom(arr), max_side=100)
+    assert got.shape == (80, 100)
+    small = cv2.resize(arr, (100, 80), interpolation=cv2.INTER_AREA)
+    _assert_close(got, _expected(small))
+    # 不超过 max_side 的不缩放
+    assert reader(_dicom(arr), max_side=1000).shape == arr.shape
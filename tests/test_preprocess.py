@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""chex_preprocess 与原 convert("RGB") + T.Resize + T.ToTensor (+ Normalize) 管线的张量一致性。"""
+
+import io
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+T = pytest.importorskip("torchvision.transforms")
+Image = pytest.importorskip("PIL.Image")
+
+from conftest import synthetic_xray  # noqa: E402
+from chex_preprocess import IMAGENET_MEAN, IMAGENET_STD, Preprocessor  # noqa: E402
+
+
+def _legacy(pil, use_imagenet_norm: bool) -> torch.Tensor:
+    tfms = [T.Resize((224, 224)), T.ToTensor()]
+    if use_imagenet_norm:
+        tfms.append(T.Normalize(mean=list(IMAGENET_MEAN), std=list(IMAGENET_STD)))
+    return T.Compose(tfms)(pil.convert("RGB"))
+
+
+def _encode(pil, fmt: str) -> bytes:
+    buf = io.BytesIO()
+    pil.save(buf, format=fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return buf.getvalue()
+
+
+def _colour(size: int = 300, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    arr = rng.integers(0, 256, size=(size, size + 40, 3), dtype=np.uint8)
+    arr[..., 0] = np.linspace(0, 255, size + 40, dtype=np.uint8)   # 三个通道明显不同
+    return Image.fromarray(arr, mode="RGB")
+
+
+IMAGES = {
+    "gray_png": lambda: _encode(synthetic_xray(300), "PNG"),
+    "gray_as_rgb_png": lambda: _encode(synthetic_xray(300).convert("RGB"), "PNG"),
+    "gray_jpeg": lambda: _encode(synthetic_xray(300), "JPEG"),
+    "colour_png": lambda: _encode(_colour(), "PNG"),
+    "colour_jpeg": lambda: _encode(_colour(), "JPEG"),
+}
+
+
+@pytest.mark.parametrize("use_imagenet_norm", [False, True])
+@pytest.mark.parametrize("name", sorted(IMAGES))
+def test_matches_legacy_pipeline(name, use_imagenet_norm):
+    data = IMAGES[name]()
+    pre = Preprocessor(224, use_imagenet_norm=use_imagenet_norm)
+    decoded = pre.decode(data, keep_full=True)
+    got = pre.to_batch([decoded.small])[0]
+    want = _legacy(Image.open(io.BytesIO(data)), use_imagenet_norm)
+    assert got.shape == want.shape
+    assert torch.allclose(got, want, atol=1e-5), float((got - want).abs().max())
+
+
+def test_colour_keeps_three_channels():
+    decoded = Preprocessor(224).decode(_encode(_colour(), "PNG"))
+    assert decoded.small.shape == (224, 224, 3)
+
+
+@pytest.mark.parametrize("name", ["gray_png", "gray_as_rgb_png"])
+def test_gray_is_single_channel(name):
+    decoded = Preprocessor(224).decode(IMAGES[name]())
+    assert decoded.small.shape == (224, 224)